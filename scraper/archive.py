@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+# Append-only archive of raw responses
+#
+# Records are WARC-style (a block of WARC headers followed by the HTTP status line, headers and body) and every record
+# is its own gzip member, so segments can be appended to, concatenated and read with any gzip-aware WARC tool.
+
+import datetime
+import glob
+import gzip
+import os
+import uuid
+import zlib
+
+
+class ArchiveWriter(object):
+    """Appends response records to numbered, size-capped segments in a directory"""
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.segment = None
+        self.segment_number = None
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, fingerprint, method, url, status, headers, body):
+        """
+        :param headers: list of (name, value) pairs
+        """
+        http_block = ['HTTP/1.1 %d' % status]
+        http_block.extend('%s: %s' % (name, value) for name, value in headers)
+        payload = ('\r\n'.join(http_block) + '\r\n\r\n').encode('latin1') + body
+        warc_headers = ['WARC/1.0',
+                        'WARC-Type: response',
+                        'WARC-Record-ID: <urn:uuid:%s>' % uuid.uuid4(),
+                        'WARC-Date: %s' % datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                        'WARC-Target-URI: %s' % url,
+                        'X-Request-Method: %s' % method,
+                        'X-Request-Fingerprint: %s' % fingerprint,
+                        'Content-Type: application/http; msgtype=response',
+                        'Content-Length: %d' % len(payload)]
+        record = ('\r\n'.join(warc_headers) + '\r\n\r\n').encode('latin1') + payload + b'\r\n\r\n'
+
+        if self.segment is None or self.segment.tell() >= self.segment_size:
+            self._rotate()
+        self.segment.write(gzip.compress(record))
+
+    def close(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+
+    def _rotate(self):
+        # Every run starts a new segment, the existing ones are never written to again
+        self.close()
+        if self.segment_number is None:
+            self.segment_number = len(segment_paths(self.directory))
+        else:
+            self.segment_number += 1
+        path = os.path.join(self.directory, 'archive-%05d.warc.gz' % self.segment_number)
+        self.segment = open(path, 'ab')
+
+
+class ArchiveReader(object):
+    """Indexes every segment in a directory by request fingerprint; later records win over earlier ones"""
+
+    def __init__(self, directory):
+        self.index = {}
+        for path in segment_paths(directory):
+            with open(path, 'rb') as segment:
+                data = segment.read()
+            offset = 0
+            while offset < len(data):
+                record, length = _read_member(data, offset)
+                headers, _ = _parse_warc_record(record)
+                self.index[headers['X-Request-Fingerprint']] = (path, offset, length)
+                offset += length
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, fingerprint):
+        """Returns (url, status, headers, body) of the archived response, or None"""
+        if fingerprint not in self.index:
+            return None
+        path, offset, length = self.index[fingerprint]
+        with open(path, 'rb') as segment:
+            segment.seek(offset)
+            record, _ = _read_member(segment.read(length), 0)
+        warc_headers, payload = _parse_warc_record(record)
+        http_block, body = payload.split(b'\r\n\r\n', 1)
+        lines = http_block.decode('latin1').split('\r\n')
+        status = int(lines[0].split(' ')[1])
+        headers = [tuple(line.split(': ', 1)) for line in lines[1:]]
+        return warc_headers['WARC-Target-URI'], status, headers, body
+
+
+def segment_paths(directory):
+    return sorted(glob.glob(os.path.join(directory, 'archive-*.warc.gz')))
+
+
+def _read_member(data, offset):
+    """Decompresses the gzip member starting at offset and returns it with its compressed length"""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    view = memoryview(data)
+    parts = []
+    position = offset
+    while not decompressor.eof and position < len(data):
+        chunk = view[position:position + 65536]
+        parts.append(decompressor.decompress(chunk))
+        position += len(chunk)
+    return b''.join(parts), position - offset - len(decompressor.unused_data)
+
+
+def _parse_warc_record(record):
+    header_block, rest = record.split(b'\r\n\r\n', 1)
+    headers = dict(line.split(': ', 1) for line in header_block.decode('latin1').split('\r\n')[1:])
+    return headers, rest[:int(headers['Content-Length'])]
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+# Buffered bulk writes for DatabasePipeline
+#
+# Items are accumulated per table and written in batches inside a single transaction: entity rows with PostgreSQL
+# COPY and association rows with psycopg2's execute_values. Association rows that reference an agency, mission or
+# measurement that has not been written yet are kept back until it is, so the crawl order does not matter.
+
+import io
+import logging
+
+from psycopg2.extras import execute_values
+from sqlalchemy import inspect
+
+from scraper.models import BroadMeasurementCategory, MeasurementCategory, Measurement, Agency, Mission, Instrument
+from scraper.dimensions import ITEM_MODELS
+
+logger = logging.getLogger(__name__)
+
+# Entity models in the order their tables are written, so that foreign keys always point to rows already written
+ENTITY_MODELS = (BroadMeasurementCategory, MeasurementCategory, Measurement, Agency, Mission, Instrument)
+
+
+def copy_value(value):
+    """Formats a value for the text format of COPY"""
+    if value is None:
+        return '\\N'
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class BulkWriter(object):
+    """Accumulates rows per table and writes them with COPY and execute_values when a batch is full"""
+
+    def __init__(self, engine, cache, batch_size=1000, schema=None):
+        self.engine = engine
+        self.cache = cache
+        self.batch_size = batch_size
+        # Schema the tables are written to, if not the default one
+        self.schema = schema
+        self.connection = engine.raw_connection()
+        # Attribute name -> column name of every entity model (e.g. orbit_LST -> orbit_lst)
+        self.columns = {model: [(attr.key, attr.columns[0].name) for attr in inspect(model).column_attrs]
+                        for model in ENTITY_MODELS}
+        self.rows = {model: {} for model in ENTITY_MODELS}
+        self.links = []
+        self.buffered = 0
+
+    def add(self, item):
+        """Buffers an item and its association rows, flushing if the batch is full"""
+        model = ITEM_MODELS.get(type(item))
+        if model is None:
+            return
+        if self.cache.has(model, item['id']) or item['id'] in self.rows[model]:
+            logger.warning('Skipping duplicate %s %s', model.__name__, item['id'])
+            return
+        self.rows[model][item['id']] = {key: item.get(key) for key, _ in self.columns[model]}
+        self.links.extend(self.cache.links(model, item))
+        self.buffered += 1
+        if self.buffered >= self.batch_size:
+            self.flush()
+
+    def flush(self, final=False):
+        """Writes everything buffered in one transaction. On the final flush, links that are still unresolved are
+        dropped"""
+        if not self.buffered and not final:
+            return
+        ready = {}
+        waiting = []
+        cursor = self.connection.cursor()
+        try:
+            for model in ENTITY_MODELS:
+                if self.rows[model]:
+                    self.copy(cursor, model, list(self.rows[model].values()))
+            for link in self.links:
+                table, row, model, target_id = link
+                if model is None or self.cache.has(model, target_id) or target_id in self.rows[model]:
+                    ready.setdefault(table, []).append(row)
+                else:
+                    waiting.append(link)
+            for table, rows in ready.items():
+                columns = ', '.join(column.name for column in table.columns)
+                statement = 'INSERT INTO %s (%s) VALUES %%s' % (self.table_name(table.name), columns)
+                execute_values(cursor, statement, rows, page_size=self.batch_size)
+            self.connection.commit()
+        except:
+            self.connection.rollback()
+            raise
+        finally:
+            cursor.close()
+        logger.debug('Flushed %d items and %d links', self.buffered, sum(len(rows) for rows in ready.values()))
+        for model in ENTITY_MODELS:
+            for row in self.rows[model].values():
+                self.cache.add(model, row)
+        for table, rows in ready.items():
+            for row in rows:
+                self.cache.add_link(table, row)
+        self.rows = {model: {} for model in ENTITY_MODELS}
+        self.links = waiting
+        self.buffered = 0
+        if final and waiting:
+            logger.warning('Dropping %d links to entities that were never scraped', len(waiting))
+            self.links = []
+
+    def copy(self, cursor, model, rows):
+        keys = [key for key, _ in self.columns[model]]
+        data = io.StringIO()
+        for row in rows:
+            data.write('\t'.join(copy_value(row[key]) for key in keys))
+            data.write('\n')
+        data.seek(0)
+        columns = ', '.join(column for _, column in self.columns[model])
+        cursor.copy_expert('COPY %s (%s) FROM STDIN' % (self.table_name(model.__tablename__), columns), data)
+
+    def table_name(self, name):
+        return '%s.%s' % (self.schema, name) if self.schema else name
+
+    def close(self):
+        self.flush(final=True)
+        self.connection.close()
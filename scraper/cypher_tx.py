@@ -1,82 +1,217 @@
+import logging
+from collections import namedtuple
+
 from scraper.items import MeasurementCategory, BroadMeasurementCategory, Measurement, Agency, Mission, Instrument
 
+logger = logging.getLogger(__name__)
+
+# Item type -> (node label, node properties), in the order the labels are written
+NODES = {BroadMeasurementCategory: ('BroadObservablePropertyCategory', ('id', 'name', 'description')),
+         MeasurementCategory: ('ObservablePropertyCategory', ('id', 'name', 'description')),
+         Measurement: ('ObservableProperty', ('id', 'name', 'description')),
+         Agency: ('Agency', ('id', 'name', 'country', 'website')),
+         Mission: ('Platform', ('id', 'name', 'full_name', 'status', 'launch_date', 'eol_date', 'norad_id',
+                                'applications', 'orbit_type', 'orbit_period', 'orbit_sense', 'orbit_inclination',
+                                'orbit_inclination_num', 'orbit_inclination_class', 'orbit_altitude',
+                                'orbit_altitude_num', 'orbit_altitude_class', 'orbit_longitude', 'orbit_LST',
+                                'orbit_LST_time', 'orbit_LST_class', 'repeat_cycle', 'repeat_cycle_num',
+                                'repeat_cycle_class')),
+         Instrument: ('Sensor', ('id', 'name', 'full_name', 'status', 'maturity', 'technology', 'sampling',
+                                 'data_access', 'data_format', 'measurements_and_applications', 'resolution_summary',
+                                 'best_resolution', 'swath_summary', 'max_swath', 'accuracy_summary',
+                                 'waveband_summary', 'types', 'geometries', 'wavebands'))}
+
+# Relationship from the start node to the end node, written along with its reverse if there is one. Rows have the
+# start and end node ids as id1 and id2, and the properties of the relationship
+Relationship = namedtuple('Relationship', ['start', 'type', 'end', 'reverse', 'properties'])
+
+CATEGORY_INCLUDES = Relationship('BroadObservablePropertyCategory', 'INCLUDES', 'ObservablePropertyCategory',
+                                 'TYPE_OF', ())
+PROPERTY_INCLUDES = Relationship('ObservablePropertyCategory', 'INCLUDES', 'ObservableProperty', 'TYPE_OF', ())
+PLATFORM_BUILT_BY = Relationship('Platform', 'BUILT_BY', 'Agency', 'BUILT', ())
+SENSOR_BUILT_BY = Relationship('Sensor', 'BUILT_BY', 'Agency', 'BUILT', ())
+SENSOR_HOSTED_BY = Relationship('Sensor', 'IS_HOSTED_BY', 'Platform', 'HOSTS', ())
+SENSOR_OBSERVES = Relationship('Sensor', 'OBSERVES', 'ObservableProperty', None, ('accuracy',))
+
+RELATIONSHIPS = (CATEGORY_INCLUDES, PROPERTY_INCLUDES, PLATFORM_BUILT_BY, SENSOR_BUILT_BY, SENSOR_HOSTED_BY,
+                 SENSOR_OBSERVES)
+
+# Reverse relationship type -> type of the relationship it reverses. With the single layout the reverse relationships
+# are not written, and (a)-[:BUILT]->(b) is matched as (a)<-[:BUILT_BY]-(b), (a)-[:HOSTS]->(b) as
+# (a)<-[:IS_HOSTED_BY]-(b) and (a)-[:TYPE_OF]->(b) as (a)<-[:INCLUDES]-(b)
+REVERSE_TYPES = {relationship.reverse: relationship.type for relationship in RELATIONSHIPS
+                 if relationship.reverse is not None}
+
+# Label -> relationships written with the nodes of that label, which are replaced when the node is written again
+OWNED_RELATIONSHIPS = {'ObservablePropertyCategory': (CATEGORY_INCLUDES,),
+                       'ObservableProperty': (PROPERTY_INCLUDES,),
+                       'Platform': (PLATFORM_BUILT_BY,),
+                       'Sensor': (SENSOR_BUILT_BY, SENSOR_HOSTED_BY, SENSOR_OBSERVES)}
+
+
+def item_rows(item):
+    """Node label and properties of an item, and its relationships as (relationship, row) pairs. None for items that
+    are not written to the graph"""
+    if type(item) not in NODES:
+        return None
+    label, properties = NODES[type(item)]
+    node = {prop: item.get(prop) for prop in properties}
+    if isinstance(item, MeasurementCategory):
+        relationships = [(CATEGORY_INCLUDES, {'id1': item['broad_measurement_category_id'], 'id2': item['id']})]
+    elif isinstance(item, Measurement):
+        relationships = [(PROPERTY_INCLUDES, {'id1': item['measurement_category_id'], 'id2': item['id']})]
+    elif isinstance(item, Mission):
+        relationships = [(PLATFORM_BUILT_BY, {'id1': item['id'], 'id2': agency_id}) for agency_id in item['agencies']]
+    elif isinstance(item, Instrument):
+        relationships = [(SENSOR_BUILT_BY, {'id1': item['id'], 'id2': agency_id}) for agency_id in item['agencies']]
+        relationships += [(SENSOR_HOSTED_BY, {'id1': item['id'], 'id2': mission_id})
+                          for mission_id in item['missions']]
+        relationships += [(SENSOR_OBSERVES, {'id1': item['id'], 'id2': measurement_id,
+                                             'accuracy': item['accuracies'][idx]})
+                          for idx, measurement_id in enumerate(item['measurements'])]
+    else:
+        relationships = []
+    return label, node, relationships
+
+
+def delete_graph_batch(tx, batch_size, label=None, keep=None):
+    """Deletes up to batch_size nodes (all of them if 0) with their relationships, of a label if given, and only the
+    ones outside of the generations to keep if given (None keeping the nodes without a generation). Returns the number
+    of nodes deleted"""
+    query = "MATCH (n%s) " % (':' + label if label else '')
+    if keep is not None and None in keep:
+        # The graph written before the first generation is what the readers use until a generation is switched to
+        keep = [generation for generation in keep if generation is not None]
+        query += "WHERE n.generation IS NOT NULL AND NOT n.generation IN $keep "
+    elif keep is not None:
+        query += "WHERE n.generation IS NULL OR NOT n.generation IN $keep "
+    if batch_size:
+        query += "WITH n LIMIT $batch "
+    query += "DETACH DELETE n RETURN count(*) AS deleted"
+    return tx.run(query, batch=batch_size, keep=keep).single()['deleted']
+
+
+def create_constraints(tx):
+    """Uniqueness constraints on the id of every label, which also index the id lookups of every statement"""
+    for label, _ in NODES.values():
+        tx.run("CREATE CONSTRAINT %s_id IF NOT EXISTS ON (n:%s) ASSERT n.id IS UNIQUE" % (label.lower(), label))
+
+
+def create_generation_indexes(tx):
+    """Indexes on the id and generation of every label. Every generation has its own copy of every node, so the ids
+    are no longer unique"""
+    for label, _ in NODES.values():
+        tx.run("DROP CONSTRAINT %s_id IF EXISTS" % label.lower())
+        tx.run("CREATE INDEX %s_id_generation IF NOT EXISTS FOR (n:%s) ON (n.id, n.generation)" % (label.lower(),
+                                                                                                     label))
+
+
+# Graph generations. Every crawl in generation mode writes a copy of the graph with its own generation number, and
+# readers use the nodes of the generation in the GraphGeneration node, e.g.
+#   MATCH (g:GraphGeneration {name: 'graph'}) MATCH (s:Sensor {generation: g.current}) RETURN s
+
+
+def start_generation(tx):
+    """Reserves the number of a new generation. Returns the current generation and the new one"""
+    record = tx.run("MERGE (g:GraphGeneration {name: 'graph'}) "
+                    "RETURN g.current AS current, g.latest AS latest").single()
+    generation = max(record['current'] or 0, record['latest'] or 0) + 1
+    tx.run("MATCH (g:GraphGeneration {name: 'graph'}) "
+           "SET g.latest = $generation", generation=generation)
+    return record['current'], generation
+
+
+def switch_generation(tx, generation):
+    """Points the readers to a generation"""
+    tx.run("MATCH (g:GraphGeneration {name: 'graph'}) "
+           "SET g.current = $generation", generation=generation)
+
+
+def has_generations(tx):
+    """Whether the graph has been written in generations"""
+    return tx.run("MATCH (g:GraphGeneration {name: 'graph'}) "
+                  "RETURN count(g) AS count").single()['count'] > 0
+
+
+def current_generation(tx):
+    """Generation the readers should use, or None if the graph has none"""
+    record = tx.run("MATCH (g:GraphGeneration {name: 'graph'}) "
+                    "RETURN g.current AS current").single()
+    return record['current'] if record is not None else None
+
+
+def relationship_pattern(start, type, end, layout='both'):
+    """Cypher pattern matching a relationship of a type from the start pattern to the end pattern in a graph with the
+    given layout, e.g. relationship_pattern('(a:Agency)', 'BUILT', '(p)', 'single') is '(a:Agency)<-[:BUILT_BY]-(p)'"""
+    if layout == 'single' and type in REVERSE_TYPES:
+        return '%s<-[:%s]-%s' % (start, REVERSE_TYPES[type], end)
+    return '%s-[:%s]->%s' % (start, type, end)
+
+
+def node_pattern(var, label, id_expression, generation):
+    if generation is None:
+        return "(%s:%s {id: %s})" % (var, label, id_expression)
+    return "(%s:%s {id: %s, generation: $generation})" % (var, label, id_expression)
+
+
+def add_nodes(tx, label, rows, generation=None):
+    query = ("UNWIND $rows AS row "
+             "MERGE %s "
+             "SET a = row" % node_pattern('a', label, 'row.id', generation))
+    if generation is not None:
+        query += ", a.generation = $generation"
+    return tx.run(query, rows=rows, generation=generation).consume()
+
+
+def delete_relationships(tx, label, ids):
+    """Deletes the relationships owned by the nodes of a label with the given ids, before they are written again"""
+    for relationship in OWNED_RELATIONSHIPS.get(label, ()):
+        types = relationship.type if relationship.reverse is None else '%s|%s' % (relationship.type,
+                                                                                   relationship.reverse)
+        other = relationship.end if relationship.start == label else relationship.start
+        logger.debug(tx.run("UNWIND $ids AS id "
+                            "MATCH (a:%s {id: id})-[r:%s]-(b:%s) "
+                            "DELETE r" % (label, types, other), ids=ids).consume().counters)
+
+
+def add_relationships(tx, relationship, rows, generation=None, reverse=True):
+    """Writes relationship rows, and their reverse relationships if reverse is set. Returns the number of rows whose
+    start and end nodes were found, the others are dropped"""
+    # Sorted so that concurrent transactions lock the nodes they share in the same order
+    rows = sorted(rows, key=lambda row: (row['id2'], row['id1']))
+    query = ("UNWIND $rows AS row "
+             "MATCH %s, %s "
+             "MERGE (a)-[r1:%s]->(b)" % (node_pattern('a', relationship.start, 'row.id1', generation),
+                                         node_pattern('b', relationship.end, 'row.id2', generation),
+                                         relationship.type))
+    if relationship.properties:
+        query += " SET %s" % ', '.join('r1.%s = row.%s' % (prop, prop) for prop in relationship.properties)
+    if reverse and relationship.reverse is not None:
+        query += " MERGE (b)-[r2:%s]->(a)" % relationship.reverse
+    result = tx.run(query + " RETURN count(*) AS matched", rows=rows, generation=generation)
+    matched = result.single()['matched']
+    logger.debug(result.consume().counters)
+    return matched
+
+
+def add_batch(tx, nodes, relationships, replace=False, generation=None, reverse=True):
+    """Writes batches of nodes by label and then batches of relationships, each with a single UNWIND statement, in a
+    generation if given. If replace is set, the relationships the nodes already had are deleted first, and if reverse
+    is set the reverse relationships are written too"""
+    for label, rows in nodes.items():
+        if rows:
+            logger.debug(add_nodes(tx, label, rows, generation).counters)
+            if replace:
+                delete_relationships(tx, label, [row['id'] for row in rows])
+    for relationship, rows in relationships.items():
+        if rows:
+            add_relationships(tx, relationship, rows, generation, reverse)
+
 
-def delete_all_graph(tx):
-    return tx.run("MATCH (n)"
-                  "DETACH DELETE n").consume()
-
-
-def add_broad_observable_property_category(tx, item: BroadMeasurementCategory):
-    return tx.run("CREATE (a:BroadObservablePropertyCategory {id: $id, name: $name, description: $description})", item).consume()
-
-
-def add_observable_property_category(tx, item: MeasurementCategory):
-    tx.run("CREATE (a:ObservablePropertyCategory {id: $id, name: $name, description: $description})", item)
-    return tx.run("MATCH (a:BroadObservablePropertyCategory), (b:ObservablePropertyCategory) "
-                  "WHERE a.id = $id1 AND b.id = $id2 "
-                  "CREATE (a)-[r1:INCLUDES]->(b) "
-                  "CREATE (b)-[r2:TYPE_OF]->(a)", id1=item["broad_measurement_category_id"], id2=item["id"]).consume()
-
-
-def add_observable_property(tx, item: Measurement):
-    tx.run("CREATE (a:ObservableProperty {id: $id, name: $name, description: $description})", item)
-    return tx.run("MATCH (a:ObservablePropertyCategory), (b:ObservableProperty) "
-                  "WHERE a.id = $id1 AND b.id = $id2 "
-                  "CREATE (a)-[r1:INCLUDES]->(b) "
-                  "CREATE (b)-[r2:TYPE_OF]->(a)", id1=item["measurement_category_id"], id2=item["id"]).consume()
-
-
-def add_agency(tx, item: Agency):
-    return tx.run("CREATE (a:Agency {id: $id, name: $name, country: $country, website: $website})", item).consume()
-
-
-def add_platform(tx, item: Mission):
-    summary = tx.run("CREATE (a:Platform {id: $id, name: $name, full_name: $full_name, status: $status, "
-                     "launch_date: $launch_date, eol_date: $eol_date, norad_id: $norad_id, "
-                     "applications: $applications, orbit_type: $orbit_type, orbit_period: $orbit_period, "
-                     "orbit_sense: $orbit_sense, orbit_inclination: $orbit_inclination, "
-                     "orbit_inclination_num: $orbit_inclination_num, "
-                     "orbit_inclination_class: $orbit_inclination_class, orbit_altitude: $orbit_altitude, "
-                     "orbit_altitude_num: $orbit_altitude_num, orbit_altitude_class: $orbit_altitude_class, "
-                     "orbit_longitude: $orbit_longitude, orbit_LST: $orbit_LST, orbit_LST_time: $orbit_LST_time, "
-                     "orbit_LST_class: $orbit_LST_class, repeat_cycle: $repeat_cycle, "
-                     "repeat_cycle_num: $repeat_cycle_num, repeat_cycle_class: $repeat_cycle_class})", item).consume()
-    for agency_id in item['agencies']:
-        rel_sum = tx.run("MATCH (a:Platform), (b:Agency) "
-                         "WHERE a.id = $id1 AND b.id = $id2 "
-                         "CREATE (a)-[r1:BUILT_BY]->(b) "
-                         "CREATE (b)-[r2:BUILT]->(a)", id1=item["id"], id2=agency_id).consume()
-    return summary
-
-
-def add_sensor(tx, item: Instrument):
-    summary = tx.run("CREATE (a:Sensor {id: $id, name: $name, full_name: $full_name, status: $status, "
-                     "maturity: $maturity, technology: $technology, sampling: $sampling, data_access: $data_access,"
-                     "data_format: $data_format, measurements_and_applications: $measurements_and_applications,"
-                     "resolution_summary: $resolution_summary, best_resolution: $best_resolution, "
-                     "swath_summary: $swath_summary, max_swath: $max_swath, accuracy_summary: $accuracy_summary,"
-                     "waveband_summary: $waveband_summary, types: $types, geometries: $geometries, "
-                     "wavebands: $wavebands})", item).consume()
-    for agency_id in item['agencies']:
-        rel_sum = tx.run("MATCH (a:Sensor), (b:Agency) "
-                         "WHERE a.id = $id1 AND b.id = $id2 "
-                         "CREATE (a)-[r1:BUILT_BY]->(b) "
-                         "CREATE (b)-[r2:BUILT]->(a) ", id1=item["id"], id2=agency_id).consume()
-        print(rel_sum.counters)
-    for mission_id in item['missions']:
-        rel_sum = tx.run("MATCH (a:Sensor), (b:Platform) "
-                         "WHERE a.id = $id1 AND b.id = $id2 "
-                         "CREATE (a)-[r1:IS_HOSTED_BY]->(b) "
-                         "CREATE (b)-[r2:HOSTS]->(a) ", id1=item["id"], id2=mission_id).consume()
-        print(rel_sum.counters)
-    print('---> ITEM', item)
-    print('---> ITEM ACCURACIES', item['accuracies'])
-    for idx, measurement_id in enumerate(item['measurements']):
-        rel_sum = tx.run("MATCH (a:Sensor), (b:ObservableProperty) "
-                         "WHERE a.id = $id1 AND b.id = $id2 "
-                         "CREATE (a)-[r1:OBSERVES {accuracy: $accuracy}]->(b) ",
-                         id1=item["id"],
-                         id2=measurement_id,
-                         accuracy=item['accuracies'][idx]).consume()
-        print(rel_sum.counters)
-    return summary
+def add_item(tx, item, replace=False, generation=None, reverse=True):
+    """Writes the node of an item and its relationships"""
+    label, node, relationships = item_rows(item)
+    batch = {}
+    for relationship, row in relationships:
+        batch.setdefault(relationship, []).append(row)
+    return add_batch(tx, {label: [node]}, batch, replace, generation, reverse)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+# Date and time parsing for the CEOS summary pages
+#
+# The pages only use a handful of date shapes ("12 Mar 2005", "Mar 2005", "2005", "10:30"), which are parsed here with
+# precompiled patterns and memoized. Anything else falls back to dateparser, so the results stay the same as
+# calling dateparser directly, including how missing days and months are taken from RELATIVE_BASE.
+
+import calendar
+import datetime
+import functools
+import re
+
+import dateparser
+
+_MONTHS = {'jan': 1, 'january': 1, 'feb': 2, 'february': 2, 'mar': 3, 'march': 3, 'apr': 4, 'april': 4, 'may': 5,
+           'jun': 6, 'june': 6, 'jul': 7, 'july': 7, 'aug': 8, 'august': 8, 'sep': 9, 'sept': 9, 'september': 9,
+           'oct': 10, 'october': 10, 'nov': 11, 'november': 11, 'dec': 12, 'december': 12}
+
+_DAY_MONTH_YEAR = re.compile(r'^(\d{1,2})\s+([A-Za-z]+)\s+(\d{4})$')
+_MONTH_YEAR = re.compile(r'^([A-Za-z]+)\s+(\d{4})$')
+_YEAR = re.compile(r'^(\d{4})$')
+_HOURS_MINUTES = re.compile(r'^(\d{1,2}):(\d{2})$')
+
+_fallbacks = 0
+
+
+def parse_date(text, relative_base):
+    """Same as dateparser.parse(text, settings={'RELATIVE_BASE': relative_base})"""
+    return _parse_date(text, relative_base)
+
+
+def parse_time(text):
+    """Same as dateparser.parse(text).time(), or None if the text is not a time"""
+    return _parse_time(text)
+
+
+def counters():
+    """Memo hits and misses, and how many of the misses had to go through dateparser"""
+    date_info = _parse_date.cache_info()
+    time_info = _parse_time.cache_info()
+    return {'hits': date_info.hits + time_info.hits, 'misses': date_info.misses + time_info.misses,
+            'fallbacks': _fallbacks}
+
+
+def _fallback(text, settings=None):
+    global _fallbacks
+    _fallbacks += 1
+    return dateparser.parse(text, settings=settings)
+
+
+def _with_day(year, month, day):
+    # Like dateparser, a day taken from RELATIVE_BASE is clamped to the length of the month
+    return datetime.datetime(year, month, min(day, calendar.monthrange(year, month)[1]))
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_date(text, relative_base):
+    match = _DAY_MONTH_YEAR.match(text)
+    if match and match.group(2).lower() in _MONTHS:
+        try:
+            return datetime.datetime(int(match.group(3)), _MONTHS[match.group(2).lower()], int(match.group(1)))
+        except ValueError:
+            return None
+    match = _MONTH_YEAR.match(text)
+    if match and match.group(1).lower() in _MONTHS and int(match.group(2)) > 0:
+        return _with_day(int(match.group(2)), _MONTHS[match.group(1).lower()], relative_base.day)
+    match = _YEAR.match(text)
+    if match and int(match.group(1)) > 0:
+        return _with_day(int(match.group(1)), relative_base.month, relative_base.day)
+    return _fallback(text, settings={'RELATIVE_BASE': relative_base})
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_time(text):
+    match = _HOURS_MINUTES.match(text)
+    if match:
+        hours, minutes = int(match.group(1)), int(match.group(2))
+        if hours < 24 and minutes < 60:
+            return datetime.time(hours, minutes)
+        return None
+    parsed = _fallback(text)
+    return parsed.time() if parsed is not None else None
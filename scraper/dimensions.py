@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+# In-memory caches of the rows written by DatabasePipeline
+#
+# The instrument types, geometry types and wavebands are written once when the spider opens, and agencies, missions,
+# measurements and instruments are added as their items are written, so the association rows of an item can be built
+# from the cached IDs without querying the database.
+
+import logging
+
+from sqlalchemy import inspect
+
+from scraper.models import BroadMeasurementCategory, MeasurementCategory, Measurement, Agency, Mission, \
+    InstrumentType, GeometryType, Waveband, Instrument, operators_table, designers_table, type_of_instrument_table, \
+    geometry_of_instrument_table, instruments_in_mission_table, measurements_of_instrument_table, \
+    instrument_wavebands_table
+import scraper.items as items
+
+logger = logging.getLogger(__name__)
+
+CACHED_MODELS = (InstrumentType, GeometryType, Waveband, BroadMeasurementCategory, MeasurementCategory, Measurement,
+                 Agency, Mission, Instrument)
+
+# Association table -> (owner model, owner column, target model, target column). The owner is the model of the item
+# the rows are written for
+LINK_TABLES = {operators_table: (Mission, 1, Agency, 0),
+               designers_table: (Instrument, 1, Agency, 0),
+               type_of_instrument_table: (Instrument, 0, InstrumentType, 1),
+               geometry_of_instrument_table: (Instrument, 0, GeometryType, 1),
+               instruments_in_mission_table: (Instrument, 1, Mission, 0),
+               measurements_of_instrument_table: (Instrument, 0, Measurement, 1),
+               instrument_wavebands_table: (Instrument, 0, Waveband, 1)}
+
+ITEM_MODELS = {items.BroadMeasurementCategory: BroadMeasurementCategory,
+               items.MeasurementCategory: MeasurementCategory,
+               items.Measurement: Measurement,
+               items.Agency: Agency,
+               items.Mission: Mission,
+               items.Instrument: Instrument}
+
+
+class DimensionCache(object):
+    """Name -> id and id -> row caches of the dimension and entity tables"""
+
+    def __init__(self):
+        # Attribute names of the columns of every model
+        self.keys = {model: [attr.key for attr in inspect(model).column_attrs] for model in CACHED_MODELS}
+        self.ids = {model: {} for model in CACHED_MODELS}
+        self.rows = {model: {} for model in CACHED_MODELS}
+        # (owner model, owner id) -> written association rows as (table, row), and (table, target id) -> ids of the
+        # owners linked to it through the table, with repetitions
+        self.linked_rows = {}
+        self.referrers = {}
+
+    def load(self, session, links=False):
+        """Preloads every cached table with one query each, and the association tables if links is set"""
+        for model in CACHED_MODELS:
+            for db_object in session.query(model):
+                self.add(model, {key: getattr(db_object, key) for key in self.keys[model]})
+        if links:
+            for table in LINK_TABLES:
+                for row in session.execute(table.select()):
+                    self.add_link(table, tuple(row))
+
+    def add(self, model, row):
+        """Keeps the cache current with a row that has been written. Rows are dicts keyed by attribute name"""
+        previous = self.rows[model].get(row['id'])
+        if previous is not None and self.ids[model].get(previous.get('name')) == row['id']:
+            del self.ids[model][previous['name']]
+        self.rows[model][row['id']] = row
+        if row.get('name') is not None:
+            self.ids[model].setdefault(row['name'], row['id'])
+
+    def add_link(self, table, row):
+        """Keeps the cache current with an association row that has been written"""
+        owner, owner_column, target, target_column = LINK_TABLES[table]
+        self.linked_rows.setdefault((owner, row[owner_column]), []).append((table, row))
+        self.referrers.setdefault((table, row[target_column]), []).append(row[owner_column])
+
+    def remove_links(self, model, entity_id):
+        """Forgets the association rows of an item, and returns them"""
+        removed = self.linked_rows.pop((model, entity_id), [])
+        for table, row in removed:
+            self.referrers[(table, row[LINK_TABLES[table][3]])].remove(entity_id)
+        return removed
+
+    def linked(self, model, entity_id, table=None):
+        """Association rows written for an item, optionally only the ones of a table"""
+        return [row for row_table, row in self.linked_rows.get((model, entity_id), [])
+                if table is None or row_table is table]
+
+    def referring(self, table, entity_id):
+        """Ids of the items linked to a row through an association table, once per association row"""
+        return self.referrers.get((table, entity_id), [])
+
+    def has(self, model, entity_id):
+        return entity_id in self.rows[model]
+
+    def get(self, model, entity_id):
+        return self.rows[model].get(entity_id)
+
+    def id_of(self, model, name):
+        return self.ids[model].get(name)
+
+    def links(self, model, item):
+        """Association rows of an item as (table, row, model, id) tuples, where the row can only be written once the
+        row of that model and id is (model is None for the dimension tables, which are always written)"""
+        links = []
+        if model is Mission:
+            links.extend((operators_table, (agency_id, item['id']), Agency, agency_id)
+                         for agency_id in item['agencies'])
+        elif model is Instrument:
+            instrument_id = item['id']
+            links.extend((designers_table, (agency_id, instrument_id), Agency, agency_id)
+                         for agency_id in item['agencies'])
+            links.extend((instruments_in_mission_table, (mission_id, instrument_id), Mission, mission_id)
+                         for mission_id in item['missions'])
+            links.extend((measurements_of_instrument_table, (instrument_id, measurement_id), Measurement,
+                          measurement_id) for measurement_id in item['measurements'])
+            for table, dimension, names in ((type_of_instrument_table, InstrumentType, item['types']),
+                                            (geometry_of_instrument_table, GeometryType, item['geometries']),
+                                            (instrument_wavebands_table, Waveband, item['wavebands'])):
+                for name in names:
+                    dimension_id = self.id_of(dimension, name)
+                    if dimension_id is None:
+                        logger.warning('Unknown %s "%s" of instrument %s', dimension.__name__, name, instrument_id)
+                        continue
+                    links.append((table, (instrument_id, dimension_id), None, None))
+        # An item can list the same mission, measurement, etc. more than once, but the association rows are unique
+        unique = []
+        seen = set()
+        for link in links:
+            if (link[0], link[1]) not in seen:
+                seen.add((link[0], link[1]))
+                unique.append(link)
+        return unique
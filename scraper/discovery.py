@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+# Adaptive discovery of the live ID range of the CEOS summary pages
+#
+# The CEOS database does not publish the upper bound of its agency, mission and instrument IDs, so the spider used to
+# brute force fixed ranges. An IdProber instead walks the ID space linearly while hits keep coming, stops after a
+# configurable run of consecutive misses and then gallops ahead (frontier + window * 2^k) to find IDs past a gap.
+
+
+class IdProber(object):
+    """Discovers the live ID range of one entity type by linear extension plus galloping probes"""
+
+    def __init__(self, kind, make_request, start=0, initial_window=100, max_misses=50, gallop_steps=4):
+        """
+        :param kind: entity type name, only used for reporting
+        :param make_request: callable taking an ID and returning the scrapy.Request for it
+        :param start: first ID of the space
+        :param initial_window: number of IDs requested up front
+        :param max_misses: run of consecutive misses after the highest hit that ends the linear walk
+        :param gallop_steps: number of exponentially spaced probes sent past the frontier in each gallop round
+        """
+        self.kind = kind
+        self.make_request = make_request
+        self.start = start
+        self.initial_window = initial_window
+        self.max_misses = max_misses
+        self.gallop_steps = gallop_steps
+
+        self.next_id = start
+        self.highest_hit = start - 1
+        self.requested = set()
+        self.pending = set()
+        self.gallop_pending = set()
+        self.gallop_from = None
+        self.hits = 0
+        self.misses = 0
+
+    def start_requests(self):
+        return self._extend_to(self.start + self.initial_window)
+
+    def record(self, entity_id, hit):
+        """Registers the outcome of a probe and returns the follow-up requests"""
+        self.pending.discard(entity_id)
+        self.gallop_pending.discard(entity_id)
+        if hit:
+            self.hits += 1
+            self.highest_hit = max(self.highest_hit, entity_id)
+        else:
+            self.misses += 1
+
+        requests = self._extend_to(self.highest_hit + self.max_misses + 1)
+        if not requests and not self.pending:
+            requests = self._gallop()
+        return requests
+
+    def _extend_to(self, stop):
+        requests = []
+        while self.next_id < stop:
+            requests.extend(self._issue(self.next_id))
+            self.next_id += 1
+        return requests
+
+    def _gallop(self):
+        # Any hit in a gallop round moves highest_hit forward and the linear walk above fills the gap, after which a new
+        # round starts from the new frontier. A round that comes back empty handed ends the discovery.
+        if self.gallop_pending or self.gallop_from == self.highest_hit:
+            return []
+        self.gallop_from = self.highest_hit
+        requests = []
+        for k in range(self.gallop_steps):
+            probe_id = self.next_id - 1 + self.max_misses * 2 ** (k + 1)
+            requests.extend(self._issue(probe_id, gallop=True))
+        return requests
+
+    def _issue(self, entity_id, gallop=False):
+        if entity_id in self.requested:
+            return []
+        self.requested.add(entity_id)
+        self.pending.add(entity_id)
+        if gallop:
+            self.gallop_pending.add(entity_id)
+        return [self.make_request(entity_id)]
+
+    def summary(self):
+        return {'kind': self.kind, 'requests': len(self.requested), 'hits': self.hits, 'misses': self.misses,
+                'highest_id': self.highest_hit}
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+# Define here your Scrapy extensions
+#
+# See documentation in:
+# http://doc.scrapy.org/en/latest/topics/extensions.html
+
+import functools
+import json
+import os
+import time
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import defer, task
+
+
+class Histogram(object):
+    """Cumulative latency histogram with fixed buckets, in seconds"""
+
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def summary(self):
+        return {'count': self.count, 'sum': self.sum, 'mean': self.sum / self.count if self.count else None,
+                'buckets': dict(zip([str(bound) for bound in self.buckets], self.counts))}
+
+
+class CrawlTelemetry(object):
+    """Crawl throughput telemetry.
+
+    Records per-callback parse latency (through TelemetrySpiderMiddleware), per-pipeline process_item latency (of the
+    pipelines decorated with timed_pipeline), items by item class and the pnlError rate of the summary pages. The
+    metrics are written every TELEMETRY_INTERVAL seconds to TELEMETRY_PROMETHEUS_PATH in the Prometheus text format,
+    and a JSON summary is written to TELEMETRY_SUMMARY_PATH when the spider closes.
+    """
+
+    def __init__(self, crawler, prometheus_path, summary_path, interval):
+        self.crawler = crawler
+        self.prometheus_path = prometheus_path
+        self.summary_path = summary_path
+        self.interval = interval
+        self.callbacks = {}
+        self.pipelines = {}
+        self.items = {}
+        self.started = None
+        self.task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('TELEMETRY_ENABLED'):
+            raise NotConfigured
+        ext = cls(crawler, crawler.settings.get('TELEMETRY_PROMETHEUS_PATH', 'telemetry/metrics.prom'),
+                  crawler.settings.get('TELEMETRY_SUMMARY_PATH', 'telemetry/summary.json'),
+                  crawler.settings.getfloat('TELEMETRY_INTERVAL', 15.0))
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(ext.item_scraped, signal=signals.item_scraped)
+        return ext
+
+    def spider_opened(self, spider):
+        self.started = time.monotonic()
+        self.task = task.LoopingCall(self.write_prometheus)
+        self.task.start(self.interval, now=False)
+
+    def spider_closed(self, spider, reason):
+        if self.task is not None and self.task.running:
+            self.task.stop()
+        self.write_prometheus()
+        self._write(self.summary_path, json.dumps(self.summary(), indent=2, sort_keys=True))
+
+    def item_scraped(self, item, response, spider):
+        name = type(item).__name__
+        self.items[name] = self.items.get(name, 0) + 1
+
+    def observe_callback(self, name, seconds):
+        self.callbacks.setdefault(name, Histogram()).observe(seconds)
+
+    def observe_pipeline(self, name, seconds):
+        self.pipelines.setdefault(name, Histogram()).observe(seconds)
+
+    @classmethod
+    def find(cls, crawler):
+        """The CrawlTelemetry extension of a crawler, or None if it is not enabled"""
+        extensions = getattr(crawler, 'extensions', None)
+        for extension in extensions.middlewares if extensions is not None else ():
+            if isinstance(extension, cls):
+                return extension
+        return None
+
+    def pnl_errors(self):
+        stats = self.crawler.stats
+        errors = {}
+        for kind in ('agency', 'mission', 'instrument'):
+            pages = stats.get_value('ceosdb/summary_pages/%s' % kind, 0)
+            missing = stats.get_value('ceosdb/pnl_errors/%s' % kind, 0)
+            errors[kind] = {'pages': pages, 'errors': missing, 'rate': float(missing) / pages if pages else None}
+        return errors
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started if self.started is not None else 0.0
+        return {'elapsed_seconds': elapsed,
+                'items': {name: {'count': count, 'per_second': count / elapsed if elapsed else None}
+                          for name, count in self.items.items()},
+                'callbacks': {name: histogram.summary() for name, histogram in self.callbacks.items()},
+                'pipelines': {name: histogram.summary() for name, histogram in self.pipelines.items()},
+                'pnl_errors': self.pnl_errors()}
+
+    def write_prometheus(self):
+        lines = []
+        for metric, label, histograms in (('ceosdb_callback_seconds', 'callback', self.callbacks),
+                                          ('ceosdb_pipeline_seconds', 'pipeline', self.pipelines)):
+            lines.append('# TYPE %s histogram' % metric)
+            for name, histogram in sorted(histograms.items()):
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append('%s_bucket{%s="%s",le="%s"} %d' % (metric, label, name, bound, count))
+                lines.append('%s_bucket{%s="%s",le="+Inf"} %d' % (metric, label, name, histogram.count))
+                lines.append('%s_sum{%s="%s"} %f' % (metric, label, name, histogram.sum))
+                lines.append('%s_count{%s="%s"} %d' % (metric, label, name, histogram.count))
+        lines.append('# TYPE ceosdb_items_total counter')
+        for name, count in sorted(self.items.items()):
+            lines.append('ceosdb_items_total{item="%s"} %d' % (name, count))
+        pnl_errors = sorted(self.pnl_errors().items())
+        for metric, key in (('ceosdb_summary_pages_total', 'pages'), ('ceosdb_pnl_errors_total', 'errors')):
+            lines.append('# TYPE %s counter' % metric)
+            for kind, errors in pnl_errors:
+                lines.append('%s{kind="%s"} %d' % (metric, kind, errors[key]))
+        self._write(self.prometheus_path, '\n'.join(lines) + '\n')
+
+    def _write(self, path, content):
+        # Written to a temporary file first so that scrapers never read a partial file
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w') as output:
+            output.write(content)
+        os.replace(path + '.tmp', path)
+
+
+def timed_pipeline(process_item):
+    """Decorator of the process_item method of an item pipeline that times it for CrawlTelemetry, including the
+    process_item methods that return a Deferred, which are timed until it fires"""
+
+    @functools.wraps(process_item)
+    def timed_process_item(pipeline, item, spider):
+        telemetry = CrawlTelemetry.find(getattr(spider, 'crawler', None))
+        if telemetry is None:
+            return process_item(pipeline, item, spider)
+        name = type(pipeline).__name__
+        start = time.monotonic()
+        result = process_item(pipeline, item, spider)
+        if isinstance(result, defer.Deferred):
+            def observe(result):
+                telemetry.observe_pipeline(name, time.monotonic() - start)
+                return result
+            return result.addBoth(observe)
+        telemetry.observe_pipeline(name, time.monotonic() - start)
+        return result
+    return timed_process_item
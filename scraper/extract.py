@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+
+# Field extraction for the mission and instrument summary pages
+#
+# Every Mission/Instrument field comes from a MainContent_lbl* label (or, for a few tables, from a fixed position in
+# the MainContent_pnlNominal panel). The labels are described once as FieldSpecs, and a page is extracted by a single
+# walk over the panel that picks up every label, instead of one full-document XPath scan per field.
+
+import collections
+import datetime
+
+from lxml import etree
+from parsel import Selector
+
+from scraper import dates
+
+# Base for the date parts missing from a date (e.g. the day of "Mar 2005")
+RELATIVE_BASE = datetime.datetime(2020, 1, 1)
+
+# label: ID of the label element
+# select: function turning the label element (None if the page does not have it) into a raw value
+# process: function turning the raw value into a dict of item fields
+FieldSpec = collections.namedtuple('FieldSpec', ['label', 'select', 'process'])
+
+# Same, for the values at a fixed position in the panel; path is relative to it
+PositionalSpec = collections.namedtuple('PositionalSpec', ['path', 'process'])
+
+_element_by_id = etree.XPath('//*[@id=$id]')
+
+
+# Selectors, these mirror what label/text(), label/a/@href, ... return
+def _text_nodes(element):
+    if element is None:
+        return []
+    nodes = [element.text] + [child.tail for child in element]
+    return [node for node in nodes if node is not None]
+
+
+def first_text(element):
+    nodes = _text_nodes(element)
+    return nodes[0] if nodes else None
+
+
+def all_text(element):
+    return _text_nodes(element)
+
+
+def child_hrefs(element):
+    if element is None:
+        return []
+    return [child.get('href') for child in element if child.tag == 'a' and child.get('href') is not None]
+
+
+def first_child_text(tag):
+    def select(element):
+        if element is None:
+            return None
+        for child in element:
+            if child.tag == tag:
+                nodes = _text_nodes(child)
+                if nodes:
+                    return nodes[0]
+        return None
+    return select
+
+
+# Processors
+def _strip(value):
+    return (value or '').strip()
+
+
+def _or_none(field):
+    return lambda value: {field: _strip(value) or None}
+
+
+def _stripped(field):
+    return lambda value: {field: _strip(value)}
+
+
+def _short_name(field):
+    return lambda value: {field: _strip(value)[2:]}
+
+
+def _date(field):
+    return lambda value: {field: dates.parse_date(value.strip(), RELATIVE_BASE) if value else None}
+
+
+def _unique_ids(links):
+    ids = []
+    for link in links:
+        link_id = int(link.strip().split('=', 1)[-1])
+        if link_id not in ids:
+            ids.append(link_id)
+    return ids
+
+
+def _bracketed(field):
+    # The best resolution and max swath are given as "(Best resolution: 10 m)" inside the summary
+    def process(value):
+        value = _strip(value)
+        return {field: value[1:-1].split(':', 1)[-1].strip() if value else None}
+    return process
+
+
+def orbit_inclination(value):
+    orbit_inclination = _strip(value)
+    if orbit_inclination == '':
+        return {'orbit_inclination': None, 'orbit_inclination_num': None, 'orbit_inclination_class': None}
+    orbit_inclination_num = float(orbit_inclination[:-4])
+    if orbit_inclination_num == 0.0:
+        orbit_inclination_class = 'Equatorial'
+    elif orbit_inclination_num < 30.0:
+        orbit_inclination_class = 'Near Equatorial'
+    elif orbit_inclination_num < 60.0:
+        orbit_inclination_class = 'Mid Latitude'
+    elif orbit_inclination_num == 90.0:
+        orbit_inclination_class = 'Polar'
+    else:
+        orbit_inclination_class = 'Near Polar'
+    return {'orbit_inclination': orbit_inclination, 'orbit_inclination_num': orbit_inclination_num,
+            'orbit_inclination_class': orbit_inclination_class}
+
+
+def orbit_altitude(value):
+    orbit_altitude = _strip(value)
+    if orbit_altitude == '':
+        return {'orbit_altitude': None, 'orbit_altitude_num': None, 'orbit_altitude_class': None}
+    orbit_altitude_num = int(orbit_altitude[:-3])
+    if orbit_altitude_num < 400:
+        orbit_altitude_class = 'VL'
+    elif orbit_altitude_num < 550:
+        orbit_altitude_class = 'L'
+    elif orbit_altitude_num < 700:
+        orbit_altitude_class = 'M'
+    elif orbit_altitude_num < 850:
+        orbit_altitude_class = 'H'
+    else:
+        orbit_altitude_class = 'VH'
+    return {'orbit_altitude': orbit_altitude, 'orbit_altitude_num': orbit_altitude_num,
+            'orbit_altitude_class': orbit_altitude_class}
+
+
+def orbit_lst(value):
+    orbit_LST = _strip(value)
+    if orbit_LST == '':
+        return {'orbit_LST': None, 'orbit_LST_time': None, 'orbit_LST_class': None}
+    orbit_LST_time = dates.parse_time(orbit_LST)
+    if orbit_LST_time is None:
+        return {'orbit_LST': orbit_LST, 'orbit_LST_time': None, 'orbit_LST_class': None}
+
+    five_am = datetime.time(5)
+    seven_am = datetime.time(7)
+    five_pm = datetime.time(17)
+    seven_pm = datetime.time(19)
+    noon_am = datetime.time(11, 15)
+    noon_pm = datetime.time(12, 45)
+    time_for_class = orbit_LST_time
+    if time_for_class < five_am:
+        time_for_class = (datetime.datetime.combine(datetime.date.today(), time_for_class) +
+                          datetime.timedelta(hours=12)).time()
+    elif time_for_class > seven_pm:
+        time_for_class = (datetime.datetime.combine(datetime.date.today(), time_for_class) -
+                          datetime.timedelta(hours=12)).time()
+
+    orbit_LST_class = None
+    if time_for_class > five_am and time_for_class < seven_am:
+        orbit_LST_class = 'DD'
+    elif time_for_class > five_pm and time_for_class < seven_pm:
+        orbit_LST_class = 'DD'
+    elif time_for_class > noon_am and time_for_class < noon_pm:
+        orbit_LST_class = 'Noon'
+    elif time_for_class > seven_am and time_for_class < noon_am:
+        orbit_LST_class = 'AM'
+    elif time_for_class > noon_pm and time_for_class < five_pm:
+        orbit_LST_class = 'PM'
+    return {'orbit_LST': orbit_LST, 'orbit_LST_time': orbit_LST_time, 'orbit_LST_class': orbit_LST_class}
+
+
+def repeat_cycle(value):
+    repeat_cycle = _strip(value)
+    if repeat_cycle == '':
+        return {'repeat_cycle': None, 'repeat_cycle_num': None, 'repeat_cycle_class': None}
+    repeat_cycle_num = float(repeat_cycle[:-5])
+    repeat_cycle_class = 'Short' if repeat_cycle_num <= 7 else 'Long'
+    return {'repeat_cycle': repeat_cycle, 'repeat_cycle_num': repeat_cycle_num,
+            'repeat_cycle_class': repeat_cycle_class}
+
+
+def _norad_id(value):
+    return {'norad_id': int(value) if value is not None else None}
+
+
+def _measurement_links(links):
+    # GCOS links in the measurement table point outside the CEOS database
+    measurements = []
+    names = {}
+    for link in links:
+        href = link.get('href')
+        if href is None or 'gcos.wmo.int' in href:
+            continue
+        m_id = int(href.strip().split('=', 1)[-1])
+        measurements.append(m_id)
+        names.setdefault(m_id, _strip(first_text(link)))
+    return {'measurements': measurements, 'accuracies': ['50km h-code'] * len(measurements),
+            'measurement_names': names}
+
+
+def _wavebands(texts):
+    wavebands = []
+    for waveband in texts:
+        w_name = waveband.split('(', 1)[0].strip()
+        if w_name != '':
+            wavebands.append(w_name)
+    return {'wavebands': wavebands}
+
+
+MISSION_FIELDS = (
+    FieldSpec('MainContent_lblMissionNameShort', first_text, _short_name('name')),
+    FieldSpec('MainContent_lblMissionNameFull', first_text, _or_none('full_name')),
+    FieldSpec('MainContent_lblMissionAgencies', child_hrefs, lambda links: {'agencies': _unique_ids(links)}),
+    FieldSpec('MainContent_lblMissionStatus', first_text, _stripped('status')),
+    FieldSpec('MainContent_lblLaunchDate', first_text, _date('launch_date')),
+    FieldSpec('MainContent_lblEOLDate', first_text, _date('eol_date')),
+    FieldSpec('MainContent_lblNoradNumberLink', first_child_text('a'), _norad_id),
+    FieldSpec('MainContent_lblMissionObjectivesAndApplications', first_text, _stripped('applications')),
+    FieldSpec('MainContent_lblOrbitType', first_text, _stripped('orbit_type')),
+    FieldSpec('MainContent_lblOrbitPeriod', first_text, _stripped('orbit_period')),
+    FieldSpec('MainContent_lblOrbitSense', first_text, _stripped('orbit_sense')),
+    FieldSpec('MainContent_lblOrbitInclination', first_text, orbit_inclination),
+    FieldSpec('MainContent_lblOrbitAltitude', first_text, orbit_altitude),
+    FieldSpec('MainContent_lblOrbitLongitude', first_text, _stripped('orbit_longitude')),
+    FieldSpec('MainContent_lblOrbitLST', first_text, orbit_lst),
+    FieldSpec('MainContent_lblRepeatCycle', first_text, repeat_cycle),
+)
+
+INSTRUMENT_FIELDS = (
+    FieldSpec('MainContent_lblInstrumentNameShort', first_text, _short_name('name')),
+    FieldSpec('MainContent_lblInstrumentNameFull', first_text, lambda value: {'full_name': value or None}),
+    FieldSpec('MainContent_lblInstrumentStatus', first_text, _stripped('status')),
+    # The last link of the agencies label is not an agency
+    FieldSpec('MainContent_lblInstrumentAgencies', child_hrefs, lambda links: {'agencies': _unique_ids(links[:-1])}),
+    FieldSpec('MainContent_lblInstrumentMaturity', first_text, _stripped('maturity')),
+    FieldSpec('MainContent_lblInstrumentType', all_text,
+              lambda texts: {'types_text': ' '.join(text.strip() for text in texts).strip()}),
+    FieldSpec('MainContent_lblInstrumentGeometry', first_text, lambda value: {'geometry_text': _strip(value)}),
+    FieldSpec('MainContent_lblInstrumentTechnology', first_text, _or_none('technology')),
+    FieldSpec('MainContent_lblInstrumentSampling', first_text, _or_none('sampling')),
+    FieldSpec('MainContent_lblDataAccess', first_text, _or_none('data_access')),
+    FieldSpec('MainContent_lblDataFormat', first_text, _or_none('data_format')),
+    FieldSpec('MainContent_lblInstrumentMeasurementsApplications', first_text,
+              _stripped('measurements_and_applications')),
+    FieldSpec('MainContent_lblInstrumentResolutionSummary', first_text, _or_none('resolution_summary')),
+    FieldSpec('MainContent_lblInstrumentResolutionSummary', first_child_text('i'), _bracketed('best_resolution')),
+    FieldSpec('MainContent_lblInstrumentSwathSummary', first_text, _or_none('swath_summary')),
+    FieldSpec('MainContent_lblInstrumentSwathSummary', first_child_text('i'), _bracketed('max_swath')),
+    FieldSpec('MainContent_lblInstrumentAccuracySummary', first_text, _or_none('accuracy_summary')),
+    FieldSpec('MainContent_lblInstrumentWavebandSummary', first_text, _or_none('waveband_summary')),
+)
+
+INSTRUMENT_POSITIONAL_FIELDS = (
+    PositionalSpec(etree.XPath('tr[1]/td/table/tr[18]/td[2]/table/tr/td/a/@href'),
+                   lambda links: {'missions': _unique_ids(links)}),
+    PositionalSpec(etree.XPath('tr[1]/td/table/tr[16]/td[2]/table/tr/td[2]/a'), _measurement_links),
+    PositionalSpec(etree.XPath('tr[1]/td/table/tr[14]/td[2]/i/table/tr/td/text()'), _wavebands),
+)
+
+
+def _collect_labels(element, wanted, labels):
+    # First element with each wanted id, in document order
+    for child in element.iter(etree.Element):
+        child_id = child.get('id')
+        if child_id in wanted:
+            labels.setdefault(child_id, child)
+
+
+def extract_fields(root, fields, positional_fields=()):
+    """Fills a dict of item fields from the labels and positional specs in one walk over the nominal panel"""
+    panels = _element_by_id(root, id='MainContent_pnlNominal')
+    panel = panels[0] if panels else None
+
+    wanted = set(spec.label for spec in fields)
+    labels = {}
+    _collect_labels(panel if panel is not None else root, wanted, labels)
+    if panel is not None and wanted - set(labels):
+        # Labels outside of the panel are picked up in a single walk over the whole page
+        _collect_labels(root, wanted - set(labels), labels)
+
+    values = {}
+    for spec in fields:
+        values.update(spec.process(spec.select(labels.get(spec.label))))
+    for spec in positional_fields:
+        values.update(spec.process(spec.path(panel) if panel is not None else []))
+    return values
+
+
+def extract_mission(root, url):
+    """Returns the Mission fields of a mission summary page"""
+    values = extract_fields(root, MISSION_FIELDS)
+    values['id'] = int(url.split('=', 1)[-1])
+    return values
+
+
+def extract_instrument(root, url, instrument_types, instrument_geometries):
+    """Returns the Instrument fields of an instrument summary page, plus the names of its measurements"""
+    values = extract_fields(root, INSTRUMENT_FIELDS, INSTRUMENT_POSITIONAL_FIELDS)
+    values['id'] = int(url.split('=', 1)[-1])
+    types_text = values.pop('types_text')
+    values['types'] = [type_template for type_template in instrument_types if type_template in types_text]
+    geometry_text = values.pop('geometry_text')
+    values['geometries'] = [geometry_template for geometry_template in instrument_geometries
+                            if geometry_template in geometry_text]
+    return values
+
+
+def extract_page(extractor, text, url, *args):
+    """Parses a page and runs one of the extract_* functions on it; used by the spider's worker processes. Returns the
+    fields and the date parsing counters of the worker for the page"""
+    before = dates.counters()
+    values = extractor(Selector(text=text).root, url, *args)
+    after = dates.counters()
+    return values, {key: after[key] - before[key] for key in after}
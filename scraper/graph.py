@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+# Batched and concurrent writes for GraphPipeline
+#
+# Items are accumulated as node rows per label and relationship rows per relationship type, and every batch is written
+# in one transaction with a single UNWIND statement per label and relationship type, instead of one statement per node
+# and per relationship. The nodes of a batch are written before its relationships.
+#
+# The transactions can also run on a pool of worker threads, each with its own long-lived session. Writes are
+# partitioned by node id, so the writes of a node always run in order on the same worker, and transactions that fail
+# with a transient error (such as a deadlock between two workers locking the same nodes) are retried with exponential
+# backoff.
+#
+# Large deletions run in transactions of a bounded number of nodes, so they never hit the transaction memory limit.
+#
+# The relationships can also be held back until the spider closes and every node has been written, since a relationship
+# whose start or end node is not in the graph yet is dropped by the MATCH of its statement.
+
+import logging
+import random
+import time
+
+from neo4j.exceptions import ServiceUnavailable, SessionExpired, TransientError
+from twisted.internet import defer
+
+import scraper.cypher_tx as cypher_tx
+from scraper.writer import WriterThread
+
+logger = logging.getLogger(__name__)
+
+
+class GraphWorker(WriterThread):
+    """Writer thread that runs transaction functions on its own session"""
+
+    def __init__(self, driver, semaphore, name, retries=5, backoff=0.5):
+        self.driver = driver
+        self.retries = retries
+        self.backoff = backoff
+        self.session = None
+        WriterThread.__init__(self, semaphore=semaphore, name=name)
+
+    def run(self):
+        self.session = self.driver.session()
+        try:
+            WriterThread.run(self)
+        finally:
+            self.session.close()
+
+    def call(self, function, args):
+        # The transactions are retried here rather than with write_transaction, which already retries for up to
+        # max_transaction_retry_time on its own
+        attempt = 0
+        while True:
+            try:
+                return self.transaction(function, args)
+            except (TransientError, ServiceUnavailable, SessionExpired) as error:
+                if attempt >= self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt * (1 + random.random())
+                logger.warning('Retrying a graph transaction in %.1fs after %r', delay, error)
+                time.sleep(delay)
+                attempt += 1
+                if not isinstance(error, TransientError):
+                    # The connection is gone, so the session is opened again
+                    self.session.close()
+                    self.session = self.driver.session()
+
+    def transaction(self, function, args):
+        tx = self.session.begin_transaction()
+        try:
+            result = function(tx, *args)
+            tx.commit()
+            return result
+        finally:
+            # Rolls back the transaction if it was not committed
+            tx.close()
+
+
+class GraphWriterPool(object):
+    """Runs graph transactions on a pool of workers, the transactions with the same key in order on the same worker.
+    At most queue_size transactions are queued or running at a time"""
+
+    def __init__(self, driver, workers=4, queue_size=1000, retries=5, backoff=0.5):
+        semaphore = defer.DeferredSemaphore(queue_size)
+        self.workers = [GraphWorker(driver, semaphore, 'GraphWriter-%d' % index, retries, backoff)
+                        for index in range(workers)]
+        self.pending = set()
+
+    def submit(self, key, function, *args):
+        """Queues a transaction function on the worker of the key. Returns a Deferred that fires once it is queued and
+        a Deferred that fires with its result"""
+        queued, done = self.workers[hash(key) % len(self.workers)].submit(function, *args)
+        self.pending.add(done)
+
+        def finished(result):
+            self.pending.discard(done)
+            return result
+        done.addBoth(finished)
+        return queued, done
+
+    def drain(self):
+        """Returns a Deferred that fires once the transactions submitted so far have run"""
+        return defer.DeferredList(list(self.pending), consumeErrors=True)
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+
+def delete_in_batches(driver, batch_size, keep=None):
+    """Deletes the graph, or the nodes outside of the generations to keep, in transactions of up to batch_size nodes
+    (or in one transaction if 0). Returns the number of nodes deleted"""
+    total = 0
+    labels = [None] if keep is None else [label for label, _ in cypher_tx.NODES.values()]
+    with driver.session() as session:
+        for label in labels:
+            while True:
+                deleted = session.write_transaction(cypher_tx.delete_graph_batch, batch_size, label, keep)
+                total += deleted
+                if not batch_size or deleted < batch_size:
+                    break
+    logger.info('Deleted %d nodes from the graph', total)
+    return total
+
+
+def partition(rows, key, count):
+    """Splits rows into count lists by the hash of their key"""
+    parts = [[] for _ in range(count)]
+    for row in rows:
+        parts[hash(row[key]) % count].append(row)
+    return parts
+
+
+def chunks(rows, size):
+    return [rows[start:start + size] for start in range(0, len(rows), size)]
+
+
+class RelationshipBuffer(object):
+    """Holds relationship rows back until every node has been written, then writes them in transactions of up to
+    batch_size rows"""
+
+    def __init__(self, driver, batch_size=1000, pool=None, generation=None, reverse=True):
+        self.driver = driver
+        self.batch_size = batch_size
+        self.pool = pool
+        self.generation = generation
+        self.reverse = reverse
+        self.rows = {relationship: [] for relationship in cypher_tx.RELATIONSHIPS}
+
+    def add(self, relationships):
+        for relationship, row in relationships:
+            self.rows[relationship].append(row)
+
+    def write(self):
+        """Writes the buffered relationships. Returns the number of rows of every relationship whose start or end node
+        was missing, or a Deferred that fires with it if they are written on the pool"""
+        rows = self.rows
+        self.rows = {relationship: [] for relationship in rows}
+        if self.pool is None:
+            dangling = {}
+            with self.driver.session() as session:
+                for relationship, relationship_rows in rows.items():
+                    for chunk in chunks(relationship_rows, self.batch_size):
+                        matched = session.write_transaction(cypher_tx.add_relationships, relationship, chunk,
+                                                            self.generation, self.reverse)
+                        dangling[relationship] = dangling.get(relationship, 0) + len(chunk) - matched
+            return dangling
+        return self.write_pool(rows)
+
+    def write_pool(self, rows):
+        count = len(self.pool.workers)
+        writes = []
+        for relationship, relationship_rows in rows.items():
+            for index, part in enumerate(partition(relationship_rows, 'id1', count)):
+                for chunk in chunks(part, self.batch_size):
+                    _, done = self.pool.submit(index, cypher_tx.add_relationships, relationship, chunk,
+                                               self.generation, self.reverse)
+                    writes.append((relationship, len(chunk), done))
+
+        def written(results):
+            dangling = {}
+            for (relationship, sent, _), (_, matched) in zip(writes, results):
+                dangling[relationship] = dangling.get(relationship, 0) + sent - matched
+            return dangling
+        return defer.DeferredList([done for _, _, done in writes], fireOnOneErrback=True,
+                                  consumeErrors=True).addCallback(written)
+
+
+class GraphBatchWriter(object):
+    """Accumulates node and relationship rows and writes them with UNWIND statements when a batch is full"""
+
+    def __init__(self, driver, batch_size=1000, replace=False, pool=None, generation=None, relationship_buffer=None,
+                 reverse=True):
+        self.driver = driver
+        self.batch_size = batch_size
+        # Replace the relationships of nodes that were already in the graph
+        self.replace = replace
+        self.pool = pool
+        # Generation the nodes are written to, if any
+        self.generation = generation
+        # Buffer the relationships are held back in until the spider closes, if any
+        self.relationship_buffer = relationship_buffer
+        # Write the reverse relationships too
+        self.reverse = reverse
+        self.nodes = {label: [] for label, _ in cypher_tx.NODES.values()}
+        self.relationships = {relationship: [] for relationship in cypher_tx.RELATIONSHIPS}
+        self.buffered = 0
+
+    def add(self, item):
+        """Buffers the node and relationships of an item, flushing if the batch is full. Returns the Deferred of the
+        flush if it runs on the pool"""
+        rows = cypher_tx.item_rows(item)
+        if rows is None:
+            return None
+        label, node, relationships = rows
+        self.nodes[label].append(node)
+        if self.relationship_buffer is not None:
+            self.relationship_buffer.add(relationships)
+        else:
+            for relationship, row in relationships:
+                self.relationships[relationship].append(row)
+        self.buffered += 1
+        if self.buffered >= self.batch_size:
+            return self.flush()
+        return None
+
+    def flush(self):
+        """Writes the buffered nodes and relationships in one transaction, or on the pool in one transaction per worker
+        for the nodes and then one per worker for the relationships"""
+        if not self.buffered:
+            return None
+        nodes, relationships, buffered = self.nodes, self.relationships, self.buffered
+        self.nodes = {label: [] for label in nodes}
+        self.relationships = {relationship: [] for relationship in relationships}
+        self.buffered = 0
+        if self.pool is None:
+            with self.driver.session() as session:
+                session.write_transaction(cypher_tx.add_batch, nodes, relationships, self.replace, self.generation,
+                                          self.reverse)
+            logger.debug('Flushed %d items to the graph', buffered)
+            return None
+        return self.flush_pool(nodes, relationships, buffered)
+
+    def flush_pool(self, nodes, relationships, buffered):
+        count = len(self.pool.workers)
+        node_parts = [{} for _ in range(count)]
+        for label, rows in nodes.items():
+            for index, part in enumerate(partition(rows, 'id', count)):
+                if part:
+                    node_parts[index][label] = part
+        relationship_parts = [{} for _ in range(count)]
+        for relationship, rows in relationships.items():
+            for index, part in enumerate(partition(rows, 'id1', count)):
+                if part:
+                    relationship_parts[index][relationship] = part
+
+        def write(parts, function):
+            return defer.DeferredList([self.pool.submit(index, function, part)[1] for index, part in enumerate(parts)
+                                       if part], fireOnOneErrback=True, consumeErrors=True)
+
+        def flushed(_):
+            logger.debug('Flushed %d items to the graph', buffered)
+        # Every node has to be written before the relationships are matched, whichever worker writes it
+        written = write(node_parts, lambda tx, part: cypher_tx.add_batch(tx, part, {}, self.replace, self.generation))
+        written.addCallback(lambda _: write(relationship_parts,
+                                            lambda tx, part: cypher_tx.add_batch(tx, {}, part, False, self.generation,
+                                                                                 self.reverse)))
+        return written.addCallback(flushed)
+
+    def close(self):
+        return self.flush()
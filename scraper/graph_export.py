@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+# CSV export of the graph for neo4j-admin import
+#
+# The nodes and relationships that GraphPipeline writes through Bolt are streamed instead to one CSV file per label and
+# one per relationship type and direction, in the format of neo4j-admin import, so a graph store can be built offline
+# from them. Every label has its own ID space, named after it, and the ids are stored as integers like the ones written
+# through Bolt. The exporter logs the full command, which looks like
+#   neo4j-admin import --database=neo4j --id-type=INTEGER --array-delimiter=";" --multiline-fields=true
+#       --skip-bad-relationships=true --skip-duplicate-nodes=true --nodes=Sensor=neo4j-import/Sensor.csv ...
+#       --relationships=neo4j-import/Sensor_OBSERVES_ObservableProperty.csv ...
+# This is the neo4j-admin syntax of Neo4j 4.x, the version of the pinned neo4j driver. Neo4j 5 moved the command to
+# `neo4j-admin database import full`, which takes the database name as an argument instead of --database.
+# Relationships to nodes that were never scraped are skipped, as the MATCH of the Bolt statements skips them. The
+# Bolt statements MERGE the relationships, so a relationship that is found more than once (e.g. a measurement listed
+# twice for an instrument) is exported once, with the properties of its last occurrence.
+
+import datetime
+import logging
+import os
+
+import scraper.cypher_tx as cypher_tx
+
+logger = logging.getLogger(__name__)
+
+ARRAY_DELIMITER = ';'
+
+# Property -> neo4j-admin type of the properties that are not strings
+PROPERTY_TYPES = {'launch_date': 'localdatetime',
+                  'eol_date': 'localdatetime',
+                  'norad_id': 'long',
+                  'orbit_inclination_num': 'double',
+                  'orbit_altitude_num': 'long',
+                  'orbit_LST_time': 'localtime',
+                  'repeat_cycle_num': 'double',
+                  'types': 'string[]',
+                  'geometries': 'string[]',
+                  'wavebands': 'string[]'}
+
+
+def property_header(prop):
+    return '%s:%s' % (prop, PROPERTY_TYPES[prop]) if prop in PROPERTY_TYPES else prop
+
+
+def node_header(label, properties):
+    return ['id:ID(%s)' % label] + [property_header(prop) for prop in properties if prop != 'id']
+
+
+def relationship_header(start, end, properties):
+    return [':START_ID(%s)' % start, ':END_ID(%s)' % end] + [property_header(prop) for prop in properties] + [':TYPE']
+
+
+def csv_text(value):
+    if isinstance(value, (list, tuple)):
+        return ARRAY_DELIMITER.join(csv_text(element) for element in value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value)
+
+
+def csv_field(value):
+    """CSV field of a property. neo4j-admin skips unquoted empty fields and imports quoted ones as empty strings, so
+    missing properties are left empty and every other value but numbers is quoted"""
+    if value is None:
+        return ''
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return repr(value)
+    return '"%s"' % csv_text(value).replace('"', '""')
+
+
+class GraphCsvExporter(object):
+    """Writes the nodes and relationships of items to neo4j-admin import CSV files as they arrive"""
+
+    def __init__(self, directory, reverse=True):
+        self.directory = directory
+        # Export the reverse relationships too
+        self.reverse = reverse
+        self.files = {}
+        self.counts = {}
+        # File name -> (start id, end id) -> row of the relationships, written when the exporter is closed
+        self.relationships = {}
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        for label, properties in cypher_tx.NODES.values():
+            self.open_file(label, node_header(label, properties))
+        for relationship in cypher_tx.RELATIONSHIPS:
+            self.open_file(self.file_name(relationship),
+                           relationship_header(relationship.start, relationship.end, relationship.properties))
+            self.relationships[self.file_name(relationship)] = {}
+            if self.reverse and relationship.reverse is not None:
+                self.open_file(self.file_name(relationship, reverse=True),
+                               relationship_header(relationship.end, relationship.start, relationship.properties))
+                self.relationships[self.file_name(relationship, reverse=True)] = {}
+
+    def open_file(self, name, header):
+        self.files[name] = open(self.path(name), 'w', newline='', encoding='utf-8')
+        self.files[name].write(','.join(header) + '\n')
+        self.counts[name] = 0
+
+    @staticmethod
+    def file_name(relationship, reverse=False):
+        if reverse:
+            return '%s_%s_%s' % (relationship.end, relationship.reverse, relationship.start)
+        return '%s_%s_%s' % (relationship.start, relationship.type, relationship.end)
+
+    def write(self, name, row):
+        self.files[name].write(','.join(csv_field(value) for value in row) + '\n')
+        self.counts[name] += 1
+
+    def add(self, item):
+        rows = cypher_tx.item_rows(item)
+        if rows is None:
+            return
+        label, node, relationships = rows
+        properties = [node[prop] for prop in node if prop != 'id']
+        self.write(label, [node['id']] + properties)
+        for relationship, row in relationships:
+            properties = [row[prop] for prop in relationship.properties]
+            self.relationships[self.file_name(relationship)][row['id1'], row['id2']] = \
+                [row['id1'], row['id2']] + properties + [relationship.type]
+            if self.reverse and relationship.reverse is not None:
+                self.relationships[self.file_name(relationship, reverse=True)][row['id2'], row['id1']] = \
+                    [row['id2'], row['id1']] + properties + [relationship.reverse]
+
+    def import_command(self, database='neo4j'):
+        """neo4j-admin command that imports the files into a database"""
+        arguments = ['neo4j-admin', 'import', '--database=%s' % database, '--id-type=INTEGER',
+                     '--array-delimiter="%s"' % ARRAY_DELIMITER, '--multiline-fields=true',
+                     '--skip-bad-relationships=true', '--skip-duplicate-nodes=true']
+        for label, _ in cypher_tx.NODES.values():
+            arguments.append('--nodes=%s=%s' % (label, self.path(label)))
+        for relationship in cypher_tx.RELATIONSHIPS:
+            arguments.append('--relationships=%s' % self.path(self.file_name(relationship)))
+            if self.reverse and relationship.reverse is not None:
+                arguments.append('--relationships=%s' % self.path(self.file_name(relationship, reverse=True)))
+        return ' '.join(arguments)
+
+    def path(self, name):
+        return os.path.join(self.directory, name + '.csv')
+
+    def close(self):
+        for name, rows in self.relationships.items():
+            for row in rows.values():
+                self.write(name, row)
+        self.relationships = {}
+        for name, file in self.files.items():
+            file.close()
+            logger.debug('Exported %d rows to %s', self.counts[name], self.path(name))
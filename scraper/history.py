@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+# Versioned history of the missions, instruments and their association rows
+#
+# Every version of a row is kept with the time of the crawl that first saw it (valid_from) and of the crawl that saw it
+# change or disappear (valid_to, NULL for the current version). At the end of a crawl the catalog is compared with the
+# current versions through a hash of the content of every row, so only the rows that changed are written. The history
+# tables are kept out of the catalog metadata, so that replace loads never delete them and staging reloads never swap
+# them out.
+
+import hashlib
+import json
+import logging
+
+from sqlalchemy import Column, DateTime, Index, Integer, MetaData, String, Table, and_, bindparam, or_, select
+
+from scraper.models import Mission, Instrument, InstrumentType, GeometryType, Waveband
+from scraper.dimensions import LINK_TABLES
+
+logger = logging.getLogger(__name__)
+
+history_metadata = MetaData()
+
+# The dimension tables are refilled with new IDs by every replace load, so links to them are compared by name
+NAMED_TARGETS = (InstrumentType, GeometryType, Waveband)
+
+
+def history_table(model):
+    """Table with a copy of every column of the table of a model and the validity of each version"""
+    name = model.__tablename__ + '_history'
+    table = Table(name, history_metadata,
+                  Column('version_id', Integer, primary_key=True),
+                  *[Column(column.name, column.type) for column in model.__table__.columns],
+                  Column('content_hash', String(40), nullable=False),
+                  Column('valid_from', DateTime, nullable=False),
+                  Column('valid_to', DateTime))
+    Index('ix_%s_id_valid_from' % name, table.c.id, table.c.valid_from)
+    Index('ix_%s_current' % name, table.c.id, unique=True, postgresql_where=table.c.valid_to.is_(None))
+    return table
+
+
+mission_history = history_table(Mission)
+instrument_history = history_table(Instrument)
+
+link_history = Table('ceos_links_history', history_metadata,
+                     Column('version_id', Integer, primary_key=True),
+                     Column('relation', String, nullable=False),
+                     Column('owner_id', Integer, nullable=False),
+                     Column('target_id', Integer, nullable=False),
+                     Column('target_name', String),
+                     Column('valid_from', DateTime, nullable=False),
+                     Column('valid_to', DateTime))
+Index('ix_ceos_links_history_owner', link_history.c.relation, link_history.c.owner_id, link_history.c.valid_from)
+Index('ix_ceos_links_history_current', link_history.c.relation, link_history.c.valid_to)
+
+ENTITY_HISTORY = ((Mission, mission_history), (Instrument, instrument_history))
+
+
+def content_hash(table, row):
+    values = [row[column.name] for column in table.columns if column.name != 'id']
+    return hashlib.sha1(json.dumps(values, default=str).encode('utf-8')).hexdigest()
+
+
+def record_entities(connection, model, history, as_of):
+    table = model.__table__
+    current = {}
+    for row in connection.execute(table.select()):
+        row = dict(row._mapping)
+        current[row['id']] = (content_hash(table, row), row)
+    versions = dict(connection.execute(select(history.c.id, history.c.content_hash)
+                                       .where(history.c.valid_to.is_(None))).fetchall())
+    closed = [{'entity_id': entity_id} for entity_id, digest in versions.items()
+              if entity_id not in current or current[entity_id][0] != digest]
+    opened = [dict(row, content_hash=digest, valid_from=as_of) for entity_id, (digest, row) in current.items()
+              if versions.get(entity_id) != digest]
+    if closed:
+        connection.execute(history.update().where(and_(history.c.id == bindparam('entity_id'),
+                                                       history.c.valid_to.is_(None))).values(valid_to=as_of), closed)
+    if opened:
+        connection.execute(history.insert(), opened)
+    return len(closed), len(opened)
+
+
+def record_links(connection, table, as_of):
+    owner, owner_column, target, target_column = LINK_TABLES[table]
+    owner_column, target_column = list(table.columns)[owner_column], list(table.columns)[target_column]
+    target_table = target.__table__
+    by_name = target in NAMED_TARGETS
+    current = {}
+    for owner_id, target_id, target_name in connection.execute(
+            select(owner_column, target_column, target_table.c.name)
+            .select_from(table.join(target_table, target_table.c.id == target_column))):
+        current[(owner_id, target_name if by_name else target_id)] = (target_id, target_name)
+    versions = {}
+    for version_id, owner_id, target_id, target_name in connection.execute(
+            select(link_history.c.version_id, link_history.c.owner_id, link_history.c.target_id,
+                   link_history.c.target_name)
+            .where(and_(link_history.c.relation == table.name, link_history.c.valid_to.is_(None)))):
+        versions[(owner_id, target_name if by_name else target_id)] = version_id
+    closed = [{'closed_id': version_id} for key, version_id in versions.items() if key not in current]
+    opened = [{'relation': table.name, 'owner_id': key[0], 'target_id': target_id, 'target_name': target_name,
+               'valid_from': as_of} for key, (target_id, target_name) in current.items() if key not in versions]
+    if closed:
+        connection.execute(link_history.update().where(link_history.c.version_id == bindparam('closed_id'))
+                           .values(valid_to=as_of), closed)
+    if opened:
+        connection.execute(link_history.insert(), opened)
+    return len(closed), len(opened)
+
+
+def record(connection, as_of):
+    """Writes a version of every mission, instrument and association row that changed since the last recorded crawl,
+    and closes the versions of the rows that are gone"""
+    for model, history in ENTITY_HISTORY:
+        closed, opened = record_entities(connection, model, history, as_of)
+        logger.info('%s history: %d versions closed, %d written', model.__name__, closed, opened)
+    closed = opened = 0
+    for table in LINK_TABLES:
+        table_closed, table_opened = record_links(connection, table, as_of)
+        closed, opened = closed + table_closed, opened + table_opened
+    logger.info('Association history: %d versions closed, %d written', closed, opened)
+
+
+def valid_at(history, when):
+    return and_(history.c.valid_from <= when, or_(history.c.valid_to.is_(None), history.c.valid_to > when))
+
+
+def mission_as_of(session, mission_id, when):
+    """Version of a mission that was current at the given time, or None"""
+    return session.execute(select(mission_history).where(and_(mission_history.c.id == mission_id,
+                                                              valid_at(mission_history, when)))).first()
+
+
+def instrument_as_of(session, instrument_id, when):
+    """Version of an instrument that was current at the given time, or None"""
+    return session.execute(select(instrument_history).where(and_(instrument_history.c.id == instrument_id,
+                                                                 valid_at(instrument_history, when)))).first()
+
+
+def missions_as_of(session, when):
+    """Every mission listed at the given time"""
+    return session.execute(select(mission_history).where(valid_at(mission_history, when))
+                           .order_by(mission_history.c.id)).all()
+
+
+def instruments_as_of(session, when):
+    """Every instrument listed at the given time"""
+    return session.execute(select(instrument_history).where(valid_at(instrument_history, when))
+                           .order_by(instrument_history.c.id)).all()
+
+
+def links_as_of(session, table, when, owner_id=None):
+    """Rows of an association table (as owner_id, target_id, target_name) at the given time, of one owner if given"""
+    query = select(link_history.c.owner_id, link_history.c.target_id, link_history.c.target_name).where(
+        and_(link_history.c.relation == table.name, valid_at(link_history, when)))
+    if owner_id is not None:
+        query = query.where(link_history.c.owner_id == owner_id)
+    return session.execute(query.order_by(link_history.c.owner_id, link_history.c.target_id)).all()
+
+
+def versions(session, model, entity_id):
+    """Every version of a mission or instrument, oldest first"""
+    history = dict(ENTITY_HISTORY)[model]
+    return session.execute(select(history).where(history.c.id == entity_id)
+                           .order_by(history.c.valid_from)).all()
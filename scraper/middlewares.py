@@ -5,7 +5,23 @@
 # See documentation in:
 # http://doc.scrapy.org/en/latest/topics/spider-middleware.html
 
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+import zlib
+
 from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.httpobj import urlparse_cached
+from scrapy.utils.request import request_fingerprint
+
+from scraper.archive import ArchiveReader, ArchiveWriter
+from scraper.extensions import CrawlTelemetry
 
 
 class ScraperSpiderMiddleware(object):
@@ -54,3 +70,231 @@ class ScraperSpiderMiddleware(object):
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+
+
+class ConditionalCacheMiddleware(object):
+    """Persistent response cache that revalidates pages with conditional requests.
+
+    Every successful HTTP GET response is stored on disk keyed by URL, together with its ETag/Last-Modified validators
+    and a hash of its body. Later requests for the same URL are sent with If-None-Match/If-Modified-Since and a 304
+    is answered from the cache. Responses whose body hash did not change since the last crawl have 'unchanged' in
+    their flags and response.meta['unchanged'] set, so callbacks can tell them apart. The cache is committed every
+    commit_every writes, so a crawl that crashes or is killed keeps what it stored.
+    """
+
+    # ASP.NET state fields change on every request, so they are left out of the body hash
+    volatile_fields = re.compile(br'(<input[^>]+id="__(?:VIEWSTATE\w*|EVENTVALIDATION)"[^>]+value=")[^"]*(")')
+
+    def __init__(self, path, max_age, commit_every=100):
+        self.path = path
+        self.max_age = max_age
+        self.commit_every = commit_every
+        self.db = None
+        self.uncommitted = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('CONDITIONAL_CACHE_ENABLED'):
+            raise NotConfigured
+        s = cls(crawler.settings.get('CONDITIONAL_CACHE_PATH', 'conditional_cache.sqlite'),
+                crawler.settings.getint('CONDITIONAL_CACHE_MAX_AGE', 0),
+                crawler.settings.getint('CONDITIONAL_CACHE_COMMIT_EVERY', 100))
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def spider_opened(self, spider):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        # With the write-ahead log the frequent commits do not rewrite the database
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, '
+                        'digest TEXT, status INTEGER, headers TEXT, body BLOB, stored_at REAL)')
+
+    def spider_closed(self, spider):
+        self.db.commit()
+        self.db.close()
+
+    @staticmethod
+    def _cacheable(request):
+        # Only the HTTP pages are cached, not e.g. the data: requests the spider sends itself
+        return request.method == 'GET' and urlparse_cached(request).scheme in ('http', 'https')
+
+    def process_request(self, request, spider):
+        if not self._cacheable(request):
+            return None
+        entry = self._get(request.url)
+        if entry is None:
+            return None
+        if self.max_age and time.time() - entry['stored_at'] < self.max_age:
+            request.meta['unchanged'] = True
+            return self._cached_response(request, entry)
+        if entry['etag']:
+            request.headers.setdefault('If-None-Match', entry['etag'])
+        if entry['last_modified']:
+            request.headers.setdefault('If-Modified-Since', entry['last_modified'])
+        return None
+
+    def process_response(self, request, response, spider):
+        if not self._cacheable(request) or 'cached' in response.flags:
+            return response
+        if response.status == 304:
+            entry = self._get(request.url)
+            if entry is not None:
+                request.meta['unchanged'] = True
+                self.db.execute('UPDATE responses SET stored_at = ? WHERE url = ?', (time.time(), request.url))
+                self._written()
+                return self._cached_response(request, entry)
+            return response
+        if response.status != 200:
+            return response
+
+        entry = self._get(request.url)
+        digest = hashlib.sha1(self.volatile_fields.sub(br'\1\2', response.body)).hexdigest()
+        unchanged = entry is not None and entry['digest'] == digest
+        request.meta['unchanged'] = unchanged
+        self._put(request.url, response, digest)
+        if unchanged:
+            return response.replace(flags=response.flags + ['unchanged'])
+        return response
+
+    def _get(self, url):
+        row = self.db.execute('SELECT etag, last_modified, digest, status, headers, body, stored_at FROM responses '
+                              'WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        return {'etag': row[0], 'last_modified': row[1], 'digest': row[2], 'status': row[3],
+                'headers': json.loads(row[4]), 'body': zlib.decompress(row[5]), 'stored_at': row[6]}
+
+    def _put(self, url, response, digest):
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        headers = [(key.decode('latin1'), [value.decode('latin1') for value in values])
+                   for key, values in response.headers.items()]
+        self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        (url, etag.decode('latin1') if etag else None,
+                         last_modified.decode('latin1') if last_modified else None, digest, response.status,
+                         json.dumps(headers), zlib.compress(response.body), time.time()))
+        self._written()
+
+    def _written(self):
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.db.commit()
+            self.uncommitted = 0
+
+    def _cached_response(self, request, entry):
+        headers = Headers(dict(entry['headers']))
+        respcls = responsetypes.from_args(headers=headers, url=request.url, body=entry['body'])
+        return respcls(url=request.url, status=entry['status'], headers=headers, body=entry['body'],
+                       flags=['cached', 'unchanged'], request=request)
+
+
+class ArchiveMiddleware(object):
+    """Records every raw response into an append-only archive, or replays a crawl from it without any network.
+
+    ARCHIVE_MODE = 'record' writes each response (decoded body, minus its transfer headers) to ARCHIVE_DIR.
+    ARCHIVE_MODE = 'replay' answers every request from ARCHIVE_DIR, matching them by request fingerprint, and drops
+    the requests that were never recorded.
+    """
+
+    # Bodies are stored decoded, so the headers describing the wire encoding are not kept
+    dropped_headers = {b'content-encoding', b'content-length', b'transfer-encoding'}
+
+    def __init__(self, mode, directory, segment_size):
+        self.mode = mode
+        self.directory = directory
+        self.segment_size = segment_size
+        self.writer = None
+        self.reader = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        mode = crawler.settings.get('ARCHIVE_MODE')
+        if mode not in ('record', 'replay'):
+            raise NotConfigured
+        s = cls(mode, crawler.settings.get('ARCHIVE_DIR', 'archive'),
+                crawler.settings.getint('ARCHIVE_SEGMENT_SIZE', 64 * 1024 * 1024))
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def spider_opened(self, spider):
+        if self.mode == 'record':
+            self.writer = ArchiveWriter(self.directory, self.segment_size)
+        else:
+            self.reader = ArchiveReader(self.directory)
+            spider.logger.info('Replaying %d archived responses from %s', len(self.reader), self.directory)
+
+    def spider_closed(self, spider):
+        if self.writer is not None:
+            self.writer.close()
+
+    def process_request(self, request, spider):
+        if self.mode != 'replay' or request.url.startswith('data:'):
+            return None
+        archived = self.reader.get(request_fingerprint(request))
+        if archived is None:
+            raise IgnoreRequest('Not in the archive: %s' % request)
+        url, status, headers, body = archived
+        headers = Headers(headers)
+        respcls = responsetypes.from_args(headers=headers, url=url, body=body)
+        return respcls(url=url, status=status, headers=headers, body=body, flags=['replayed'], request=request)
+
+    def process_response(self, request, response, spider):
+        if self.mode == 'record' and not request.url.startswith('data:'):
+            headers = [(key.decode('latin1'), value.decode('latin1'))
+                       for key, values in response.headers.items() if key.lower() not in self.dropped_headers
+                       for value in values]
+            self.writer.write(request_fingerprint(request), request.method, response.url, response.status, headers,
+                              response.body)
+        return response
+
+
+class TelemetrySpiderMiddleware(object):
+    """Times every spider callback for CrawlTelemetry.
+
+    The time runs from the moment the response enters the callback until its output has been consumed, so callbacks
+    that return a Deferred are timed until it fires.
+    """
+
+    def __init__(self, telemetry):
+        self.telemetry = telemetry
+        self.started = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        telemetry = CrawlTelemetry.find(crawler)
+        if telemetry is None:
+            raise NotConfigured
+        return cls(telemetry)
+
+    def process_spider_input(self, response, spider):
+        self.started[id(response)] = time.monotonic()
+        return None
+
+    def process_spider_output(self, response, result, spider):
+        start = self.started.pop(id(response), None)
+        returned = time.monotonic()
+        consuming = 0.0
+        iterator = iter(result)
+        try:
+            while True:
+                step = time.monotonic()
+                try:
+                    output = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    consuming += time.monotonic() - step
+                yield output
+        finally:
+            if start is not None:
+                callback = getattr(response.request, 'callback', None)
+                self.telemetry.observe_callback(getattr(callback, '__name__', 'parse'),
+                                                returned - start + consuming)
+
+    def process_spider_exception(self, response, exception, spider):
+        self.started.pop(id(response), None)
+        return None
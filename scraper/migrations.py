@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+# Versioned schema migrations
+#
+# create_all only creates the tables that are missing, so changes to existing tables are made here. The version of the
+# schema is kept in ceos_schema_version. A new database is created at the latest version, and a database created
+# before the versions were kept is taken to be at version 0 and goes through every migration.
+
+import logging
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, inspect, text
+
+from scraper.models import DeclarativeBase, operators_table, designers_table, type_of_instrument_table, \
+    geometry_of_instrument_table, instruments_in_mission_table, measurements_of_instrument_table, \
+    instrument_wavebands_table, OrbitNodeCount
+import scraper.views as views
+import scraper.history as history
+
+logger = logging.getLogger(__name__)
+
+# Not part of the catalog metadata, so that staging reloads never replace it
+version_table = Table('ceos_schema_version', MetaData(),
+                      Column('version', Integer, primary_key=True),
+                      Column('description', String))
+
+
+def association_primary_keys(connection):
+    """Composite primary keys on the association tables, dropping their duplicate and incomplete rows first"""
+    inspector = inspect(connection)
+    for table in (operators_table, designers_table, type_of_instrument_table, geometry_of_instrument_table,
+                  instruments_in_mission_table, measurements_of_instrument_table, instrument_wavebands_table):
+        # Missing tables are created afterwards with their primary keys
+        if not inspector.has_table(table.name) or inspector.get_pk_constraint(table.name)['constrained_columns']:
+            continue
+        first, second = [column.name for column in table.columns]
+        connection.execute(text('DELETE FROM %s WHERE %s IS NULL OR %s IS NULL' % (table.name, first, second)))
+        connection.execute(text('DELETE FROM %s a USING %s b WHERE a.ctid < b.ctid AND a.%s = b.%s AND a.%s = b.%s'
+                                % (table.name, table.name, first, first, second, second)))
+        connection.execute(text('ALTER TABLE %s ADD PRIMARY KEY (%s, %s)' % (table.name, first, second)))
+    # The saved orbit counts may include the duplicates, so they are worked out again by the next incremental load
+    if inspector.has_table(OrbitNodeCount.__tablename__):
+        connection.execute(text('DELETE FROM %s' % OrbitNodeCount.__tablename__))
+
+
+def indexes(connection):
+    """Reverse indexes on the association tables and indexes on the classification and name columns"""
+    existing = set(inspect(connection).get_table_names())
+    for table in DeclarativeBase.metadata.sorted_tables:
+        # Missing tables are created afterwards with their indexes
+        if table.name not in existing:
+            continue
+        for index in table.indexes:
+            connection.execute(text('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (
+                index.name, table.name, ', '.join(column.name for column in index.columns))))
+
+
+# (version, description, function) in order. Migrations run on the connection of a transaction
+MIGRATIONS = ((1, 'Primary keys on the association tables', association_primary_keys),
+              (2, 'Indexes on the association tables and the classification columns', indexes))
+
+
+def current_version(connection):
+    return connection.execute(text('SELECT max(version) FROM %s' % version_table.name)).scalar()
+
+
+def upgrade(engine):
+    """Brings the schema of the database up to the latest version"""
+    with engine.begin() as connection:
+        existing = inspect(connection).has_table('ceos_missions')
+        version_table.create(connection, checkfirst=True)
+        version = current_version(connection)
+        if version is None and not existing:
+            # New database, created by create_all at the latest version
+            DeclarativeBase.metadata.create_all(connection)
+            version = MIGRATIONS[-1][0]
+            connection.execute(version_table.insert(), [{'version': version, 'description': 'Created'}])
+        version = version or 0
+        for migration_version, description, migration in MIGRATIONS:
+            if migration_version > version:
+                logger.info('Migrating the database to version %d: %s', migration_version, description)
+                migration(connection)
+                connection.execute(version_table.insert(),
+                                   [{'version': migration_version, 'description': description}])
+        # Tables and views added since the database was created
+        DeclarativeBase.metadata.create_all(connection)
+        history.history_metadata.create_all(connection)
+        views.create(connection)
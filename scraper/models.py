@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from sqlalchemy import create_engine, Column, Integer, Float, String, DateTime, Time, Enum, ForeignKey, Table, \
-    CheckConstraint
+    CheckConstraint, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.engine.url import URL
@@ -20,37 +20,48 @@ def db_connect():
 
 
 def create_tables(engine):
-    """"""
-    DeclarativeBase.metadata.create_all(engine)
+    """
+    Creates the missing tables and migrates the existing ones to the latest schema version
+    """
+    from scraper.migrations import upgrade
+    upgrade(engine)
 
 
 operators_table = Table('ceos_operators', DeclarativeBase.metadata,
-                        Column('agency_id', Integer, ForeignKey('ceos_agencies.id')),
-                        Column('mission_id', Integer, ForeignKey('ceos_missions.id')))
+                        Column('agency_id', Integer, ForeignKey('ceos_agencies.id'), primary_key=True),
+                        Column('mission_id', Integer, ForeignKey('ceos_missions.id'), primary_key=True, index=True))
 
 designers_table = Table('ceos_designers', DeclarativeBase.metadata,
-                        Column('agency_id', Integer, ForeignKey('ceos_agencies.id')),
-                        Column('instrument_id', Integer, ForeignKey('ceos_instruments.id')))
+                        Column('agency_id', Integer, ForeignKey('ceos_agencies.id'), primary_key=True),
+                        Column('instrument_id', Integer, ForeignKey('ceos_instruments.id'), primary_key=True,
+                               index=True))
 
 type_of_instrument_table = Table('ceos_type_of_instrument', DeclarativeBase.metadata,
-                                 Column('instrument_id', Integer, ForeignKey('ceos_instruments.id')),
-                                 Column('instrument_type_id', Integer, ForeignKey('ceos_instrument_types.id')))
+                                 Column('instrument_id', Integer, ForeignKey('ceos_instruments.id'), primary_key=True),
+                                 Column('instrument_type_id', Integer, ForeignKey('ceos_instrument_types.id'),
+                                        primary_key=True, index=True))
 
 geometry_of_instrument_table = Table('ceos_geometry_of_instrument', DeclarativeBase.metadata,
-                                     Column('instrument_id', Integer, ForeignKey('ceos_instruments.id')),
-                                     Column('instrument_geometry_id', Integer, ForeignKey('ceos_geometry_types.id')))
+                                     Column('instrument_id', Integer, ForeignKey('ceos_instruments.id'),
+                                            primary_key=True),
+                                     Column('instrument_geometry_id', Integer, ForeignKey('ceos_geometry_types.id'),
+                                            primary_key=True, index=True))
 
 instruments_in_mission_table = Table('ceos_instruments_in_mission', DeclarativeBase.metadata,
-                                     Column('mission_id', Integer, ForeignKey('ceos_missions.id')),
-                                     Column('instrument_id', Integer, ForeignKey('ceos_instruments.id')))
+                                     Column('mission_id', Integer, ForeignKey('ceos_missions.id'), primary_key=True),
+                                     Column('instrument_id', Integer, ForeignKey('ceos_instruments.id'),
+                                            primary_key=True, index=True))
 
 measurements_of_instrument_table = Table('ceos_measurements_of_instrument', DeclarativeBase.metadata,
-                                         Column('instrument_id', Integer, ForeignKey('ceos_instruments.id')),
-                                         Column('measurement_id', Integer, ForeignKey('ceos_measurements.id')))
+                                         Column('instrument_id', Integer, ForeignKey('ceos_instruments.id'),
+                                                primary_key=True),
+                                         Column('measurement_id', Integer, ForeignKey('ceos_measurements.id'),
+                                                primary_key=True, index=True))
 
 instrument_wavebands_table = Table('ceos_instrument_wavebands', DeclarativeBase.metadata,
-                                   Column('instrument_id', Integer, ForeignKey('ceos_instruments.id')),
-                                   Column('waveband_id', Integer, ForeignKey('ceos_wavebands.id')))
+                                   Column('instrument_id', Integer, ForeignKey('ceos_instruments.id'), primary_key=True),
+                                   Column('waveband_id', Integer, ForeignKey('ceos_wavebands.id'), primary_key=True,
+                                          index=True))
 
 technologies = ('Absorption-band MW radiometer/spectrometer', 'Atmospheric lidar', 'Broad-band radiometer',
                 'Cloud and precipitation radar', 'Communications system', 'Data collection system',
@@ -95,7 +106,7 @@ class Measurement(DeclarativeBase):
     __tablename__ = 'ceos_measurements'
 
     id = Column(Integer, primary_key=True)
-    name = Column('name', String)
+    name = Column('name', String, index=True)
     description = Column('description', String)
     measurement_category_id = Column(Integer, ForeignKey('ceos_measurement_categories.id'))
     measurement_category = relationship('MeasurementCategory', back_populates='measurements')
@@ -126,27 +137,27 @@ class Mission(DeclarativeBase):
     launch_date = Column('launch_date', DateTime, nullable=True)
     eol_date = Column('eol_date', DateTime, nullable=True)
     applications = Column('applications', String)
-    orbit_type = Column('orbit_type', String, nullable=True)
+    orbit_type = Column('orbit_type', String, nullable=True, index=True)
     orbit_period = Column('orbit_period', String, nullable=True)
     orbit_sense = Column('orbit_sense', String, nullable=True)
     orbit_inclination = Column('orbit_inclination', String, nullable=True)
     orbit_inclination_num = Column('orbit_inclination_num', Float, nullable=True)
     orbit_inclination_class = Column('orbit_inclination_class', String, CheckConstraint(
         "orbit_inclination_class IN ('Equatorial', 'Near Equatorial', 'Mid Latitude', 'Near Polar', 'Polar')"),
-                                     nullable=True)
+                                     nullable=True, index=True)
     orbit_altitude = Column('orbit_altitude', String, nullable=True)
     orbit_altitude_num = Column('orbit_altitude_num', Integer, nullable=True)
     orbit_altitude_class = Column('orbit_altitude_class', String, CheckConstraint(
-        "orbit_altitude_class IN ('VL', 'L', 'M', 'H', 'VH')"), nullable=True)
+        "orbit_altitude_class IN ('VL', 'L', 'M', 'H', 'VH')"), nullable=True, index=True)
     orbit_longitude = Column('orbit_longitude', String, nullable=True)
     orbit_LST = Column('orbit_lst', String, nullable=True)
     orbit_LST_time = Column('orbit_lst_time', Time, nullable=True)
     orbit_LST_class = Column('orbit_lst_class', String, CheckConstraint(
-        "orbit_lst_class IN ('DD', 'AM', 'Noon', 'PM')"), nullable=True)
+        "orbit_lst_class IN ('DD', 'AM', 'Noon', 'PM')"), nullable=True, index=True)
     repeat_cycle = Column('repeat_cycle', String, nullable=True)
     repeat_cycle_num = Column('repeat_cycle_num', Float, nullable=True)
     repeat_cycle_class = Column('repeat_cycle_class', String, CheckConstraint(
-        "repeat_cycle_class IN ('Long', 'Short')"), nullable=True)
+        "repeat_cycle_class IN ('Long', 'Short')"), nullable=True, index=True)
 
     agencies = relationship('Agency', secondary=operators_table, back_populates='missions')
     instruments = relationship('Instrument', secondary=instruments_in_mission_table, back_populates='missions')
@@ -157,7 +168,7 @@ class InstrumentType(DeclarativeBase):
     __tablename__ = 'ceos_instrument_types'
 
     id = Column(Integer, primary_key=True)
-    name = Column('name', String)
+    name = Column('name', String, index=True)
 
     instruments = relationship('Instrument', secondary=type_of_instrument_table, back_populates='types')
 
@@ -193,7 +204,7 @@ class Instrument(DeclarativeBase):
     status = Column('status', String)
     maturity = Column('maturity', String, nullable=True)
     technology = Column('technology', String, CheckConstraint("technology IN ('" + "', '".join(technologies) + "')"),
-                        nullable=True)
+                        nullable=True, index=True)
     sampling = Column('sampling', String, CheckConstraint("sampling IN ('Imaging', 'Sounding', 'Other', 'TBD')"))
     data_access = Column('data_access', String, CheckConstraint(
         "data_access IN ('Open Access', 'Constrained Access', 'Very Constrained Access', 'No Access')"), nullable=True)
@@ -230,3 +241,17 @@ class MeasurementMostCommonOrbit(DeclarativeBase):
     id = Column(Integer, primary_key=True)
     measurement = Column('measurement', String)
     orbit = Column('orbit', String, nullable=True)
+
+
+class OrbitNodeCount(DeclarativeBase):
+    """Sqlalchemy OrbitNodeCount model, the counts behind the most common orbits"""
+    __tablename__ = 'ceos_orbit_node_counts'
+    __table_args__ = (Index('ix_ceos_orbit_node_counts_kind_name', 'kind', 'name'),)
+
+    id = Column(Integer, primary_key=True)
+    # 'technology', 'type' or 'measurement', or 'missions' for the number of missions with a known orbit type
+    kind = Column('kind', String)
+    name = Column('name', String, nullable=True)
+    # Suffix of the decision tree node, or '' for the number of (mission, instrument) links
+    node = Column('node', String)
+    count = Column('count', Integer)
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+
+# Most common orbit of every technology, instrument type and measurement
+#
+# The missions, the instrument-in-mission links and the technology, types and measurements of every instrument are
+# fetched once. For each technology, type or measurement, the number of (mission, instrument) links that match it
+# weighs every mission, so all the support and confidence tests of the decision tree are a single matrix product of
+# those weights with the orbit classes of the missions. The counts are the same as the ones of the mission queries
+# joined with their instruments that the tree used to run one by one.
+
+import numpy as np
+
+from scraper.models import Mission, Instrument, InstrumentType, Measurement, OrbitNodeCount, technologies, \
+    instruments_in_mission_table, type_of_instrument_table, measurements_of_instrument_table
+
+# Nodes of the decision tree as (suffix, mission column, matching values)
+NODES = (('GEO', 'orbit_type', ('Geostationary',)),
+         ('LEO', 'orbit_type', ('Inclined, non-sun-synchronous', 'Sun-synchronous')),
+         ('HEO', 'orbit_type', ('Highly elliptical',)),
+         ('-SSO', 'orbit_type', ('Sun-synchronous',)),
+         ('-Eq', 'orbit_inclination_class', ('Equatorial',)),
+         ('-NearEq', 'orbit_inclination_class', ('Near Equatorial',)),
+         ('-MidLat', 'orbit_inclination_class', ('Mid Latitude',)),
+         ('-NearPo', 'orbit_inclination_class', ('Near Polar',)),
+         ('-Po', 'orbit_inclination_class', ('Polar',)),
+         ('-DD', 'orbit_LST_class', ('DD',)),
+         ('-AM', 'orbit_LST_class', ('AM',)),
+         ('-Noon', 'orbit_LST_class', ('Noon',)),
+         ('-PM', 'orbit_LST_class', ('PM',)),
+         ('-VL', 'orbit_altitude_class', ('VL',)),
+         ('-L', 'orbit_altitude_class', ('L',)),
+         ('-M', 'orbit_altitude_class', ('M',)),
+         ('-H', 'orbit_altitude_class', ('H',)),
+         ('-VH', 'orbit_altitude_class', ('VH',)),
+         ('-NRC', 'repeat_cycle_class', (None,)),
+         ('-SRC', 'repeat_cycle_class', ('Short',)),
+         ('-LRC', 'repeat_cycle_class', ('Long',)))
+
+ORBIT_TYPES = ('GEO', 'LEO', 'HEO')
+INCLINATIONS = ('-Eq', '-NearEq', '-MidLat', '-NearPo', '-Po')
+LSTS = ('-DD', '-AM', '-Noon', '-PM')
+ALTITUDES = ('-VL', '-L', '-M', '-H', '-VH')
+REPEAT_CYCLES = ('-NRC', '-SRC', '-LRC')
+
+NODE_INDEX = {suffix: index for index, (suffix, _, _) in enumerate(NODES)}
+COLUMNS = ('orbit_type', 'orbit_inclination_class', 'orbit_LST_class', 'orbit_altitude_class', 'repeat_cycle_class')
+
+
+class OrbitAggregates(object):
+    """Incidence of the missions with the technologies, instrument types and measurements of their instruments"""
+
+    def __init__(self, missions, links, instrument_technologies, instrument_types, instrument_measurements):
+        # missions: (id, orbit_type, orbit_inclination_class, orbit_LST_class, orbit_altitude_class,
+        # repeat_cycle_class) rows; links: (mission_id, instrument_id) rows, one per row of the association table
+        mission_ids = [row[0] for row in missions]
+        index = {mission_id: position for position, mission_id in enumerate(mission_ids)}
+        columns = {name: [row[position + 1] for row in missions] for position, name in enumerate(COLUMNS)}
+        self.missions_count = sum(1 for orbit_type in columns['orbit_type']
+                                  if orbit_type is not None and orbit_type != 'TBD')
+        # Mission x node matrix of the orbit classes
+        self.classes = np.zeros((len(mission_ids), len(NODES)), dtype=np.int64)
+        for node, (_, column, values) in enumerate(NODES):
+            self.classes[:, node] = [value in values for value in columns[column]]
+        self.link_missions = np.array([index[mission_id] for mission_id, _ in links], dtype=np.int64)
+        self.link_instruments = np.array([instrument_id for _, instrument_id in links], dtype=np.int64)
+        self.technologies = self.group(instrument_technologies)
+        self.types = self.group(instrument_types)
+        self.measurements = self.group(instrument_measurements)
+
+    @classmethod
+    def from_session(cls, session):
+        missions = session.query(Mission.id, Mission.orbit_type, Mission.orbit_inclination_class,
+                                 Mission.orbit_LST_class, Mission.orbit_altitude_class,
+                                 Mission.repeat_cycle_class).all()
+        links = session.query(instruments_in_mission_table.c.mission_id,
+                              instruments_in_mission_table.c.instrument_id).all()
+        instrument_technologies = session.query(Instrument.id, Instrument.technology).all()
+        instrument_types = session.query(type_of_instrument_table.c.instrument_id, InstrumentType.name).join(
+            InstrumentType, InstrumentType.id == type_of_instrument_table.c.instrument_type_id).all()
+        instrument_measurements = session.query(measurements_of_instrument_table.c.instrument_id,
+                                                Measurement.name).join(
+            Measurement, Measurement.id == measurements_of_instrument_table.c.measurement_id).all()
+        return cls(missions, links, instrument_technologies, instrument_types, instrument_measurements)
+
+    def group(self, pairs):
+        # Name -> ids of the instruments that have it, each instrument once
+        groups = {}
+        for instrument_id, name in pairs:
+            groups.setdefault(name, set()).add(instrument_id)
+        return {name: np.array(sorted(ids), dtype=np.int64) for name, ids in groups.items()}
+
+    def weights(self, instrument_ids):
+        """Number of links of every mission with the given instruments"""
+        matching = np.isin(self.link_instruments, instrument_ids)
+        return np.bincount(self.link_missions[matching], minlength=self.classes.shape[0])
+
+    def counts(self, groups, names):
+        """Number of links (param counts) and key x node intersection counts, for the instruments of each name"""
+        empty = np.zeros(0, dtype=np.int64)
+        weights = np.array([self.weights(groups.get(name, empty)) for name in names], dtype=np.int64)
+        weights = weights.reshape(len(names), self.classes.shape[0])
+        return weights.sum(axis=1), weights @ self.classes
+
+    def node_counts(self):
+        """(kind, name) -> vector of the number of links followed by the count of every node"""
+        node_counts = {}
+        for kind, groups in (('technology', self.technologies), ('type', self.types),
+                             ('measurement', self.measurements)):
+            names = [name for name in groups if name is not None]
+            param_counts, intersect_counts = self.counts(groups, names)
+            for name, param_count, row in zip(names, param_counts, intersect_counts):
+                node_counts[(kind, name)] = np.concatenate(([param_count], row))
+        return node_counts
+
+    def most_common_orbits(self, groups, names):
+        param_counts, intersect_counts = self.counts(groups, names)
+        return [most_common_orbit(row) for row in tests(param_counts, intersect_counts, self.missions_count)]
+
+
+class OrbitCounts(object):
+    """Per-node counts of every technology, type and measurement, updated as the missions, instruments and
+    measurements they come from change.
+
+    The counts are kept in ceos_orbit_node_counts between crawls. The contribution of a mission, instrument or
+    measurement to them is worked out from the rows and association rows of the DimensionCache, so applying a change
+    only touches the links of what changed.
+    """
+
+    def __init__(self, cache, node_counts, missions_count):
+        self.cache = cache
+        # (kind, name) -> vector of the number of links followed by the count of every node
+        self.node_counts = node_counts
+        self.missions_count = missions_count
+        self.changed = set()
+        # The support test of every key depends on whether there are missions at all
+        self.all_changed = False
+
+    @classmethod
+    def from_aggregates(cls, cache, aggregates):
+        return cls(cache, aggregates.node_counts(), aggregates.missions_count)
+
+    @classmethod
+    def load(cls, session, cache):
+        node_counts = {}
+        missions_count = None
+        for kind, name, node, count in session.query(OrbitNodeCount.kind, OrbitNodeCount.name, OrbitNodeCount.node,
+                                                     OrbitNodeCount.count):
+            if kind == 'missions':
+                missions_count = count
+                continue
+            vector = node_counts.setdefault((kind, name), np.zeros(len(NODES) + 1, dtype=np.int64))
+            vector[NODE_INDEX[node] + 1 if node else 0] = count
+        if missions_count is None:
+            # The counts of a catalog written before they were kept are worked out once from its tables, and its most
+            # common orbits are all written again
+            orbit_counts = cls.from_aggregates(cache, OrbitAggregates.from_session(session))
+            orbit_counts.all_changed = True
+            return orbit_counts
+        return cls(cache, node_counts, missions_count)
+
+    def mission_vector(self, mission_id):
+        # One link, and the orbit classes of the mission
+        row = self.cache.get(Mission, mission_id)
+        vector = np.zeros(len(NODES) + 1, dtype=np.int64)
+        vector[0] = 1
+        for node, (_, column, values) in enumerate(NODES):
+            vector[node + 1] = row[column] in values
+        return vector
+
+    def instrument_keys(self, instrument_id):
+        row = self.cache.get(Instrument, instrument_id)
+        if row is None:
+            return set()
+        keys = set()
+        if row['technology'] is not None:
+            keys.add(('technology', row['technology']))
+        for _, type_id in self.cache.linked(Instrument, instrument_id, type_of_instrument_table):
+            keys.add(('type', self.cache.get(InstrumentType, type_id)['name']))
+        for _, measurement_id in self.cache.linked(Instrument, instrument_id, measurements_of_instrument_table):
+            keys.add(('measurement', self.cache.get(Measurement, measurement_id)['name']))
+        return keys
+
+    def add_links(self, contribution, instrument_id, mission_ids):
+        keys = self.instrument_keys(instrument_id)
+        for mission_id in mission_ids:
+            vector = self.mission_vector(mission_id)
+            for key in keys:
+                contribution[key] = contribution.get(key, 0) + vector
+
+    def contribution(self, model, entity_id):
+        """Counts that come from a mission, instrument or measurement as it is cached, and 1 if it is a mission with a
+        known orbit type"""
+        contribution = {}
+        missions = 0
+        if model is Mission:
+            row = self.cache.get(Mission, entity_id)
+            if row is not None and row['orbit_type'] is not None and row['orbit_type'] != 'TBD':
+                missions = 1
+            for instrument_id in self.cache.referring(instruments_in_mission_table, entity_id):
+                self.add_links(contribution, instrument_id, [entity_id])
+        elif model is Instrument:
+            mission_ids = [mission_id for mission_id, _ in
+                           self.cache.linked(Instrument, entity_id, instruments_in_mission_table)]
+            self.add_links(contribution, entity_id, mission_ids)
+        elif model is Measurement:
+            for instrument_id in set(self.cache.referring(measurements_of_instrument_table, entity_id)):
+                mission_ids = [mission_id for mission_id, _ in
+                               self.cache.linked(Instrument, instrument_id, instruments_in_mission_table)]
+                self.add_links(contribution, instrument_id, mission_ids)
+        return contribution, missions
+
+    def apply(self, before, after):
+        """Updates the counts with the difference between two contributions of the same item"""
+        (before, missions_before), (after, missions_after) = before, after
+        missions_count = self.missions_count + missions_after - missions_before
+        if (missions_count == 0) != (self.missions_count == 0):
+            self.all_changed = True
+        self.missions_count = missions_count
+        for key in set(before) | set(after):
+            delta = after.get(key, 0) - before.get(key, 0)
+            if np.any(delta):
+                self.node_counts[key] = self.node_counts.get(key, 0) + delta
+                self.changed.add(key)
+
+    def touch(self, key):
+        """Marks the most common orbit of a key as needing an update even if its counts did not change"""
+        self.changed.add(key)
+
+    def most_common_orbit(self, key):
+        vector = self.node_counts.get(key, np.zeros(len(NODES) + 1, dtype=np.int64))
+        return most_common_orbit(tests(vector[:1], vector[np.newaxis, 1:], self.missions_count)[0])
+
+    def save(self, session, everything=False):
+        """Writes the counts of the changed keys, or all of them"""
+        if everything or self.all_changed:
+            session.query(OrbitNodeCount).delete(synchronize_session=False)
+            keys = self.node_counts
+        else:
+            session.query(OrbitNodeCount).filter(OrbitNodeCount.kind == 'missions').delete(synchronize_session=False)
+            keys = self.changed
+            for kind, name in keys:
+                session.query(OrbitNodeCount).filter(OrbitNodeCount.kind == kind, OrbitNodeCount.name == name).delete(
+                    synchronize_session=False)
+        session.add(OrbitNodeCount(kind='missions', name=None, node='', count=self.missions_count))
+        for kind, name in keys:
+            vector = self.node_counts.get((kind, name))
+            if vector is None:
+                continue
+            for position, count in enumerate(vector):
+                if count:
+                    node = NODES[position - 1][0] if position else ''
+                    session.add(OrbitNodeCount(kind=kind, name=name, node=node, count=int(count)))
+        self.changed = set()
+        self.all_changed = False
+
+
+def tests(param_counts, intersect_counts, missions_count):
+    """Key x node matrix of the support and confidence tests"""
+    intersect_counts = np.asarray(intersect_counts, dtype=np.float64)
+    param_counts = np.asarray(param_counts, dtype=np.float64).reshape(-1, 1)
+    if missions_count == 0:
+        return np.zeros(intersect_counts.shape, dtype=bool)
+    support = intersect_counts / missions_count
+    with np.errstate(divide='ignore', invalid='ignore'):
+        confidence = intersect_counts / param_counts
+    return (param_counts != 0) & (support > 10.0 / missions_count) & (confidence > 0.5)
+
+
+def most_common_orbit(passed):
+    """Innermost node of the decision tree, given which of the nodes passed their tests"""
+    def last(suffixes):
+        # Later nodes of a level override the earlier ones
+        found = ''
+        for suffix in suffixes:
+            if passed[NODE_INDEX[suffix]]:
+                found = suffix
+        return found
+
+    most_common_orbit = last(ORBIT_TYPES) or None
+    if most_common_orbit == 'LEO':
+        most_common_orbit_add = '-SSO' if passed[NODE_INDEX['-SSO']] else ''
+        # Prevent SSO form turning into NearPo
+        if most_common_orbit_add != '-SSO':
+            most_common_orbit_add = last(INCLINATIONS)
+        most_common_orbit += most_common_orbit_add
+        # Try to specialize for LST
+        if most_common_orbit_add == '-SSO':
+            most_common_orbit_add = last(LSTS)
+            most_common_orbit += most_common_orbit_add
+        # Specialize for Orbit Altitude only if already specialized from LEO
+        if most_common_orbit != 'LEO':
+            most_common_orbit_add = last(ALTITUDES)
+            most_common_orbit += most_common_orbit_add
+        # Specialize for repeat cycle only if already specialized for OA
+        if most_common_orbit_add in ALTITUDES:
+            most_common_orbit_add = last(REPEAT_CYCLES)
+            most_common_orbit += most_common_orbit_add
+    return most_common_orbit
+
+
+def compute_common_orbits(session, aggregates=None):
+    """Most common orbit of every technology, instrument type and measurement, as (techtype, orbit) and
+    (measurement, orbit) rows in the order the tree used to produce them"""
+    if aggregates is None:
+        aggregates = OrbitAggregates.from_session(session)
+    type_names = [instrument_type.name for instrument_type in session.query(InstrumentType).all()]
+    measurement_names = [measurement.name for measurement in session.query(Measurement).all()]
+    techtype_orbits = list(zip(technologies, aggregates.most_common_orbits(aggregates.technologies, technologies)))
+    techtype_orbits += zip(type_names, aggregates.most_common_orbits(aggregates.types, type_names))
+    measurement_orbits = list(zip(measurement_names,
+                                  aggregates.most_common_orbits(aggregates.measurements, measurement_names)))
+    return techtype_orbits, measurement_orbits
@@ -4,16 +4,29 @@
 #
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: http://doc.scrapy.org/en/latest/topics/item-pipeline.html
+import datetime
+import logging
 import os
 
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import or_
 from scraper.models import BroadMeasurementCategory, MeasurementCategory, Measurement, \
     Agency, Mission, InstrumentType, GeometryType, Waveband, Instrument, TechTypeMostCommonOrbit, \
     MeasurementMostCommonOrbit, technologies, db_connect, create_tables
+from scraper.bulk import BulkWriter
+from scraper.writer import WriterThread
+from scraper.graph import GraphBatchWriter, GraphWriterPool, RelationshipBuffer, delete_in_batches
+from scraper.graph_export import GraphCsvExporter
+from scraper.extensions import timed_pipeline
+from scraper.dimensions import DimensionCache, ITEM_MODELS, LINK_TABLES
+import scraper.staging as staging
+import scraper.views as views
+import scraper.history as history
+import scraper.orbits as orbits
 from scraper.spiders import CEOSDB_schema
 
 from neo4j import GraphDatabase
+from scrapy.utils.log import failure_to_exc_info
+from twisted.internet import task, threads
 import scraper.cypher_tx as cypher_tx
 
 from rdflib import Graph, Literal, RDF, RDFS, URIRef
@@ -21,6 +34,27 @@ from rdflib.namespace import FOAF, OWL
 
 import scraper.items as items
 
+logger = logging.getLogger(__name__)
+
+# Stats of the spider and HTTP errors after which a crawl may have missed part of the catalog
+CRAWL_ERROR_STATS = ('spider_exceptions/count', 'httperror/response_ignored_count', 'retry/max_reached')
+
+
+def crawl_complete(crawler, stats, spider, write_errors):
+    """Whether the crawl ran to the end without spider or HTTP errors and without errors in the write_errors stat of
+    the pipeline, so that the entities it did not see are really gone"""
+    if crawler is not None and not crawler.engine.running:
+        # The crawl was stopped (e.g. with Ctrl-C) before it was finished
+        return False
+    if stats is None:
+        return True
+    return not any(stats.get_value(key, 0, spider=spider) for key in CRAWL_ERROR_STATS + (write_errors,))
+
+
+def link_key(link):
+    table, row = link
+    return table.name, row
+
 
 class DatabasePipeline(object):
     """Database pipeline for storing scraped items in the database"""
@@ -29,255 +63,205 @@ class DatabasePipeline(object):
         Initializes database connection and sessionmaker.
         Creates deals table.
         """
-        engine = db_connect()
-        create_tables(engine)
-        self.Session = sessionmaker(bind=engine)
+        self.engine = db_connect()
+        create_tables(self.engine)
+        self.Session = sessionmaker(bind=self.engine)
+        self.write_engine = self.engine
+        self.staging_schema = None
+        self.incremental = False
+        self.cache = None
+        self.orbit_counts = None
+        self.writer = None
+        self.flush_task = None
+        self.crawl_time = None
+        self.writer_thread = None
+        self.crawler = None
+        self.stats = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = cls()
+        pipeline.crawler = crawler
+        pipeline.stats = crawler.stats
+        return pipeline
 
     def fill_instrument_types(self, session, types):
         for instr_type in types:
+            if self.incremental and session.query(InstrumentType).filter(InstrumentType.name == instr_type).count():
+                continue
             instrument_type = InstrumentType(name=instr_type)
             session.add(instrument_type)
 
     def fill_geometry_types(self, session, geometries):
         for geometry in geometries:
+            if self.incremental and session.query(GeometryType).filter(GeometryType.name == geometry).count():
+                continue
             geometry_type = GeometryType(name=geometry)
             session.add(geometry_type)
 
     def fill_wavebands(self, session, wavebands):
         for waveband_t in wavebands:
+            if self.incremental and session.query(Waveband).filter(Waveband.name == waveband_t[0]).count():
+                continue
             waveband = Waveband(name=waveband_t[0], wavelengths=waveband_t[1])
             session.add(waveband)
 
     def add_measurement_category(self, session):
+        if self.incremental and session.query(MeasurementCategory).get(1000) is not None:
+            return
         broad_other = BroadMeasurementCategory(id=1000, name='Other', description='Other')
         session.add(broad_other)
         cat_other = MeasurementCategory(id=1000, name='Other', description='Other', broad_measurement_category_id=1000)
         session.add(cat_other)
 
-    def check_confidences(self, missions_count, missions_param_count, missions_intersect_count):
-        if missions_count != 0:
-            supp = float(missions_intersect_count) / missions_count
-        else:
-            return False
-        if missions_param_count != 0:
-            conf_param_impl_orbit = float(missions_intersect_count) / missions_param_count
-        else:
-            return False
-        return supp > 10.0/missions_count and conf_param_impl_orbit > 0.5
-
-    def compute_common_orbit(self, session, param_query):
-        most_common_orbit = None
-        missions_count = session.query(Mission).filter(Mission.orbit_type != None).filter(
-            Mission.orbit_type != 'TBD').count()
-        missions_param_count = param_query.count()
-        ## First level nodes
-        # GEO
-        missions_intersect_count = param_query.filter(Mission.orbit_type == 'Geostationary').count()
-        if self.check_confidences(missions_count, missions_param_count, missions_intersect_count):
-            most_common_orbit = 'GEO'
-        # LEO
-        missions_orbit_query = session.query(Mission).filter(or_(Mission.orbit_type == 'Inclined, non-sun-synchronous',
-                                                                 Mission.orbit_type == 'Sun-synchronous'))
-        missions_intersect_query = param_query.filter(or_(Mission.orbit_type == 'Inclined, non-sun-synchronous',
-                                                                 Mission.orbit_type == 'Sun-synchronous'))
-        missions_intersect_count = missions_intersect_query.count()
-        if self.check_confidences(missions_count, missions_param_count, missions_intersect_count):
-            most_common_orbit = 'LEO'
-        # HEO
-        missions_intersect_count = param_query.filter(Mission.orbit_type == 'Highly elliptical').count()
-        if self.check_confidences(missions_count, missions_param_count, missions_intersect_count):
-            most_common_orbit = 'HEO'
-
-        # In case of LEO, specialize by SSO or other inclined orbits
-        if most_common_orbit == 'LEO':
-            most_common_orbit_add = ''
-            # SSO
-            missions_intersect_query = param_query.filter(Mission.orbit_type == 'Sun-synchronous')
-            missions_intersect_count = missions_intersect_query.count()
-            if self.check_confidences(missions_count, missions_param_count, missions_intersect_count):
-                most_common_orbit_add = '-SSO'
-            # Prevent SSO form turning into NearPo
-            if most_common_orbit_add != '-SSO':
-                # Equatorial
-                missions_intersect_query = param_query.filter(Mission.orbit_inclination_class == 'Equatorial')
-                missions_intersect_count = missions_intersect_query.count()
-                if self.check_confidences(missions_count, missions_param_count, missions_intersect_count):
-                    most_common_orbit_add = '-Eq'
-                # Near Equatorial
-                missions_intersect_query = param_query.filter(Mission.orbit_inclination_class == 'Near Equatorial')
-                missions_intersect_count = missions_intersect_query.count()
-                if self.check_confidences(missions_count, missions_param_count, missions_intersect_count):
-                    most_common_orbit_add = '-NearEq'
-                # Mid Latitude
-                missions_intersect_query = param_query.filter(Mission.orbit_inclination_class == 'Mid Latitude')
-                missions_intersect_count = missions_intersect_query.count()
-                if self.check_confidences(missions_count, missions_param_count, missions_intersect_count):
-                    most_common_orbit_add = '-MidLat'
-                # Near Polar
-                missions_intersect_query = param_query.filter(Mission.orbit_inclination_class == 'Near Polar')
-                missions_intersect_count = missions_intersect_query.count()
-                if self.check_confidences(missions_count, missions_param_count, missions_intersect_count):
-                    most_common_orbit_add = '-NearPo'
-                # Polar
-                missions_intersect_query = param_query.filter(Mission.orbit_inclination_class == 'Polar')
-                missions_intersect_count = missions_intersect_query.count()
-                if self.check_confidences(missions_count, missions_param_count, missions_intersect_count):
-                    most_common_orbit_add = '-Po'
-            most_common_orbit += most_common_orbit_add
-
-            # Try to specialize for LST
-            if most_common_orbit_add == '-SSO':
-                most_common_orbit_add = ''
-                # DD
-                missions_intersect_query = param_query.filter(Mission.orbit_LST_class == 'DD')
-                missions_intersect_count = missions_intersect_query.count()
-                if self.check_confidences(missions_count, missions_param_count, missions_intersect_count):
-                    most_common_orbit_add = '-DD'
-                # AM
-                missions_intersect_query = param_query.filter(Mission.orbit_LST_class == 'AM')
-                missions_intersect_count = missions_intersect_query.count()
-                if self.check_confidences(missions_count, missions_param_count, missions_intersect_count):
-                    most_common_orbit_add = '-AM'
-                # Noon
-                missions_intersect_query = param_query.filter(Mission.orbit_LST_class == 'Noon')
-                missions_intersect_count = missions_intersect_query.count()
-                if self.check_confidences(missions_count, missions_param_count, missions_intersect_count):
-                    most_common_orbit_add = '-Noon'
-                # PM
-                missions_intersect_query = param_query.filter(Mission.orbit_LST_class == 'PM')
-                missions_intersect_count = missions_intersect_query.count()
-                if self.check_confidences(missions_count, missions_param_count, missions_intersect_count):
-                    most_common_orbit_add = '-PM'
-                most_common_orbit += most_common_orbit_add
-
-            # Specialize for Orbit Altitude only if already specialized from LEO
-            if most_common_orbit != 'LEO':
-                most_common_orbit_add = ''
-                # VL
-                missions_intersect_query = param_query.filter(Mission.orbit_altitude_class == 'VL')
-                missions_intersect_count = missions_intersect_query.count()
-                if self.check_confidences(missions_count, missions_param_count, missions_intersect_count):
-                    most_common_orbit_add = '-VL'
-                # L
-                missions_intersect_query = param_query.filter(Mission.orbit_altitude_class == 'L')
-                missions_intersect_count = missions_intersect_query.count()
-                if self.check_confidences(missions_count, missions_param_count, missions_intersect_count):
-                    most_common_orbit_add = '-L'
-                # M
-                missions_intersect_query = param_query.filter(Mission.orbit_altitude_class == 'M')
-                missions_intersect_count = missions_intersect_query.count()
-                if self.check_confidences(missions_count, missions_param_count, missions_intersect_count):
-                    most_common_orbit_add = '-M'
-                # H
-                missions_intersect_query = param_query.filter(Mission.orbit_altitude_class == 'H')
-                missions_intersect_count = missions_intersect_query.count()
-                if self.check_confidences(missions_count, missions_param_count, missions_intersect_count):
-                    most_common_orbit_add = '-H'
-                # VH
-                missions_intersect_query = param_query.filter(Mission.orbit_altitude_class == 'VH')
-                missions_intersect_count = missions_intersect_query.count()
-                if self.check_confidences(missions_count, missions_param_count, missions_intersect_count):
-                    most_common_orbit_add = '-VH'
-                most_common_orbit += most_common_orbit_add
-
-            # Specialize for repeat cycle only if already specialized for OA
-            if most_common_orbit_add == '-VL' or most_common_orbit_add == '-L' or most_common_orbit_add == '-M' \
-                    or most_common_orbit_add == '-H' or most_common_orbit_add == '-VH':
-                most_common_orbit_add = ''
-                # NRC
-                missions_intersect_query = param_query.filter(Mission.repeat_cycle_class == None)
-                missions_intersect_count = missions_intersect_query.count()
-                if self.check_confidences(missions_count, missions_param_count, missions_intersect_count):
-                    most_common_orbit_add = '-NRC'
-                # SRC
-                missions_intersect_query = param_query.filter(Mission.repeat_cycle_class == 'Short')
-                missions_intersect_count = missions_intersect_query.count()
-                if self.check_confidences(missions_count, missions_param_count, missions_intersect_count):
-                    most_common_orbit_add = '-SRC'
-                # LRC
-                missions_intersect_query = param_query.filter(Mission.repeat_cycle_class == 'Long')
-                missions_intersect_count = missions_intersect_query.count()
-                if self.check_confidences(missions_count, missions_param_count, missions_intersect_count):
-                    most_common_orbit_add = '-LRC'
-                most_common_orbit += most_common_orbit_add
-        return most_common_orbit
-
     def compute_common_orbits(self, session):
         # For each technology and type, compute the innermost node on the decision tree that fits all confidence values
         # to be considered a common orbit
-        for technology in technologies:
-            mission_query = session.query(Mission).join(Instrument, Mission.instruments).filter(Instrument.technology == technology)
-            most_common_orbit = self.compute_common_orbit(session, mission_query)
-            tt_mco = TechTypeMostCommonOrbit(techtype=technology, orbit=most_common_orbit)
-            print(technology, most_common_orbit)
-            session.add(tt_mco)
-        for type in session.query(InstrumentType).all():
-            mission_query = session.query(Mission).join(Instrument, Mission.instruments).filter(Instrument.types.any(InstrumentType.name == type.name))
-            most_common_orbit = self.compute_common_orbit(session, mission_query)
-            tt_mco = TechTypeMostCommonOrbit(techtype=type.name, orbit=most_common_orbit)
-            print(type.name, most_common_orbit)
-            session.add(tt_mco)
-        for measurement in session.query(Measurement).all():
-            mission_query = session.query(Mission).join(Instrument, Mission.instruments).filter(Instrument.measurements.any(Measurement.name == measurement.name))
-            most_common_orbit = self.compute_common_orbit(session, mission_query)
-            meas_mco = MeasurementMostCommonOrbit(measurement=measurement.name, orbit=most_common_orbit)
-            print(measurement.name, most_common_orbit)
-            session.add(meas_mco)
+        aggregates = orbits.OrbitAggregates.from_session(session)
+        techtype_orbits, measurement_orbits = orbits.compute_common_orbits(session, aggregates)
+        for techtype, most_common_orbit in techtype_orbits:
+            logger.debug('%s: %s', techtype, most_common_orbit)
+            session.add(TechTypeMostCommonOrbit(techtype=techtype, orbit=most_common_orbit))
+        for measurement, most_common_orbit in measurement_orbits:
+            logger.debug('%s: %s', measurement, most_common_orbit)
+            session.add(MeasurementMostCommonOrbit(measurement=measurement, orbit=most_common_orbit))
+        # The counts are kept for the incremental crawls that follow
+        orbits.OrbitCounts.from_aggregates(self.cache, aggregates).save(session, everything=True)
+
+    def update_common_orbits(self, session):
+        # Only the technologies, types and measurements whose counts changed during an incremental crawl are updated
+        if self.orbit_counts.all_changed:
+            keys = [('technology', technology) for technology in technologies]
+            keys += [('type', row['name']) for row in self.cache.rows[InstrumentType].values()]
+            keys += set(('measurement', row['name']) for row in self.cache.rows[Measurement].values())
+            # Names that were renamed away still have rows to remove
+            keys += self.orbit_counts.changed - set(keys)
+        else:
+            keys = sorted(self.orbit_counts.changed, key=lambda key: (key[0], key[1] or ''))
+        for kind, name in keys:
+            most_common_orbit = self.orbit_counts.most_common_orbit((kind, name))
+            logger.debug('%s: %s', name, most_common_orbit)
+            if kind == 'measurement':
+                # One row per measurement with the name
+                session.query(MeasurementMostCommonOrbit).filter(MeasurementMostCommonOrbit.measurement == name).delete(
+                    synchronize_session=False)
+                for row in self.cache.rows[Measurement].values():
+                    if row['name'] == name:
+                        session.add(MeasurementMostCommonOrbit(measurement=name, orbit=most_common_orbit))
+            elif kind == 'technology' and name not in technologies:
+                continue
+            else:
+                tt_mcos = session.query(TechTypeMostCommonOrbit).filter(TechTypeMostCommonOrbit.techtype == name).all()
+                for tt_mco in tt_mcos:
+                    tt_mco.orbit = most_common_orbit
+                if not tt_mcos:
+                    session.add(TechTypeMostCommonOrbit(techtype=name, orbit=most_common_orbit))
+        self.orbit_counts.save(session)
+
+    def delete_all(self, session):
+        for instrument in session.query(Instrument):
+            session.delete(instrument)
+        for mission in session.query(Mission):
+            session.delete(mission)
+        for agency in session.query(Agency):
+            session.delete(agency)
+        for measurement in session.query(Measurement):
+            session.delete(measurement)
+        for category in session.query(MeasurementCategory):
+            session.delete(category)
+        for broad_category in session.query(BroadMeasurementCategory):
+            session.delete(broad_category)
+        for instrument_type in session.query(InstrumentType):
+            session.delete(instrument_type)
+        for geometry_type in session.query(GeometryType):
+            session.delete(geometry_type)
+        for waveband in session.query(Waveband):
+            session.delete(waveband)
+        for tt_mco in session.query(TechTypeMostCommonOrbit):
+            session.delete(tt_mco)
+        for meas_mco in session.query(MeasurementMostCommonOrbit):
+            session.delete(meas_mco)
 
     def open_spider(self, spider):
+        load_mode = spider.settings.get('DATABASE_LOAD_MODE', 'replace')
+        self.incremental = load_mode == 'incremental'
+        self.crawl_time = datetime.datetime.utcnow()
+        if load_mode == 'staging':
+            # Everything is loaded into an empty staging schema that replaces the live tables at close_spider
+            self.staging_schema = spider.settings.get('DATABASE_STAGING_SCHEMA', 'ceos_staging')
+            self.write_engine = staging.create_staging(self.engine, self.staging_schema)
+            self.Session.configure(bind=self.write_engine)
         session = self.Session()
 
         try:
-            for instrument in session.query(Instrument):
-                session.delete(instrument)
-            for mission in session.query(Mission):
-                session.delete(mission)
-            for agency in session.query(Agency):
-                session.delete(agency)
-            for measurement in session.query(Measurement):
-                session.delete(measurement)
-            for category in session.query(MeasurementCategory):
-                session.delete(category)
-            for broad_category in session.query(BroadMeasurementCategory):
-                session.delete(broad_category)
-            for instrument_type in session.query(InstrumentType):
-                session.delete(instrument_type)
-            for geometry_type in session.query(GeometryType):
-                session.delete(geometry_type)
-            for waveband in session.query(Waveband):
-                session.delete(waveband)
-            for tt_mco in session.query(TechTypeMostCommonOrbit):
-                session.delete(tt_mco)
-            for meas_mco in session.query(MeasurementMostCommonOrbit):
-                session.delete(meas_mco)
+            if self.staging_schema is None and not self.incremental:
+                self.delete_all(session)
+            known_types = set(name for name, in session.query(InstrumentType.name))
             self.fill_instrument_types(session, spider.instrument_types)
             self.fill_geometry_types(session, spider.instrument_geometries)
             self.fill_wavebands(session, spider.wavebands)
             self.add_measurement_category(session)
             session.commit()
+            self.cache = DimensionCache()
+            self.cache.load(session, links=self.incremental)
+            if self.incremental:
+                self.orbit_counts = orbits.OrbitCounts.load(session, self.cache)
+                for instr_type in set(spider.instrument_types) - known_types:
+                    self.orbit_counts.touch(('type', instr_type))
+                if spider.settings.get('DATABASE_WRITE_MODE', 'orm') == 'bulk':
+                    logger.warning("Incremental loads are written in 'orm' mode")
+            elif spider.settings.get('DATABASE_WRITE_MODE', 'orm') == 'bulk':
+                self.writer = BulkWriter(self.engine, self.cache, spider.settings.getint('DATABASE_BATCH_SIZE', 1000),
+                                         self.staging_schema)
+                self.flush_task = task.LoopingCall(self.flush)
+                self.flush_task.start(spider.settings.getfloat('DATABASE_FLUSH_INTERVAL', 5.0), now=False)
         except:
             session.rollback()
             raise
         finally:
             session.close()
 
+        if spider.settings.getbool('DATABASE_WRITER_THREAD', True):
+            self.writer_thread = WriterThread(spider.settings.getint('DATABASE_WRITER_QUEUE_SIZE', 1000))
+
+    def flush(self):
+        if self.writer_thread is not None:
+            _, done = self.writer_thread.submit(self.writer.flush)
+            done.addErrback(lambda failure: logger.error('Error flushing the database writer',
+                                                         exc_info=failure_to_exc_info(failure)))
+        else:
+            self.writer.flush()
+
+    @timed_pipeline
     def process_item(self, item, spider):
         """Save items in the database.
 
         This method is called for every item pipeline component.
 
         """
-        session = self.Session()
+        if self.writer_thread is None:
+            return self.write_item(item, spider)
+        # The item is written on the writer thread, and passed on to the next pipeline once it is queued
+        queued, done = self.writer_thread.submit(self.write_item, item, spider)
+        done.addErrback(self.write_failed, item, spider)
+        return queued.addCallback(lambda _: item)
+
+    def write_failed(self, failure, item, spider):
+        logger.error('Error writing %s to the database', item, exc_info=failure_to_exc_info(failure),
+                     extra={'spider': spider})
+        if self.stats is not None:
+            self.stats.inc_value('database/write_errors', spider=spider)
+
+    def write_item(self, item, spider):
+        if self.writer is not None:
+            self.writer.add(item)
+            return item
 
-        if isinstance(item, items.BroadMeasurementCategory):
-            db_object = BroadMeasurementCategory(**item)
-        elif isinstance(item, items.MeasurementCategory):
-            db_object = MeasurementCategory(**item)
-        elif isinstance(item, items.Measurement):
-            db_object = Measurement(**item)
-        elif isinstance(item, items.Agency):
-            db_object = Agency(**item)
-        elif isinstance(item, items.Mission):
+        model = ITEM_MODELS.get(type(item))
+        if model is None:
+            return item
+        if model is Mission:
+            # The agencies are only written as association rows
             db_object = Mission(id=item['id'], name=item['name'], full_name=item['full_name'], status=item['status'],
                                 launch_date=item['launch_date'], eol_date=item['eol_date'],
                                 applications=item['applications'], orbit_type=item['orbit_type'],
@@ -292,10 +276,9 @@ class DatabasePipeline(object):
                                 orbit_LST_time=item['orbit_LST_time'], orbit_LST_class=item['orbit_LST_class'],
                                 repeat_cycle=item['repeat_cycle'], repeat_cycle_num=item['repeat_cycle_num'],
                                 repeat_cycle_class=item['repeat_cycle_class'])
-            for agency_id in item['agencies']:
-                agency = session.query(Agency).get(agency_id)
-                db_object.agencies.append(agency)
-        elif isinstance(item, items.Instrument):
+        elif model is Instrument:
+            # The agencies, types, geometries, missions, measurements and wavebands are only written as association
+            # rows
             db_object = Instrument(id=item['id'], name=item['name'], full_name=item['full_name'], status=item['status'],
                                    maturity=item['maturity'], technology=item['technology'], sampling=item['sampling'],
                                    data_access=item['data_access'], data_format=item['data_format'],
@@ -304,29 +287,39 @@ class DatabasePipeline(object):
                                    best_resolution=item['best_resolution'], swath_summary=item['swath_summary'],
                                    max_swath=item['max_swath'], accuracy_summary=item['accuracy_summary'],
                                    waveband_summary=item['waveband_summary'])
-            for agency_id in item['agencies']:
-                agency = session.query(Agency).get(agency_id)
-                db_object.agencies.append(agency)
-            for instr_type in item['types']:
-                instrument_type = session.query(InstrumentType).filter(InstrumentType.name == instr_type).first()
-                db_object.types.append(instrument_type)
-            for geometry in item['geometries']:
-                instrument_geometry = session.query(GeometryType).filter(GeometryType.name == geometry).first()
-                db_object.geometries.append(instrument_geometry)
-            for mission_id in item['missions']:
-                mission = session.query(Mission).get(mission_id)
-                db_object.missions.append(mission)
-            for measurement_id in item['measurements']:
-                measurement = session.query(Measurement).get(measurement_id)
-                db_object.measurements.append(measurement)
-            for waveband in item['wavebands']:
-                instrument_waveband = session.query(Waveband).filter(Waveband.name == waveband).first()
-                db_object.wavebands.append(instrument_waveband)
         else:
-            db_object = None
+            db_object = model(**item)
+
+        # Association rows are built from the cached IDs, dropping the ones to rows that were never written
+        links = []
+        for table, row, target_model, target_id in self.cache.links(model, item):
+            if target_model is None or self.cache.has(target_model, target_id):
+                links.append((table, row))
+            else:
+                logger.warning('%s %s links to missing %s %s', model.__name__, item['id'], target_model.__name__,
+                               target_id)
+        row = {key: item.get(key) for key in self.cache.keys[model]}
+
+        previous = self.cache.get(model, item['id'])
+        if self.incremental:
+            if previous == row and sorted(self.cache.linked_rows.get((model, item['id']), []), key=link_key) == \
+                    sorted(links, key=link_key):
+                return item
+            before = self.orbit_counts.contribution(model, item['id'])
 
+        session = self.Session()
         try:
-            session.add(db_object)
+            if previous is not None and self.incremental:
+                # The row is updated in place and its association rows are replaced
+                session.merge(db_object)
+                for table, (owner, owner_column, _, _) in LINK_TABLES.items():
+                    if owner is model:
+                        session.execute(table.delete().where(table.columns[owner_column] == item['id']))
+            else:
+                session.add(db_object)
+            session.flush()
+            for table, link_row in links:
+                session.execute(table.insert(), dict(zip([column.name for column in table.columns], link_row)))
             session.commit()
         except:
             session.rollback()
@@ -334,14 +327,45 @@ class DatabasePipeline(object):
         finally:
             session.close()
 
+        self.cache.add(model, row)
+        self.cache.remove_links(model, item['id'])
+        for table, link_row in links:
+            self.cache.add_link(table, link_row)
+        if self.incremental:
+            self.orbit_counts.apply(before, self.orbit_counts.contribution(model, item['id']))
+            if model is Measurement:
+                # Every measurement has its own most common orbit row
+                self.orbit_counts.touch(('measurement', row['name']))
+                if previous is not None:
+                    self.orbit_counts.touch(('measurement', previous['name']))
         return item
 
     def close_spider(self, spider):
+        if self.flush_task is not None and self.flush_task.running:
+            self.flush_task.stop()
+        if self.writer_thread is None:
+            return self.finish(spider)
+        # Everything queued before is written first, and the thread stops once the crawl is finished
+        _, done = self.writer_thread.submit(self.finish, spider)
+        return done.addBoth(self.stop_writer_thread)
+
+    def stop_writer_thread(self, result):
+        self.writer_thread.stop()
+        self.writer_thread = None
+        return result
+
+    def finish(self, spider):
+        if self.writer is not None:
+            self.writer.close()
+
         session = self.Session()
 
         try:
             # Process the orbit data to generate most common orbit data
-            self.compute_common_orbits(session)
+            if self.incremental:
+                self.update_common_orbits(session)
+            else:
+                self.compute_common_orbits(session)
             session.commit()
         except:
             session.rollback()
@@ -349,6 +373,23 @@ class DatabasePipeline(object):
         finally:
             session.close()
 
+        if self.staging_schema is not None:
+            # The views are built with the staged tables and swapped in with them
+            staging.create_indexes(self.write_engine, self.staging_schema)
+            staging.swap(self.engine, self.staging_schema, spider.settings.get('DATABASE_SCHEMA', 'public'),
+                         spider.settings.get('DATABASE_RETIRED_SCHEMA', 'ceos_retired'))
+        elif spider.settings.getbool('DATABASE_REFRESH_VIEWS', True):
+            views.refresh(self.engine, concurrently=spider.settings.getbool('DATABASE_REFRESH_CONCURRENTLY', True))
+
+        if spider.settings.getbool('DATABASE_HISTORY', True):
+            if not crawl_complete(self.crawler, self.stats, spider, 'database/write_errors'):
+                # Everything the crawl did not get to would be recorded as deleted
+                logger.warning('The crawl was interrupted or had errors, the history is not recorded')
+                return
+            # New versions of the missions, instruments and association rows that changed in this crawl
+            with self.engine.begin() as connection:
+                history.record(connection, self.crawl_time)
+
 
 class GraphPipeline(object):
     """Neo4J pipeline for storing scraped items in a graph database"""
@@ -365,44 +406,188 @@ class GraphPipeline(object):
         #password = os.environ.get("NEO4J_PASSWORD", 'ceosdb_scraper')
         #uri = f"neo4j://{host}:{port}"
         self.driver = GraphDatabase.driver(uri, auth=(user, password))
+        self.writer = None
+        self.flush_task = None
+        self.replace = False
+        self.pool = None
+        self.stats = None
+        self.generation = None
+        self.collecting = None
+        self.delete_batch_size = 10000
+        self.relationship_buffer = None
+        self.reverse = True
+        self.crawler = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = cls()
+        pipeline.crawler = crawler
+        pipeline.stats = crawler.stats
+        return pipeline
 
     def open_spider(self, spider):
-        with self.driver.session() as session:
-            summary = session.write_transaction(cypher_tx.delete_all_graph)
-            print(summary.counters)
+        self.delete_batch_size = spider.settings.getint('GRAPH_DELETE_BATCH_SIZE', 10000)
+        self.reverse = spider.settings.get('GRAPH_RELATIONSHIP_LAYOUT', 'both') != 'single'
+        if spider.settings.getbool('GRAPH_GENERATIONS', False):
+            # The crawl writes a new generation, and the readers keep using the current one until it is complete
+            with self.driver.session() as session:
+                current, self.generation = session.write_transaction(cypher_tx.start_generation)
+            with self.driver.session() as session:
+                session.write_transaction(cypher_tx.create_generation_indexes)
+            logger.info('Writing graph generation %d', self.generation)
+            # Generations left over by interrupted crawls are deleted in the background
+            self.collecting = threads.deferToThread(delete_in_batches, self.driver, self.delete_batch_size,
+                                                    [current, self.generation])
+            self.collecting.addErrback(lambda failure: logger.error('Error deleting old graph generations',
+                                                                    exc_info=failure_to_exc_info(failure)))
+        else:
+            # Without the wipe, the nodes written again replace the ones from the previous crawls
+            self.replace = not spider.settings.getbool('GRAPH_WIPE', True)
+            if self.replace:
+                with self.driver.session() as session:
+                    generations = session.read_transaction(cypher_tx.has_generations)
+                if generations:
+                    # The ids of a graph written in generations are not unique, so it cannot be updated in place
+                    logger.warning('The graph was written in generations, it is wiped instead of updated in place')
+                    self.replace = False
+            if not self.replace:
+                delete_in_batches(self.driver, self.delete_batch_size)
+            with self.driver.session() as session:
+                session.write_transaction(cypher_tx.create_constraints)
+        if spider.settings.getint('GRAPH_WRITERS', 0) > 0:
+            self.pool = GraphWriterPool(self.driver, spider.settings.getint('GRAPH_WRITERS'),
+                                        spider.settings.getint('GRAPH_WRITER_QUEUE_SIZE', 1000),
+                                        spider.settings.getint('GRAPH_WRITER_RETRIES', 5),
+                                        spider.settings.getfloat('GRAPH_WRITER_BACKOFF', 0.5))
+        if spider.settings.getbool('GRAPH_DEFER_RELATIONSHIPS', True):
+            self.relationship_buffer = RelationshipBuffer(self.driver, spider.settings.getint('GRAPH_BATCH_SIZE', 1000),
+                                                          self.pool, self.generation, self.reverse)
+        if spider.settings.get('GRAPH_WRITE_MODE', 'item') == 'batch':
+            self.writer = GraphBatchWriter(self.driver, spider.settings.getint('GRAPH_BATCH_SIZE', 1000), self.replace,
+                                           self.pool, self.generation, self.relationship_buffer, self.reverse)
+            self.flush_task = task.LoopingCall(self.flush)
+            self.flush_task.start(spider.settings.getfloat('GRAPH_FLUSH_INTERVAL', 5.0), now=False)
+
+    def flush(self):
+        flushed = self.writer.flush()
+        if flushed is not None:
+            flushed.addErrback(self.write_failed, None, None)
+
+    def write_failed(self, failure, item, spider):
+        if item is None:
+            logger.error('Error writing a batch to the graph', exc_info=failure_to_exc_info(failure))
+        else:
+            logger.error('Error writing %s to the graph', item, exc_info=failure_to_exc_info(failure),
+                         extra={'spider': spider})
+        if self.stats is not None:
+            self.stats.inc_value('graph/write_errors', spider=spider)
 
+    @timed_pipeline
     def process_item(self, item, spider):
         """Save items in the database.
 
         This method is called for every item pipeline component.
 
         """
-        with self.driver.session() as session:
-            if isinstance(item, items.BroadMeasurementCategory):
-                summary = session.write_transaction(cypher_tx.add_broad_observable_property_category, item)
-            elif isinstance(item, items.MeasurementCategory):
-                summary = session.write_transaction(cypher_tx.add_observable_property_category, item)
-            elif isinstance(item, items.Measurement):
-                summary = session.write_transaction(cypher_tx.add_observable_property, item)
-            elif isinstance(item, items.Agency):
-                summary = session.write_transaction(cypher_tx.add_agency, item)
-            elif isinstance(item, items.Mission):
-                summary = session.write_transaction(cypher_tx.add_platform, item)
-            elif isinstance(item, items.Instrument):
-                summary = session.write_transaction(cypher_tx.add_sensor, item)
-            else:
-                summary = None
-
-            if summary is not None:
-                print(summary.counters)
-            return item
+        if self.writer is not None:
+            # On the pool, the item waits for the batch it fills to be written
+            flushed = self.writer.add(item)
+            if flushed is not None:
+                return flushed.addCallback(lambda _: item)
+        elif type(item) in cypher_tx.NODES:
+            label, _ = cypher_tx.NODES[type(item)]
+            function, args = cypher_tx.add_item, (item, self.replace, self.generation, self.reverse)
+            if self.relationship_buffer is not None:
+                # Only the node is written now, and its relationships once every node is in the graph
+                _, node, relationships = cypher_tx.item_rows(item)
+                self.relationship_buffer.add(relationships)
+                function, args = cypher_tx.add_batch, ({label: [node]}, {}, self.replace, self.generation)
+            if self.pool is not None:
+                # The item is passed on once its transaction is queued on the worker of its node
+                queued, done = self.pool.submit((label, item['id']), function, *args)
+                done.addErrback(self.write_failed, item, spider)
+                return queued.addCallback(lambda _: item)
+            with self.driver.session() as session:
+                session.write_transaction(function, *args)
+        return item
 
     def close_spider(self, spider):
+        if self.flush_task is not None and self.flush_task.running:
+            self.flush_task.stop()
+        if self.pool is None:
+            if self.writer is not None:
+                self.writer.close()
+            if self.relationship_buffer is not None:
+                self.relationships_written(self.relationship_buffer.write(), spider)
+            return self.finish(spider)
+        # The last batch is written once the transactions still running have finished
+        drained = self.pool.drain()
+        if self.writer is not None:
+            drained.addCallback(lambda _: self.writer.close())
+        if self.relationship_buffer is not None:
+            drained.addCallback(lambda _: self.relationship_buffer.write())
+            drained.addCallback(self.relationships_written, spider)
+        return drained.addCallback(lambda _: self.finish(spider)).addBoth(self.stop_pool)
+
+    def relationships_written(self, dangling, spider):
+        total = sum(dangling.values())
+        if self.stats is not None:
+            self.stats.set_value('graph/dangling_relationships', total, spider=spider)
+        if total:
+            logger.warning('Dropped %d relationships to nodes that are not in the graph: %s', total,
+                           ', '.join('%d %s-[%s]->%s' % (count, relationship.start, relationship.type, relationship.end)
+                                     for relationship, count in dangling.items() if count))
+
+    def stop_pool(self, result):
+        self.pool.stop()
+        self.pool = None
+        return result
+
+    def finish(self, spider):
         with self.driver.session() as session:
             pass
             # Process the orbit data to generate most common orbit data
             # self.compute_common_orbits(session)
 
+        if self.generation is not None:
+            if not crawl_complete(self.crawler, self.stats, spider, 'graph/write_errors'):
+                # The readers stay on the current generation, and the next crawl deletes this one
+                logger.warning('The crawl was interrupted or had errors, the graph stays on its current generation')
+                return None
+            return self.collecting.addCallback(lambda _: self.switch_generation())
+
+    def switch_generation(self):
+        with self.driver.session() as session:
+            session.write_transaction(cypher_tx.switch_generation, self.generation)
+        logger.info('Switched the graph to generation %d', self.generation)
+        # The generation the readers used until now is deleted in the background once they have moved on. If the
+        # process stops first, the next crawl deletes it
+        collecting = threads.deferToThread(delete_in_batches, self.driver, self.delete_batch_size, [self.generation])
+        collecting.addErrback(lambda failure: logger.error('Error deleting old graph generations',
+                                                           exc_info=failure_to_exc_info(failure)))
+
+
+class GraphExportPipeline(object):
+    """Pipeline for exporting scraped items to CSV files for neo4j-admin import"""
+
+    def __init__(self):
+        self.exporter = None
+
+    def open_spider(self, spider):
+        self.exporter = GraphCsvExporter(spider.settings.get('GRAPH_EXPORT_DIR', 'neo4j-import'),
+                                         spider.settings.get('GRAPH_RELATIONSHIP_LAYOUT', 'both') != 'single')
+        self.exporter.open()
+
+    @timed_pipeline
+    def process_item(self, item, spider):
+        self.exporter.add(item)
+        return item
+
+    def close_spider(self, spider):
+        self.exporter.close()
+        logger.info('Exported the graph, import it with: %s',
+                    self.exporter.import_command(spider.settings.get('GRAPH_EXPORT_DATABASE', 'neo4j')))
+
 
 class OntologyPipeline(object):
     """Ontology pipeline for storing scraped items in an ontology"""
@@ -423,6 +608,7 @@ class OntologyPipeline(object):
         self.g.add((CEOSDB_schema.measurementCategoryClass, RDFS.subClassOf, OWL.Thing))
         self.g.add((CEOSDB_schema.measurementClass, RDFS.subClassOf, OWL.Thing))
 
+    @timed_pipeline
     def process_item(self, item, spider):
         """Save items in the database.
 
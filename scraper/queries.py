@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+# Read-only queries over the materialized views (see scraper/views.py)
+#
+# Every function takes a SQLAlchemy session or connection and returns the rows of a single view query. The views are as
+# fresh as the last crawl.
+
+from sqlalchemy import func, select
+
+from scraper.views import instrument_measurement_orbits, agency_missions, technology_instruments
+
+# Instrument statuses counted as active by active_instruments_by_technology
+ACTIVE_STATUSES = ('Operational', 'Currently being flown')
+
+
+def instruments_by_measurement(session, measurement):
+    """Instruments that take a measurement, one row per mission they fly on with the orbit of the mission"""
+    view = instrument_measurement_orbits
+    return session.execute(select(view).where(view.c.measurement_name == measurement)
+                           .order_by(view.c.instrument_name, view.c.mission_name)).all()
+
+
+def measurement_orbits(session, measurement):
+    """Number of instruments taking a measurement per orbit type, inclination, local solar time and altitude class"""
+    view = instrument_measurement_orbits
+    classes = (view.c.orbit_type, view.c.orbit_inclination_class, view.c.orbit_lst_class, view.c.orbit_altitude_class)
+    return session.execute(select(*classes, func.count(view.c.instrument_id.distinct()).label('instrument_count'))
+                           .where(view.c.measurement_name == measurement)
+                           .group_by(*classes).order_by(func.count(view.c.instrument_id.distinct()).desc())).all()
+
+
+def agency_rollup(session, agency=None):
+    """Missions of every agency, or of the agency with the given name, with the instruments they host"""
+    view = agency_missions
+    query = select(view).order_by(view.c.agency_name, view.c.mission_name)
+    if agency is not None:
+        query = query.where(view.c.agency_name == agency)
+    return session.execute(query).all()
+
+
+def agency_totals(session):
+    """Number of missions and hosted instruments of every agency"""
+    view = agency_missions
+    return session.execute(select(view.c.agency_id, view.c.agency_name,
+                                  func.count(view.c.mission_id).label('mission_count'),
+                                  func.sum(view.c.instrument_count).label('instrument_count'))
+                           .group_by(view.c.agency_id, view.c.agency_name).order_by(view.c.agency_name)).all()
+
+
+def active_instruments_by_technology(session, statuses=ACTIVE_STATUSES):
+    """Number of instruments of every technology with one of the given statuses. Instruments with no technology are
+    counted under ''"""
+    view = technology_instruments
+    return session.execute(select(view.c.technology, func.sum(view.c.instrument_count).label('instrument_count'))
+                           .where(view.c.status.in_(statuses))
+                           .group_by(view.c.technology).order_by(view.c.technology)).all()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+# Order-independent resolution of the links between instruments and the missions/measurements they reference
+#
+# Instrument pages can be parsed before the pages of the missions and measurements they link to. Instead of dropping
+# those links, the registry holds each instrument until every mission it references has been seen (or found missing)
+# and every measurement it references has been seen, and releases whatever is left when the crawl ends.
+
+
+class EntityRegistry(object):
+    """Set-based registry of the seen missions and measurements, holding back the instruments that reference unknowns"""
+
+    def __init__(self):
+        self.seen = {'mission': set(), 'measurement': set()}
+        self.missing = {'mission': set(), 'measurement': set()}
+        # (kind, id) -> instruments waiting for it
+        self.waiting = {}
+        # id(instrument) -> number of references of the instrument that are still unknown
+        self.unresolved = {}
+        # id(instrument) -> instrument, in arrival order
+        self.pending = {}
+
+    def is_known(self, kind, entity_id):
+        return entity_id in self.seen[kind] or entity_id in self.missing[kind]
+
+    def add_instrument(self, instrument):
+        """Registers an instrument and returns the instruments that are ready, i.e. [instrument] or []"""
+        unknown = set(('mission', mission_id) for mission_id in instrument['missions']
+                      if not self.is_known('mission', mission_id))
+        unknown.update(('measurement', m_id) for m_id in instrument['measurements']
+                       if not self.is_known('measurement', m_id))
+        if not unknown:
+            return [instrument]
+        for key in unknown:
+            self.waiting.setdefault(key, []).append(instrument)
+        self.unresolved[id(instrument)] = len(unknown)
+        self.pending[id(instrument)] = instrument
+        return []
+
+    def see(self, kind, entity_id):
+        """Marks an entity as existing and returns the instruments this made ready"""
+        self.seen[kind].add(entity_id)
+        return self._resolve(kind, entity_id)
+
+    def miss(self, kind, entity_id):
+        """Marks an entity as not existing and returns the instruments this made ready"""
+        if entity_id in self.seen[kind]:
+            return []
+        self.missing[kind].add(entity_id)
+        return self._resolve(kind, entity_id)
+
+    def flush(self):
+        """Returns the instruments still waiting, in arrival order, and forgets them"""
+        pending = list(self.pending.values())
+        self.waiting = {}
+        self.unresolved = {}
+        self.pending = {}
+        return pending
+
+    def _resolve(self, kind, entity_id):
+        ready = []
+        for instrument in self.waiting.pop((kind, entity_id), []):
+            self.unresolved[id(instrument)] -= 1
+            if self.unresolved[id(instrument)] == 0:
+                del self.unresolved[id(instrument)]
+                del self.pending[id(instrument)]
+                ready.append(instrument)
+        return ready
@@ -26,6 +26,24 @@ ROBOTSTXT_OBEY = True
 # Configure maximum concurrent requests performed by Scrapy (default: 16)
 CONCURRENT_REQUESTS = 16
 
+# How the agency, mission and instrument summary pages are found:
+#   'range' requests the fixed ID ranges hard-coded in the spider
+#   'probe' walks each ID space while hits keep coming and gallops past gaps to find new IDs
+#   'listing' pages through the mission and instrument listings (agencies are probed)
+#   'listing_only' only pages through the listings and reports new IDs, without fetching any summary page
+DISCOVERY_MODE = 'range'
+# Where 'listing_only' stores the IDs it found, to tell the new ones apart on the next run
+LISTING_OUTPUT = 'listing.json'
+# Run of consecutive misses after the highest known ID that ends the linear walk in 'probe' mode
+DISCOVERY_MAX_MISSES = 50
+# Number of IDs requested up front for each entity type in 'probe' mode
+DISCOVERY_INITIAL_WINDOW = 100
+# Number of exponentially spaced probes sent past the frontier in each gallop round
+DISCOVERY_GALLOP_STEPS = 4
+
+# Number of worker processes the mission and instrument pages are parsed in (0 parses them in the reactor thread)
+PARSE_WORKERS = 0
+
 # Configure a delay for requests for the same website (default: 0)
 # See http://scrapy.readthedocs.org/en/latest/topics/settings.html#download-delay
 # See also autothrottle settings and docs
@@ -51,24 +69,59 @@ CONCURRENT_REQUESTS = 16
 #SPIDER_MIDDLEWARES = {
 #    'scraper.middlewares.ScraperSpiderMiddleware': 543,
 #}
+SPIDER_MIDDLEWARES = {
+    # Right next to the spider so that only the callbacks themselves are timed
+    'scraper.middlewares.TelemetrySpiderMiddleware': 950,
+}
 
 # Enable or disable downloader middlewares
 # See http://scrapy.readthedocs.org/en/latest/topics/downloader-middleware.html
 #DOWNLOADER_MIDDLEWARES = {
 #    'scraper.middlewares.MyCustomDownloaderMiddleware': 543,
 #}
+DOWNLOADER_MIDDLEWARES = {
+    # Below HttpCompressionMiddleware (590) so that bodies are stored decompressed
+    'scraper.middlewares.ConditionalCacheMiddleware': 580,
+    # Below ConditionalCacheMiddleware so that revalidated pages are recorded in full
+    'scraper.middlewares.ArchiveMiddleware': 575,
+}
+
+# Persistent conditional-request cache for recrawls (see ConditionalCacheMiddleware)
+CONDITIONAL_CACHE_ENABLED = False
+CONDITIONAL_CACHE_PATH = 'httpcache/conditional_cache.sqlite'
+# Serve cached pages younger than this many seconds without revalidating them (0 always revalidates)
+CONDITIONAL_CACHE_MAX_AGE = 0
+# Writes to the cache between commits, which is at most what a crawl that crashes or is killed loses
+CONDITIONAL_CACHE_COMMIT_EVERY = 100
+
+# Raw response archive (see ArchiveMiddleware): 'record' appends every response to ARCHIVE_DIR, 'replay' runs the
+# spider and the pipelines from ARCHIVE_DIR without touching the network, None disables it
+ARCHIVE_MODE = None
+ARCHIVE_DIR = 'archive'
+ARCHIVE_SEGMENT_SIZE = 64 * 1024 * 1024
 
 # Enable or disable extensions
 # See http://scrapy.readthedocs.org/en/latest/topics/extensions.html
 #EXTENSIONS = {
 #    'scrapy.extensions.telnet.TelnetConsole': None,
 #}
+EXTENSIONS = {
+    'scraper.extensions.CrawlTelemetry': 500,
+}
+
+# Crawl throughput telemetry (see CrawlTelemetry); debug output of the spider and pipelines is only logged with
+# LOG_LEVEL = 'DEBUG'
+TELEMETRY_ENABLED = False
+TELEMETRY_PROMETHEUS_PATH = 'telemetry/metrics.prom'
+TELEMETRY_SUMMARY_PATH = 'telemetry/summary.json'
+TELEMETRY_INTERVAL = 15.0
 
 # Configure item pipelines
 # See http://scrapy.readthedocs.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
 #    'scraper.pipelines.DatabasePipeline': 300,
     'scraper.pipelines.GraphPipeline': 400,
+#    'scraper.pipelines.GraphExportPipeline': 450,
 #    'scraper.pipelines.OntologyPipeline': 500,
 }
 
@@ -102,4 +155,78 @@ ITEM_PIPELINES = {
 #     'database': 'daphne'
 # }
 
+# How DatabasePipeline writes the items: 'orm' commits every item through the ORM, 'bulk' buffers them and writes
+# them in batches with COPY and execute_values (see scraper.bulk)
+DATABASE_WRITE_MODE = 'orm'
+# Number of buffered items that triggers a flush in 'bulk' mode
+DATABASE_BATCH_SIZE = 1000
+# Seconds between time-triggered flushes in 'bulk' mode
+DATABASE_FLUSH_INTERVAL = 5.0
+# Write the items on a dedicated thread (see scraper/writer.py) instead of the reactor thread. Items wait for room
+# before being passed on once DATABASE_WRITER_QUEUE_SIZE of them are waiting to be written
+DATABASE_WRITER_THREAD = True
+DATABASE_WRITER_QUEUE_SIZE = 1000
+# How DatabasePipeline reloads the catalog: 'replace' deletes the live rows when the spider opens, 'staging' builds
+# the catalog in DATABASE_STAGING_SCHEMA and swaps it into DATABASE_SCHEMA in one transaction when the spider closes,
+# 'incremental' keeps the catalog and only rewrites the items that changed, updating the most common orbits they
+# affect (rows of items that are no longer scraped are kept)
+DATABASE_LOAD_MODE = 'replace'
+DATABASE_SCHEMA = 'public'
+DATABASE_STAGING_SCHEMA = 'ceos_staging'
+# Schema the replaced tables are moved to during the swap, dropped in the same transaction
+DATABASE_RETIRED_SCHEMA = 'ceos_retired'
+# Refresh the materialized views (see scraper/views.py) when the spider closes. Staging reloads build them instead.
+# Concurrent refreshes keep the views readable while they are rebuilt, at the cost of a slower refresh
+DATABASE_REFRESH_VIEWS = True
+DATABASE_REFRESH_CONCURRENTLY = True
+# Keep a versioned history of the missions, instruments and their association rows (see scraper/history.py). Only the
+# rows that changed since the previous crawl get a new version. Crawls that were interrupted or had errors are not
+# recorded, since the rows they missed would be recorded as deleted. Errors of the other pipelines (e.g. the graph) do
+# not count
+DATABASE_HISTORY = True
+
+# How GraphPipeline writes to Neo4j: 'item' writes every item in its own transaction, with one statement per node and
+# relationship, 'batch' buffers the nodes and relationships and writes every label and relationship type of a batch
+# with a single UNWIND statement, once GRAPH_BATCH_SIZE items are buffered, every GRAPH_FLUSH_INTERVAL seconds and when
+# the spider closes
+GRAPH_WRITE_MODE = 'item'
+GRAPH_BATCH_SIZE = 1000
+GRAPH_FLUSH_INTERVAL = 5.0
+# Delete the whole graph when the spider opens. Nodes are merged on their id (which has a uniqueness constraint on every
+# label), so without the wipe a crawl updates the nodes it writes again, replacing their relationships, and keeps the
+# others
+GRAPH_WIPE = True
+# Write the relationships once the spider closes and every node is in the graph, in transactions of GRAPH_BATCH_SIZE
+# rows, instead of along with their start node. Relationships to nodes that are written later are otherwise dropped.
+# The number of relationships to nodes that were never written is logged and kept in the graph/dangling_relationships
+# stat
+GRAPH_DEFER_RELATIONSHIPS = True
+# Relationships written to the graph and to the export: 'both' writes every relationship along with its reverse
+# (INCLUDES and TYPE_OF, BUILT_BY and BUILT, IS_HOSTED_BY and HOSTS), 'single' only the first one of each pair, which
+# halves the relationships. Queries for a reverse type then match the relationship against its direction, see
+# REVERSE_TYPES and relationship_pattern in scraper/cypher_tx.py. Changing the layout of an existing graph needs
+# GRAPH_WIPE or GRAPH_GENERATIONS
+GRAPH_RELATIONSHIP_LAYOUT = 'both'
+# Nodes deleted per transaction by the wipe and by the deletion of old generations, or 0 to delete them in a single
+# transaction
+GRAPH_DELETE_BATCH_SIZE = 10000
+# Write every crawl to a new generation of the graph instead of wiping it (see scraper/cypher_tx.py). Readers use the
+# nodes of the generation named by the GraphGeneration node, which only moves to the new generation once the crawl is
+# complete, and the previous generation is then deleted in batches. A crawl that was interrupted or had errors is not
+# switched to. GRAPH_WIPE does not apply, and a graph written in generations is always wiped by the crawls without them
+GRAPH_GENERATIONS = False
+# Number of worker threads writing to Neo4j, each with its own session, or 0 to write on the reactor thread. Items are
+# partitioned between the workers by node id, at most GRAPH_WRITER_QUEUE_SIZE transactions wait for a worker, and the
+# transactions that fail with a transient error are retried up to GRAPH_WRITER_RETRIES times with exponential backoff
+# starting at GRAPH_WRITER_BACKOFF seconds (in explicit transactions, so the driver does not retry them on its own too)
+GRAPH_WRITERS = 0
+GRAPH_WRITER_QUEUE_SIZE = 1000
+GRAPH_WRITER_RETRIES = 5
+GRAPH_WRITER_BACKOFF = 0.5
+
+# Directory GraphExportPipeline writes the node and relationship CSV files for neo4j-admin import to, and the database
+# the import command it logs when the spider closes loads them into
+GRAPH_EXPORT_DIR = 'neo4j-import'
+GRAPH_EXPORT_DATABASE = 'neo4j'
+
 LOG_LEVEL = 'INFO'
\ No newline at end of file
@@ -1,25 +1,22 @@
 # -*- coding: utf-8 -*-
 
-import datetime
+import collections
+import concurrent.futures
+import json
+import multiprocessing
+import os
 import re
 
-import dateparser
 import scrapy
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
 
+from scraper import dates, extract
+from scraper.discovery import IdProber
 from scraper.items import BroadMeasurementCategory, MeasurementCategory, Measurement, Agency, Mission, Instrument
-
-
-# Patch for gcos links in XML doc
-def remove_gcos_links(links):
-    new_links = []
-    remove_link = 'gcos.wmo.int'
-    for link in links:
-        if remove_link not in link:
-            new_links.append(link)
-    print("---> OLD LINKS", links)
-    print("---> NEW LINKS", new_links)
-    return new_links
-
+from scraper.registry import EntityRegistry
 
 
 class CEOSDBSpider(scrapy.Spider):
@@ -85,29 +82,163 @@ class CEOSDBSpider(scrapy.Spider):
                  ('N/A', '')
  ]
 
-    mission_ids = []
-    measurment_ids = []
+    # Summary page URL, callback name, request priority and brute force ID range of every entity type
+    summary_pages = {
+        'agency': ('http://database.eohandbook.com/database/agencysummary.aspx?agencyID=', 'parse_agency', 20, (1, 230)),
+        'mission': ('http://database.eohandbook.com/database/missionsummary.aspx?missionID=', 'parse_mission', 10,
+                    (0, 1450)),
+        'instrument': ('http://database.eohandbook.com/database/instrumentsummary.aspx?instrumentID=',
+                       'parse_instrument', 10, (0, 2108)),
+    }
+
+    def __init__(self, *args, **kwargs):
+        super(CEOSDBSpider, self).__init__(*args, **kwargs)
+        self.registry = EntityRegistry()
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(CEOSDBSpider, cls).from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider.spider_idle, signal=signals.spider_idle)
+        return spider
+
+    # Listing page URL and GridView ID of the entity types that have a listing
+    listing_pages = {
+        'mission': ('http://database.eohandbook.com/database/missiontable.aspx', 'MainContent_gvMissionTable'),
+        'instrument': ('http://database.eohandbook.com/database/instrumenttable.aspx', 'MainContent_gvInstrumentTable'),
+    }
 
     def start_requests(self):
-        yield scrapy.Request(url='http://database.eohandbook.com/measurements/overview.aspx',
-                             callback=self.prepare_broad_categories, priority=25)
+        # DISCOVERY_MODE selects how the agency, mission and instrument summary pages are found:
+        #   'range' brute forces the fixed ID ranges in summary_pages
+        #   'probe' finds the live ID range of each entity type on its own
+        #   'listing' walks every page of the mission and instrument listings (agencies have no listing, so they are
+        #   probed)
+        #   'listing_only' only walks the listings and reports the IDs found, without fetching any summary page
+        mode = self.settings.get('DISCOVERY_MODE', 'range')
+        workers = self.settings.getint('PARSE_WORKERS', 0)
+        # The workers are started from a fork server, since forking the crawler process once the reactor and the
+        # pipelines have started their threads could copy locks that another thread holds
+        self.parse_pool = None
+        if workers > 0:
+            self.parse_pool = concurrent.futures.ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context('forkserver'))
+        # Date parsing counters of the worker processes
+        self.worker_date_counters = collections.Counter()
+        self.listed_ids = {'mission': set(), 'instrument': set()}
+
+        if mode != 'listing_only':
+            yield scrapy.Request(url='http://database.eohandbook.com/measurements/overview.aspx',
+                                 callback=self.prepare_broad_categories, priority=25)
+
+        if mode in ('probe', 'listing'):
+            self.probers = {}
+            for kind in ('agency', 'mission', 'instrument') if mode == 'probe' else ('agency',):
+                self.probers[kind] = IdProber(
+                    kind, self.summary_request_factory(kind, probe=True), start=self.summary_pages[kind][3][0],
+                    initial_window=self.settings.getint('DISCOVERY_INITIAL_WINDOW', 100),
+                    max_misses=self.settings.getint('DISCOVERY_MAX_MISSES', 50),
+                    gallop_steps=self.settings.getint('DISCOVERY_GALLOP_STEPS', 4))
+                for request in self.probers[kind].start_requests():
+                    yield request
+            if mode == 'probe':
+                return
+
+        if mode in ('listing', 'listing_only'):
+            yield scrapy.Request(url=self.listing_pages['mission'][0], callback=self.prepare_missions, priority=15)
+            yield scrapy.Request(url=self.listing_pages['instrument'][0], callback=self.prepare_instruments,
+                                 priority=15)
+            return
+
         # For agencies, do brute force requests as there is not a comprehensive list of them
-        for i in range(1, 230):
-            yield scrapy.Request(url='http://database.eohandbook.com/database/agencysummary.aspx?agencyID=' + str(i),
-                                 callback=self.parse_agency, priority=20)
-        
-        # TODO: the update to the CEOS database website seems to have broken the ddlDisplayResults being set to "All", so the commented-out code below
-        #       only works for the first 10 missions/instruments. I think this is solvable but I tried for several hours with no luck.
-        # yield scrapy.Request(url='http://database.eohandbook.com/database/missiontable.aspx',
-        #                      callback=self.prepare_missions, priority=15)
-        # yield scrapy.Request(url='http://database.eohandbook.com/database/missiontable.aspx',
-        #                      callback=self.prepare_instruments, priority=15)
-        for i in range(0,1450):
-            yield scrapy.Request(url='http://database.eohandbook.com/database/missionsummary.aspx?missionID='+str(i),
-                                callback=self.parse_mission, priority=10)
-        for i in range(0,2108):
-            yield scrapy.Request(url='http://database.eohandbook.com/database/instrumentsummary.aspx?instrumentID='+str(i),
-                                callback=self.parse_instrument, priority=10)
+        agency_request = self.summary_request_factory('agency')
+        for i in range(*self.summary_pages['agency'][3]):
+            yield agency_request(i)
+
+        mission_request = self.summary_request_factory('mission')
+        for i in range(*self.summary_pages['mission'][3]):
+            yield mission_request(i)
+        instrument_request = self.summary_request_factory('instrument')
+        for i in range(*self.summary_pages['instrument'][3]):
+            yield instrument_request(i)
+
+    def extract(self, response, extractor, *args):
+        """Runs one of the extract.extract_* functions on a response.
+
+        With PARSE_WORKERS > 0 the page is parsed in a worker process and a Deferred firing with the fields is
+        returned, otherwise the fields themselves.
+        """
+        if self.parse_pool is None:
+            return extractor(response.selector.root, response.url, *args)
+        future = self.parse_pool.submit(extract.extract_page, extractor, response.text, response.url, *args)
+        d = defer.Deferred()
+
+        def done(future):
+            if future.exception() is not None:
+                reactor.callFromThread(d.errback, Failure(future.exception()))
+            else:
+                reactor.callFromThread(parsed, *future.result())
+
+        def parsed(values, date_counters):
+            self.worker_date_counters.update(date_counters)
+            d.callback(values)
+        future.add_done_callback(done)
+        return d
+
+    def summary_request_factory(self, kind, probe=False):
+        url, callback, priority, _ = self.summary_pages[kind]
+
+        def make_request(entity_id):
+            if probe:
+                return scrapy.Request(url=url + str(entity_id), callback=getattr(self, callback), priority=priority,
+                                      errback=self.probe_failed, meta={'probe': (kind, entity_id)})
+            return scrapy.Request(url=url + str(entity_id), callback=getattr(self, callback), priority=priority)
+        return make_request
+
+    def count_summary_page(self, kind, error):
+        self.crawler.stats.inc_value('ceosdb/summary_pages/%s' % kind)
+        if error:
+            self.crawler.stats.inc_value('ceosdb/pnl_errors/%s' % kind)
+
+    def probe_result(self, response, hit):
+        """Feeds the outcome of a summary page back to its prober and returns the follow-up requests"""
+        if 'probe' not in response.meta:
+            return []
+        kind, entity_id = response.meta['probe']
+        return self.probers[kind].record(entity_id, hit)
+
+    def probe_failed(self, failure):
+        # HTTP errors count as misses so that the walk keeps going
+        if 'probe' in failure.request.meta:
+            kind, entity_id = failure.request.meta['probe']
+            for request in self.probers[kind].record(entity_id, False):
+                yield request
+            if kind == 'mission':
+                for item in self.resolved_instrument_items(self.registry.miss('mission', entity_id)):
+                    yield item
+
+    def closed(self, reason):
+        if getattr(self, 'parse_pool', None) is not None:
+            self.parse_pool.shutdown()
+        for prober in getattr(self, 'probers', {}).values():
+            self.logger.info('ID discovery: %s', prober.summary())
+        date_counters = collections.Counter(dates.counters())
+        date_counters.update(getattr(self, 'worker_date_counters', {}))
+        self.logger.info('Date parsing: %s', dict(date_counters))
+        if self.settings.get('DISCOVERY_MODE', 'range') == 'listing_only':
+            self.report_listing()
+
+    def report_listing(self):
+        """Logs the IDs that are new since the previous listing and stores the current one for the next run"""
+        output = self.settings.get('LISTING_OUTPUT', 'listing.json')
+        previous = {}
+        if os.path.exists(output):
+            with open(output) as listing_file:
+                previous = json.load(listing_file)
+        for kind, ids in self.listed_ids.items():
+            new_ids = sorted(ids - set(previous.get(kind, [])))
+            self.logger.info('Listing: %d %ss, %d new: %s', len(ids), kind, len(new_ids), new_ids)
+        with open(output, 'w') as listing_file:
+            json.dump({kind: sorted(ids) for kind, ids in self.listed_ids.items()}, listing_file)
 
     def parse(self, response):
         TITLE_SELECTOR = 'title ::text'
@@ -136,7 +267,7 @@ class CEOSDBSpider(scrapy.Spider):
         description = response.xpath('//*[@id="MainContent_pnlNominal"]/tr[2]/td/table/tr/td/table/tr[1]/td[2]/text()')\
             .extract_first().strip()
 
-        print('Broad category:', bc_id, name, description)
+        self.logger.debug('Broad category: %s %s %s', bc_id, name, description)
         yield BroadMeasurementCategory(id=bc_id, name=name, description=description)
 
         categories = response.xpath('//*[@id="MainContent_pnlNominal"]/tr[2]/td/table/tr/td/table/tr[2]/td/table/tr/td[1]/a/@href') \
@@ -153,7 +284,7 @@ class CEOSDBSpider(scrapy.Spider):
         broad_category_id = response.xpath('//*[@id="MainContent_pnlNominal"]/tr[2]/td/table/tr/td/table/tr[1]/td[1]/b/a[2]/@href') \
                                     .extract_first().strip().split('=')[-1]
 
-        print('Category:', c_id, name, description, broad_category_id)
+        self.logger.debug('Category: %s %s %s %s', c_id, name, description, broad_category_id)
         yield MeasurementCategory(id=c_id, name=name, description=description,
                                   broad_measurement_category_id=broad_category_id)
 
@@ -162,9 +293,10 @@ class CEOSDBSpider(scrapy.Spider):
             m_id = int(measurement_row.xpath('td[1]/a/@href').extract_first().strip().split('=', 1)[-1])
             m_name = measurement_row.xpath('td[1]/a/b/text()').extract_first().strip()
             m_description = measurement_row.xpath('td[2]/text()').extract_first().strip()
-            print('Measurement:', m_id, m_name, m_description, c_id)
-            self.measurment_ids.append(m_id)
+            self.logger.debug('Measurement: %s %s %s %s', m_id, m_name, m_description, c_id)
             yield Measurement(id=m_id, name=m_name, description=m_description, measurement_category_id=c_id)
+            for item in self.resolved_instrument_items(self.registry.see('measurement', m_id)):
+                yield item
 
 
     def parse_agency(self, response):
@@ -173,310 +305,138 @@ class CEOSDBSpider(scrapy.Spider):
         country = response.xpath('//*[@id="MainContent_lblAgencyCountry"]/text()').extract_first(default='').strip()
         website = response.xpath('//*[@id="MainContent_lblAgencyURL"]/a/@href').extract_first(default='').strip()
         if agency:
-            print('Agency:', agency, agency_id, country, website)
+            self.logger.debug('Agency: %s %s %s %s', agency, agency_id, country, website)
             yield Agency(id=agency_id, name=agency, country=country, website=website)
+        self.count_summary_page('agency', not agency)
+        for request in self.probe_result(response, bool(agency)):
+            yield request
+
+    def prepare_listing(self, response, kind):
+        """Posts the listing filter form with every filter reset and the largest page size on offer"""
+        # The form fields are named after the ASP.NET control tree (ctl00$MainContent$...), not after the element IDs,
+        # so they are looked up in the page instead of hard-coding them
+        formdata = {}
+        for select in response.xpath('//select[starts-with(@id, "MainContent_ddl")]'):
+            values = select.xpath('option/@value').extract()
+            labels = [label.strip() for label in select.xpath('option/text()').extract()]
+            if 'All' in labels:
+                formdata[select.xpath('@name').extract_first()] = values[labels.index('All')]
+            elif select.xpath('@id').extract_first() == 'MainContent_ddlDisplayResults':
+                sizes = [value for value in values if value.isdigit()]
+                if sizes:
+                    formdata[select.xpath('@name').extract_first()] = max(sizes, key=int)
+        for text_box in response.xpath('//input[@type="text"][starts-with(@id, "MainContent_tb")]/@name').extract():
+            formdata[text_box] = ''
+        yield scrapy.FormRequest.from_response(response, formdata=formdata,
+                                               clickdata={'id': 'MainContent_btFilter'},
+                                               callback=self.parse_listing, cb_kwargs={'kind': kind, 'page': 1},
+                                               priority=15, dont_filter=True)
+
+    def parse_listing(self, response, kind, page=1):
+        """Yields the summary page of every row in a listing page and posts back for the next page"""
+        table_id = self.listing_pages[kind][1]
+        for link in response.xpath('//table[@id="%s"]/tr/td[1]/b/a/@href' % table_id).extract():
+            entity_id = int(link.strip().split('=', 1)[-1])
+            if entity_id in self.listed_ids[kind]:
+                continue
+            self.listed_ids[kind].add(entity_id)
+            if self.settings.get('DISCOVERY_MODE', 'range') != 'listing_only':
+                yield self.summary_request_factory(kind)(entity_id)
+
+        # GridView pager links look like javascript:__doPostBack('ctl00$MainContent$gvMissionTable','Page$2'), and the
+        # '...' link to the next block of pages uses the same argument format
+        postbacks = {}
+        for href in response.xpath('//table[@id="%s"]//a/@href' % table_id).extract():
+            match = re.search(r"__doPostBack\('([^']+)','Page\$(\d+)'\)", href)
+            if match:
+                postbacks[int(match.group(2))] = match.group(1)
+        if page + 1 in postbacks:
+            yield scrapy.FormRequest.from_response(response, formdata={'__EVENTTARGET': postbacks[page + 1],
+                                                                       '__EVENTARGUMENT': 'Page$%d' % (page + 1)},
+                                                   dont_click=True, callback=self.parse_listing,
+                                                   cb_kwargs={'kind': kind, 'page': page + 1}, priority=15,
+                                                   dont_filter=True)
 
     def prepare_missions(self, response):
-        sel = scrapy.Selector(response)
-        viewstate = sel.xpath("//input[@id='__VIEWSTATE']/@value").extract().pop()
-        eventvalidation = sel.xpath("//input[@id='__EVENTVALIDATION']/@value").extract().pop()
-        data = {'__EVENTTARGET': '', '__EVENTARGUMENT': '', '__LASTFOCUS': '', '__VIEWSTATE': viewstate,
-                '__VIEWSTATEGENERATOR': 'ABD5AB5F', '__VIEWSTATEENCRYPTED': '', '__EVENTVALIDATION': eventvalidation,
-                'MainContent_ddlAgency': 'All', 'MainContent_ddlMissionStatus': 'All', 'MainContent_tbMission': '', 'MainContent_ddlLauchYearFilterType': 'All',
-                'MainContent_tbInstruments': '', 'MainContent_ddlEOLYearFilterType': 'All', 'MainContent_tbApplications': '', 'MainContent_ddlDisplayResults': 'All',
-                'MainContent_ddlRepeatCycleFilter': 'All', 'MainContent_btFilter': 'Apply+Filter'}
-        yield scrapy.FormRequest.from_response(response,
-                                 formdata=data, callback=self.parse_missions)
+        return self.prepare_listing(response, 'mission')
 
     def parse_missions(self, response):
-        TR_SELECTOR = '//*[@id="MainContent_gvMissionTable"]/tr'
-        for row in response.xpath(TR_SELECTOR)[1:]:
-            url = row.xpath('td[1]/b/a/@href').extract_first().strip()
-            yield scrapy.Request(url=response.urljoin(url), callback=self.parse_mission, priority=14)
+        return self.parse_listing(response, 'mission')
 
     def parse_mission(self, response):
+        self.count_summary_page('mission', "pnlError" in response.text)
+        requests = self.probe_result(response, "pnlError" not in response.text)
         if "pnlError" in response.text:
-            return
-        # Settings for date parsing
-        date_parsing_settings = {'RELATIVE_BASE': datetime.datetime(2020, 1, 1)}
-
-        # Basic mission information
-        mission_name = response.xpath('//*[@id="MainContent_lblMissionNameShort"]/text()').extract_first().strip()[2:]
-        mission_id = int(response.url.split('=', 1)[-1])
-        mission_fullname = response.xpath('//*[@id="MainContent_lblMissionNameFull"]/text()').extract_first(default='').strip()
-        if not mission_fullname:
-            mission_fullname = None
-        agency_ids = []
-        for agency_link in response.xpath('//*[@id="MainContent_lblMissionAgencies"]/a/@href').extract():
-            agency_id = int(agency_link.strip().split('=', 1)[-1])
-            if agency_id not in agency_ids:
-                agency_ids.append(agency_id)
-        status = response.xpath('//*[@id="MainContent_lblMissionStatus"]/text()').extract_first().strip()
-        launch_date = response.xpath('//*[@id="MainContent_lblLaunchDate"]/text()').extract_first()
-        if launch_date:
-            launch_date = dateparser.parse(launch_date.strip(), settings=date_parsing_settings)
-        eol_date = response.xpath('//*[@id="MainContent_lblEOLDate"]/text()').extract_first()
-        if eol_date:
-            eol_date = dateparser.parse(eol_date.strip(), settings=date_parsing_settings)
-        norad_id = response.xpath('//*[@id="MainContent_lblNoradNumberLink"]/a/text()').extract_first()
-        if norad_id is not None:
-            norad_id = int(norad_id)
-
-        applications = response.xpath('//*[@id="MainContent_lblMissionObjectivesAndApplications"]/text()').extract_first(default='').strip()
-
-        # Orbit details (if existing)
-        orbit_type = response.xpath('//*[@id="MainContent_lblOrbitType"]/text()').extract_first(default='').strip()
-        orbit_period = response.xpath('//*[@id="MainContent_lblOrbitPeriod"]/text()').extract_first(default='').strip()
-        orbit_sense = response.xpath('//*[@id="MainContent_lblOrbitSense"]/text()').extract_first(default='').strip()
-
-        orbit_inclination = response.xpath('//*[@id="MainContent_lblOrbitInclination"]/text()').extract_first(default='').strip()
-        if orbit_inclination == '':
-            orbit_inclination = None
-            orbit_inclination_num = None
-            orbit_inclination_class = None
-        else:
-            orbit_inclination_num = float(orbit_inclination[:-4])
-            if orbit_inclination_num == 0.0:
-                orbit_inclination_class = 'Equatorial'
-            elif orbit_inclination_num < 30.0:
-                orbit_inclination_class = 'Near Equatorial'
-            elif orbit_inclination_num < 60.0:
-                orbit_inclination_class = 'Mid Latitude'
-            elif orbit_inclination_num == 90.0:
-                orbit_inclination_class = 'Polar'
-            else:
-                orbit_inclination_class = 'Near Polar'
-
-        orbit_altitude = response.xpath('//*[@id="MainContent_lblOrbitAltitude"]/text()').extract_first(default='').strip()
-        if orbit_altitude == '':
-            orbit_altitude = None
-            orbit_altitude_num = None
-            orbit_altitude_class = None
-        else:
-            orbit_altitude_num = int(orbit_altitude[:-3])
-            if orbit_altitude_num < 400:
-                orbit_altitude_class = 'VL'
-            elif orbit_altitude_num < 550:
-                orbit_altitude_class = 'L'
-            elif orbit_altitude_num < 700:
-                orbit_altitude_class = 'M'
-            elif orbit_altitude_num < 850:
-                orbit_altitude_class = 'H'
-            else:
-                orbit_altitude_class = 'VH'
-
-        orbit_longitude = response.xpath('//*[@id="MainContent_lblOrbitLongitude"]/text()').extract_first(default='').strip()
-        orbit_LST = response.xpath('//*[@id="MainContent_lblOrbitLST"]/text()').extract_first(default='').strip()
-        if orbit_LST == '':
-            orbit_LST = None
-            orbit_LST_time = None
-            orbit_LST_class = None
-        else:
-            orbit_LST_time = dateparser.parse(orbit_LST)
-            if orbit_LST_time is not None:
-                orbit_LST_time = orbit_LST_time.time()
-                five_am = datetime.time(5)
-                seven_am = datetime.time(7)
-                five_pm = datetime.time(17)
-                seven_pm = datetime.time(19)
-                noon_am = datetime.time(11, 15)
-                noon_pm = datetime.time(12, 45)
-                time_for_class = orbit_LST_time
-                if time_for_class < five_am:
-                    time_for_class = (datetime.datetime.combine(datetime.date.today(), time_for_class) +
-                                      datetime.timedelta(hours=12)).time()
-                elif time_for_class > seven_pm:
-                    time_for_class = (datetime.datetime.combine(datetime.date.today(), time_for_class) -
-                                      datetime.timedelta(hours=12)).time()
-
-                orbit_LST_class = None
-                if time_for_class > five_am and time_for_class < seven_am:
-                    orbit_LST_class = 'DD'
-                elif time_for_class > five_pm and time_for_class < seven_pm:
-                    orbit_LST_class = 'DD'
-                elif time_for_class > noon_am and time_for_class < noon_pm:
-                    orbit_LST_class = 'Noon'
-                elif time_for_class > seven_am and time_for_class < noon_am:
-                    orbit_LST_class = 'AM'
-                elif time_for_class > noon_pm and time_for_class < five_pm:
-                    orbit_LST_class = 'PM'
-            else:
-                orbit_LST_time = None
-                orbit_LST_class = None
-
-
-        repeat_cycle = response.xpath('//*[@id="MainContent_lblRepeatCycle"]/text()').extract_first(default='').strip()
-        if repeat_cycle == '':
-            repeat_cycle = None
-            repeat_cycle_num = None
-            repeat_cycle_class = None
-        else:
-            repeat_cycle_num = float(repeat_cycle[:-5])
-            if repeat_cycle_num <= 7:
-                repeat_cycle_class = 'Short'
-            else:
-                repeat_cycle_class = 'Long'
-
+            return requests + self.resolved_instrument_items(
+                self.registry.miss('mission', int(response.url.split('=', 1)[-1])))
+        mission = self.extract(response, extract.extract_mission)
+        if isinstance(mission, defer.Deferred):
+            return mission.addCallback(self.mission_items, requests)
+        return self.mission_items(mission, requests)
+
+    def mission_items(self, mission, requests):
         # Debug information
-        print('Mission:', mission_name, mission_id, mission_fullname, agency_ids, status, launch_date, eol_date,
-              norad_id, applications, orbit_type, orbit_period, orbit_sense, orbit_inclination, orbit_inclination_num,
-              orbit_inclination_class, orbit_altitude, orbit_altitude_num, orbit_altitude_class, orbit_longitude,
-              orbit_LST, orbit_LST_time, orbit_LST_class, repeat_cycle, repeat_cycle_num, repeat_cycle_class)
-
-        # Save information for later
-        self.mission_ids.append(mission_id)
-
-        # Send mission information to pipelines
-        yield Mission(id=mission_id, name=mission_name, full_name=mission_fullname, agencies=agency_ids,
-                      status=status, launch_date=launch_date, eol_date=eol_date, norad_id=norad_id,
-                      applications=applications, orbit_type=orbit_type, orbit_period=orbit_period,
-                      orbit_sense=orbit_sense, orbit_inclination=orbit_inclination,
-                      orbit_inclination_num=orbit_inclination_num, orbit_inclination_class=orbit_inclination_class,
-                      orbit_altitude=orbit_altitude, orbit_altitude_num=orbit_altitude_num,
-                      orbit_altitude_class=orbit_altitude_class, orbit_longitude=orbit_longitude, orbit_LST=orbit_LST,
-                      orbit_LST_time=orbit_LST_time, orbit_LST_class=orbit_LST_class, repeat_cycle=repeat_cycle,
-                      repeat_cycle_num=repeat_cycle_num, repeat_cycle_class=repeat_cycle_class)
+        self.logger.debug('Mission: %s', mission)
+
+        # Send mission information to pipelines, followed by the instruments that were waiting for it
+        return requests + [Mission(**mission)] + self.resolved_instrument_items(self.registry.see('mission',
+                                                                                                  mission['id']))
 
     def prepare_instruments(self, response):
-        sel = scrapy.Selector(response)
-        viewstate = sel.xpath("//input[@id='__VIEWSTATE']/@value").extract().pop()
-        eventvalidation = sel.xpath("//input[@id='__EVENTVALIDATION']/@value").extract().pop()
-        data = {'__EVENTTARGET': '', '__EVENTARGUMENT': '', '__LASTFOCUS': '', '__VIEWSTATE': viewstate,
-                '__VIEWSTATEGENERATOR': 'F2417B6C', '__VIEWSTATEENCRYPTED': '', '__EVENTVALIDATION': eventvalidation,
-                'MainContent_ddlAgency': 'All', 'MainContent_ddlMissionStatus': 'All', 'MainContent_tbMission': '', 'MainContent_ddlInstrumentStatus': 'All',
-                'MainContent_tbInstrument': '', 'MainContent_ddlInstrumentType': 'All', 'MainContent_tbApplications': '',
-                'MainContent_ddlInstrumentTechnology': 'All', 'MainContent_ddlResolutionFilter': 'All', 'MainContent_ddlWaveband': 'All',
-                'MainContent_ddlDataAccess': 'All', 'MainContent_ddlDisplayResults': "3", 'MainContent_btFilter': 'Apply+Filter'}
-        yield scrapy.FormRequest.from_response(response,
-                                 formdata=data, dont_click=True, callback=self.parse_instruments)
+        return self.prepare_listing(response, 'instrument')
 
     def parse_instruments(self, response):
-        TR_SELECTOR = '//table[@id="MainContent_gvInstrumentTable"]/tr'
-        for row in response.xpath(TR_SELECTOR)[1:]:
-            url = row.xpath('td[1]/b/a/@href').extract_first().strip()
-            yield scrapy.Request(url=response.urljoin(url), callback=self.parse_instrument, priority=9)
+        return self.parse_listing(response, 'instrument')
 
     def parse_instrument(self, response):
-        # Basic instrument information
+        self.count_summary_page('instrument', "pnlError" in response.text)
+        requests = self.probe_result(response, "pnlError" not in response.text)
         if "pnlError" in response.text:
-            return
-        instrument_name = response.xpath('//*[@id="MainContent_lblInstrumentNameShort"]/text()').extract_first().strip()[2:]
-        instrument_id = int(response.url.split('=', 1)[-1])
-        instrument_fullname = response.xpath('//*[@id="MainContent_lblInstrumentNameFull"]/text()').extract_first(default='')
-        print('---> INSTRUMENT NAME ', instrument_name)
-        print('---> URL ', response.url)
-        if not instrument_fullname:
-            instrument_fullname = None
-        status = response.xpath('//*[@id="MainContent_lblInstrumentStatus"]/text()').extract_first().strip()
-        agency_ids = []
-        for agency_link in response.xpath('//*[@id="MainContent_lblInstrumentAgencies"]/a/@href').extract()[:-1]:
-            agency_id = int(agency_link.strip().split('=', 1)[-1])
-            if agency_id not in agency_ids:
-                agency_ids.append(agency_id)
-        maturity = response.xpath('//*[@id="MainContent_lblInstrumentMaturity"]/text()').extract_first(default='').strip()
-        types = []
-        types_texts = response.xpath('//*[@id="MainContent_lblInstrumentType"]/text()')
-        types_text = ''
-        for type_subtext in types_texts.extract():
-            types_text += ' ' + type_subtext.strip()
-        types_text = types_text.strip()
-        for type_template in self.instrument_types:
-            if type_template in types_text:
-                types.append(type_template)
-        geometry_text = response.xpath('//*[@id="MainContent_lblInstrumentGeometry"]/text()').extract_first(default='').strip()
-        geometries = []
-        for geometry_template in self.instrument_geometries:
-            if geometry_template in geometry_text:
-                geometries.append(geometry_template)
-        technology = response.xpath('//*[@id="MainContent_lblInstrumentTechnology"]/text()').extract_first(default='').strip()
-        if technology == '':
-            technology = None
-        sampling = response.xpath('//*[@id="MainContent_lblInstrumentSampling"]/text()').extract_first(default='').strip()
-        if sampling == '':
-            sampling = None
-        data_access = response.xpath('//*[@id="MainContent_lblDataAccess"]/text()').extract_first(default='').strip()
-        if data_access == '':
-            data_access = None
-        data_format = response.xpath('//*[@id="MainContent_lblDataFormat"]/text()').extract_first(default='').strip()
-        if data_format == '':
-            data_format = None
-
-        # Measurements summary
-        measurements_and_applications = \
-            response.xpath('//*[@id="MainContent_lblInstrumentMeasurementsApplications"]/text()').extract_first(default='').strip()
-
-        # Missions
-        missions = []
-        for mission_link in response.xpath('//*[@id="MainContent_pnlNominal"]/tr[1]/td/table/tr[18]/td[2]/table/tr/td/a/@href').extract():
-            mission_id = int(mission_link.strip().split('=', 1)[-1])
-            if mission_id not in missions and mission_id in self.mission_ids:
-                missions.append(mission_id)
-
-        # Measurements
-        measurements = []
-        accuracies = []
-        measurement_links = response.xpath('//*[@id="MainContent_pnlNominal"]/tr[1]/td/table/tr[16]/td[2]/table/tr/td[2]/a/@href')
-        extracted_measurement_links = remove_gcos_links(measurement_links.extract())
-        # for link in measurement_links.extract():
-        for link in extracted_measurement_links:
-            m_id = int(link.strip().split('=', 1)[-1])
-            if m_id not in self.measurment_ids:
-                m_name = response.xpath('//*[@id="MainContent_pnlNominal"]/tr[1]/td/table/tr[16]/td[2]/table/tr/td[2]/a/text()')\
-                    .extract_first().strip()
-                self.measurment_ids.append(m_id)
-                yield Measurement(id=m_id, name=m_name, description='', measurement_category_id=1000)
-            measurements.append(m_id)
-            accuracies.append('50km h-code')
-
-        # accuracy_infos = response.xpath('//*[@id="MainContent_pnlNominal"]/tr[1]/td/table/tr[16]/td[2]/table/tr[position()>1]/td[3]/text()')
-        # print("----- ALL ACCURACY LINKS",  accuracy_infos.extract())
-        # for accuracy_info in accuracy_infos.extract():
-        #     accuracy = accuracy_info.strip()
-        #     accuracies.append(accuracy)
-
-        # Summaries
-        resolution_summary = response.xpath('//*[@id="MainContent_lblInstrumentResolutionSummary"]/text()').extract_first(default='').strip()
-        if resolution_summary == '':
-            resolution_summary = None
-        best_resolution = response.xpath('//*[@id="MainContent_lblInstrumentResolutionSummary"]/i/text()').extract_first(default='').strip()
-        if best_resolution == '':
-            best_resolution = None
-        else:
-            best_resolution = best_resolution[1:-1].split(':', 1)[-1].strip()
-        swath_summary = response.xpath('//*[@id="MainContent_lblInstrumentSwathSummary"]/text()').extract_first(default='').strip()
-        if swath_summary == '':
-            swath_summary = None
-        max_swath = response.xpath('//*[@id="MainContent_lblInstrumentSwathSummary"]/i/text()').extract_first(default='').strip()
-        if max_swath == '':
-            max_swath = None
-        else:
-            max_swath = max_swath[1:-1].split(':', 1)[-1].strip()
-        accuracy_summary = response.xpath('//*[@id="MainContent_lblInstrumentAccuracySummary"]/text()').extract_first(default='').strip()
-        if accuracy_summary == '':
-            accuracy_summary = None
-        waveband_summary = response.xpath('//*[@id="MainContent_lblInstrumentWavebandSummary"]/text()').extract_first(default='').strip()
-        if waveband_summary == '':
-            waveband_summary = None
-
-        # Frequencies
-        wavebands = []
-        waveband_list = response.xpath('//*[@id="MainContent_pnlNominal"]/tr[1]/td/table/tr[14]/td[2]/i/table/tr/td/text()').extract()
-        for waveband in waveband_list:
-            w_name = waveband.split('(', 1)[0].strip()
-            if w_name != '':
-                wavebands.append(w_name)
-
-        # Debug information
-        print('Instrument:', instrument_name, instrument_id, instrument_fullname, agency_ids, status, maturity, types,
-              geometries, technology, sampling, data_access, data_format, measurements_and_applications, missions,
-              measurements, accuracies, resolution_summary, best_resolution, swath_summary, max_swath, accuracy_summary,
-              waveband_summary, wavebands)
-
-        # Send Instrument information to pipelines
-        yield Instrument(id=instrument_id, name=instrument_name, full_name=instrument_fullname,
-                         agencies=agency_ids, status=status, maturity=maturity, types=types, geometries=geometries,
-                         technology=technology, sampling=sampling, data_access=data_access, data_format=data_format,
-                         measurements_and_applications=measurements_and_applications, missions=missions,
-                         measurements=measurements, accuracies=accuracies, resolution_summary=resolution_summary,
-                         best_resolution=best_resolution, swath_summary=swath_summary, max_swath=max_swath,
-                         accuracy_summary=accuracy_summary, waveband_summary=waveband_summary, wavebands=wavebands)
+            return requests
+        instrument = self.extract(response, extract.extract_instrument, self.instrument_types,
+                                  self.instrument_geometries)
+        if isinstance(instrument, defer.Deferred):
+            return instrument.addCallback(self.instrument_items, requests)
+        return self.instrument_items(instrument, requests)
+
+    def instrument_items(self, instrument, requests):
+        # Instruments linking to missions or measurements that have not been seen yet are held back until they are
+        return requests + self.resolved_instrument_items(self.registry.add_instrument(instrument))
+
+    def resolved_instrument_items(self, instruments):
+        """Builds the items of instruments released by the registry.
+
+        Links to missions that do not exist are dropped, and measurements that never showed up in a measurement
+        category get an 'Other' placeholder.
+        """
+        results = []
+        for instrument in instruments:
+            # Missions
+            instrument['missions'] = [mission_id for mission_id in instrument['missions']
+                                      if mission_id in self.registry.seen['mission']]
+
+            # Measurements
+            measurement_names = instrument.pop('measurement_names')
+            for m_id in instrument['measurements']:
+                if m_id not in self.registry.seen['measurement']:
+                    self.registry.seen['measurement'].add(m_id)
+                    results.append(Measurement(id=m_id, name=measurement_names[m_id], description='',
+                                               measurement_category_id=1000))
+
+            # Debug information
+            self.logger.debug('Instrument: %s', instrument)
+
+            # Send Instrument information to pipelines
+            results.append(Instrument(**instrument))
+        return results
+
+    def spider_idle(self, spider):
+        # The instruments still waiting reference missions or measurements that were never crawled, so they are
+        # released from one last request once everything else is done
+        if self.registry.pending:
+            self.crawler.engine.crawl(scrapy.Request('data:,', callback=self.flush_registry, dont_filter=True,
+                                                     meta={'dont_obey_robotstxt': True}), self)
+            raise DontCloseSpider
+
+    def flush_registry(self, response):
+        return self.resolved_instrument_items(self.registry.flush())
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+# Staging-schema reloads for DatabasePipeline
+#
+# The whole catalog is built in a separate schema while readers keep using the current tables. Secondary indexes are
+# only built once everything is loaded, and the staged tables replace the live ones in a single transaction, so
+# readers see either the old catalog or the new one, never a partial one.
+
+import logging
+
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateIndex, CreateSchema, CreateTable
+
+from scraper.models import DeclarativeBase
+import scraper.views as views
+
+logger = logging.getLogger(__name__)
+
+
+def create_staging(engine, schema):
+    """Creates an empty staging schema with every table but without their secondary indexes, and returns an engine
+    that maps the tables to it"""
+    staging_engine = engine.execution_options(schema_translate_map={None: schema})
+    with engine.begin() as connection:
+        connection.execute(text('DROP SCHEMA IF EXISTS %s CASCADE' % schema))
+        connection.execute(CreateSchema(schema))
+    with staging_engine.begin() as connection:
+        for table in DeclarativeBase.metadata.sorted_tables:
+            connection.execute(CreateTable(table))
+    return staging_engine
+
+
+def create_indexes(staging_engine, schema):
+    """Builds the secondary indexes of the staged tables, and then the materialized views over them"""
+    with staging_engine.begin() as connection:
+        for table in DeclarativeBase.metadata.sorted_tables:
+            for index in table.indexes:
+                connection.execute(CreateIndex(index))
+    with staging_engine.begin() as connection:
+        views.create(connection, schema)
+
+
+def swap(engine, staging, target, retired):
+    """Moves the staged tables and views into the target schema in one transaction, and drops the ones they
+    replace"""
+    with engine.begin() as connection:
+        existing = set(inspect(connection).get_table_names(schema=target))
+        existing_views = set(connection.execute(text('SELECT matviewname FROM pg_matviews WHERE schemaname = :schema'),
+                                                {'schema': target}).scalars())
+        connection.execute(text('DROP SCHEMA IF EXISTS %s CASCADE' % retired))
+        connection.execute(CreateSchema(retired))
+        for view in views.VIEWS:
+            if view.table.name in existing_views:
+                connection.execute(text('ALTER MATERIALIZED VIEW %s.%s SET SCHEMA %s' % (
+                    target, view.table.name, retired)))
+        for table in DeclarativeBase.metadata.sorted_tables:
+            if table.name in existing:
+                connection.execute(text('ALTER TABLE %s.%s SET SCHEMA %s' % (target, table.name, retired)))
+        for table in DeclarativeBase.metadata.sorted_tables:
+            connection.execute(text('ALTER TABLE %s.%s SET SCHEMA %s' % (staging, table.name, target)))
+        for view in views.VIEWS:
+            connection.execute(text('ALTER MATERIALIZED VIEW %s.%s SET SCHEMA %s' % (
+                staging, view.table.name, target)))
+        connection.execute(text('DROP SCHEMA %s CASCADE' % retired))
+        connection.execute(text('DROP SCHEMA %s CASCADE' % staging))
+    logger.info('Swapped the tables of schema %s into %s', staging, target)
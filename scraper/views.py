@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+# Materialized views over the catalog tables
+#
+# The views precompute the joins our consumers run all the time, each with a unique index so that it can be refreshed
+# concurrently while it is being read. They are created with the tables (see migrations.upgrade), built in the staging
+# schema by staging reloads, and refreshed by DatabasePipeline at the end of every other crawl. The Table objects below
+# describe their columns for reading them (see scraper.queries), and are kept out of the catalog metadata so that
+# create_all never creates them as tables.
+
+import logging
+from collections import namedtuple
+
+from sqlalchemy import Column, Integer, MetaData, String, DateTime, Table, text
+from sqlalchemy.dialects.postgresql import ARRAY
+
+logger = logging.getLogger(__name__)
+
+MaterializedView = namedtuple('MaterializedView', ['table', 'definition', 'unique', 'indexes'])
+
+view_metadata = MetaData()
+
+instrument_measurement_orbits = Table(
+    'ceos_instrument_measurement_orbits', view_metadata,
+    Column('measurement_id', Integer), Column('measurement_name', String), Column('instrument_id', Integer),
+    Column('instrument_name', String), Column('technology', String), Column('instrument_status', String),
+    Column('mission_id', Integer), Column('mission_name', String), Column('mission_status', String),
+    Column('orbit_type', String), Column('orbit_inclination_class', String), Column('orbit_lst_class', String),
+    Column('orbit_altitude_class', String), Column('repeat_cycle_class', String))
+
+agency_missions = Table(
+    'ceos_agency_missions', view_metadata,
+    Column('agency_id', Integer), Column('agency_name', String), Column('country', String),
+    Column('mission_id', Integer), Column('mission_name', String), Column('mission_status', String),
+    Column('launch_date', DateTime), Column('eol_date', DateTime), Column('instrument_count', Integer),
+    Column('instrument_ids', ARRAY(Integer)))
+
+technology_instruments = Table(
+    'ceos_technology_instruments', view_metadata,
+    Column('technology', String), Column('status', String), Column('instrument_count', Integer),
+    Column('instrument_ids', ARRAY(Integer)))
+
+VIEWS = (
+    # Instruments by measurement, with the orbit of every mission they fly on
+    MaterializedView(instrument_measurement_orbits, '''
+        SELECT m.id AS measurement_id, m.name AS measurement_name, i.id AS instrument_id, i.name AS instrument_name,
+               i.technology, i.status AS instrument_status, s.id AS mission_id, s.name AS mission_name,
+               s.status AS mission_status, s.orbit_type, s.orbit_inclination_class, s.orbit_lst_class,
+               s.orbit_altitude_class, s.repeat_cycle_class
+        FROM ceos_measurements_of_instrument mi
+        JOIN ceos_measurements m ON m.id = mi.measurement_id
+        JOIN ceos_instruments i ON i.id = mi.instrument_id
+        JOIN ceos_instruments_in_mission im ON im.instrument_id = i.id
+        JOIN ceos_missions s ON s.id = im.mission_id''',
+                     ('measurement_id', 'instrument_id', 'mission_id'), (('measurement_name',), ('instrument_id',))),
+    # Agency -> mission -> instruments rollup
+    MaterializedView(agency_missions, '''
+        SELECT a.id AS agency_id, a.name AS agency_name, a.country, s.id AS mission_id, s.name AS mission_name,
+               s.status AS mission_status, s.launch_date, s.eol_date, count(im.instrument_id) AS instrument_count,
+               coalesce(array_agg(im.instrument_id ORDER BY im.instrument_id)
+                        FILTER (WHERE im.instrument_id IS NOT NULL), '{}') AS instrument_ids
+        FROM ceos_operators o
+        JOIN ceos_agencies a ON a.id = o.agency_id
+        JOIN ceos_missions s ON s.id = o.mission_id
+        LEFT JOIN ceos_instruments_in_mission im ON im.mission_id = s.id
+        GROUP BY a.id, s.id''',
+                     ('agency_id', 'mission_id'), (('mission_id',),)),
+    # Instruments by technology and status. Missing values are '' so that the unique index covers every row
+    MaterializedView(technology_instruments, '''
+        SELECT coalesce(technology, '') AS technology, coalesce(status, '') AS status, count(*) AS instrument_count,
+               array_agg(id ORDER BY id) AS instrument_ids
+        FROM ceos_instruments
+        GROUP BY 1, 2''',
+                     ('technology', 'status'), ()),
+)
+
+
+def create(connection, schema=None):
+    """Creates the views that do not exist yet, with their data and indexes. If a schema is given, the views are
+    created in it over its tables"""
+    if schema is not None:
+        connection.execute(text('SET LOCAL search_path TO %s' % schema))
+    for view in VIEWS:
+        name = view.table.name
+        connection.execute(text('CREATE MATERIALIZED VIEW IF NOT EXISTS %s AS %s' % (name, view.definition)))
+        connection.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS %s_key ON %s (%s)' % (
+            name, name, ', '.join(view.unique))))
+        for columns in view.indexes:
+            connection.execute(text('CREATE INDEX IF NOT EXISTS ix_%s_%s ON %s (%s)' % (
+                name, '_'.join(columns), name, ', '.join(columns))))
+    if schema is not None:
+        connection.execute(text('SET LOCAL search_path TO DEFAULT'))
+
+
+def refresh(engine, concurrently=True):
+    """Refreshes every view, concurrently with the readers if the view has been populated before"""
+    with engine.begin() as connection:
+        populated = dict(connection.execute(text('SELECT matviewname, ispopulated FROM pg_matviews '
+                                                 'WHERE schemaname = current_schema()')).fetchall())
+        for view in VIEWS:
+            name = view.table.name
+            if concurrently and populated.get(name):
+                connection.execute(text('REFRESH MATERIALIZED VIEW CONCURRENTLY %s' % name))
+            else:
+                connection.execute(text('REFRESH MATERIALIZED VIEW %s' % name))
+            logger.debug('Refreshed %s', name)
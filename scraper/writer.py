@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+# Dedicated database writer thread for DatabasePipeline
+#
+# The blocking SQLAlchemy calls of the pipeline run one by one, in the order they were submitted, on a single thread, so
+# the reactor keeps downloading and parsing while the database works. At most queue_size calls are queued or running at
+# a time: further submissions wait, and the Deferred the pipeline hands back to Scrapy waits with them, which holds the
+# scraper slot and stops new responses from piling up. Everything runs on the one thread because the caches of the
+# pipeline and the links of an item depend on the items written before it.
+
+import logging
+import queue
+import threading
+
+from twisted.internet import defer
+from twisted.python import failure
+
+logger = logging.getLogger(__name__)
+
+
+class WriterThread(object):
+    """Runs blocking calls in order on a dedicated thread, with at most queue_size of them in flight"""
+
+    def __init__(self, queue_size=1000, semaphore=None, name='DatabaseWriter'):
+        # Threads that share a semaphore share the limit
+        self.semaphore = semaphore or defer.DeferredSemaphore(queue_size)
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, function, *args):
+        """Queues a call. Returns a Deferred that fires once the call is queued, which waits while the queue is full,
+        and a Deferred that fires with the result of the call, or its failure"""
+        done = defer.Deferred()
+        queued = self.semaphore.acquire()
+        queued.addCallback(lambda _: self.queue.put((function, args, done)))
+        return queued, done
+
+    def run(self):
+        from twisted.internet import reactor
+        while True:
+            call = self.queue.get()
+            if call is None:
+                break
+            function, args, done = call
+            try:
+                result = self.call(function, args)
+            except Exception:
+                result = failure.Failure()
+            reactor.callFromThread(self.finished, done, result)
+
+    def call(self, function, args):
+        return function(*args)
+
+    def finished(self, done, result):
+        self.semaphore.release()
+        if isinstance(result, failure.Failure):
+            done.errback(result)
+        else:
+            done.callback(result)
+
+    def stop(self):
+        """Stops the thread once the queued calls have run"""
+        self.queue.put(None)